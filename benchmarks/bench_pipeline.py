@@ -0,0 +1,309 @@
+# Kerokero benchmarks - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Times each stage of the audio pipeline used by the GUI on synthetic sources of varied length, sample rate and channel
+# count, and records the peak memory use of each source. Results are saved as JSON, so they can be compared against a
+# previous run to catch performance regressions between releases.
+#
+# Usage (from the repository folder):
+#   python benchmarks/bench_pipeline.py                           Run all sources, save benchmarks/results/latest.json
+#   python benchmarks/bench_pipeline.py --quick                   Shorter sources, for a quick check
+#   python benchmarks/bench_pipeline.py --compare baseline.json   Report stages more than 25% slower than a baseline
+#
+# Each source is benchmarked in its own process, so its peak memory use is not affected by the others.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import kerokero_audio  # noqa: E402
+import kerokero_loudness  # noqa: E402
+import kerokero_resample  # noqa: E402
+
+RESULTS_VERSION = 1
+
+# Synthetic sources: (format, sample rate, channels, length in seconds). 'sys' is a raw pagefile.sys file
+SOURCES = [
+    ("wav", 22050, 1, 30),
+    ("wav", 44100, 2, 180),
+    ("wav", 48000, 2, 600),
+    ("mp3", 44100, 2, 180),
+    ("mp3", 48000, 1, 60),
+    ("sys", kerokero_audio.STOCK_SAMPLE_RATE, 1, 90),
+]
+QUICK_SECONDS = 10
+
+# Clip rendered from each source, like a typical loop: in and out points in milliseconds
+CLIP_START = 1000
+CLIP_LENGTH = 60000
+CLIP_GAIN = 3.0
+
+# Number of times each stage is repeated; the best time is reported alongside the median
+REPEATS = 5
+DECODE_REPEATS = 2
+
+# Slowdown, relative to the baseline, above which --compare reports a regression. Stages that got slower by less
+# than MIN_REGRESSION_TIME seconds are ignored, since timings that short are mostly noise
+DEFAULT_THRESHOLD = 0.25
+MIN_REGRESSION_TIME = 0.001
+
+
+def source_name(source):
+    file_format, frame_rate, channels, seconds = source
+    return f"{file_format}-{frame_rate}hz-{channels}ch-{seconds}s"
+
+
+def synthesize(frame_rate, channels, seconds, seed=0):
+    """Returns an int16 (frames, channels) test signal: a chord with a slow tremolo plus a little noise"""
+    rng = np.random.default_rng(seed)
+    t = np.arange(int(frame_rate * seconds)) / frame_rate
+    signal = np.zeros((len(t), channels), dtype=np.float32)
+    for channel in range(channels):
+        for frequency in (110.0, 220.0 * (1 + channel * 0.01), 330.0, 1760.0):
+            signal[:, channel] += np.sin(2 * np.pi * frequency * t).astype(np.float32)
+        signal[:, channel] *= (0.6 + 0.4 * np.sin(2 * np.pi * 0.5 * t)).astype(np.float32)
+    signal /= np.abs(signal).max()
+    signal = signal * 20000 + rng.standard_normal(signal.shape).astype(np.float32) * 300
+    return np.clip(signal, -32768, 32767).astype(np.int16)
+
+
+def write_source(source, folder):
+    """Writes a synthetic source file and returns its path"""
+    file_format, frame_rate, channels, seconds = source
+    samples = synthesize(frame_rate, channels, seconds)
+    path = os.path.join(folder, f"{source_name(source)}.{file_format}")
+
+    kerokero_audio.export_clip(samples, frame_rate, path, file_format)
+    return path
+
+
+def peak_rss_mb():
+    """Returns the peak resident memory of this process in MB, or None if it cannot be measured"""
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS reports bytes
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+    except ImportError:
+        pass
+
+    try:
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        process = ctypes.windll.kernel32.GetCurrentProcess()
+        if ctypes.windll.psapi.GetProcessMemoryInfo(process, ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize / 1024 / 1024
+    except (AttributeError, OSError):
+        pass
+    return None
+
+
+def time_stage(results, source, stage, function, repeats=REPEATS, frames=None):
+    """Runs a stage several times and records its best and median time. Returns the stage's last result"""
+    times = []
+    result = None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        times.append(time.perf_counter() - start_time)
+
+    if frames is None:
+        frames = len(result) if isinstance(result, np.ndarray) else getattr(result, "frame_count", None)
+    results.append({
+        "source": source_name(source),
+        "stage": stage,
+        "best": min(times),
+        "median": statistics.median(times),
+        "repeats": repeats,
+        "frames": frames,
+        "peak_rss_mb": peak_rss_mb(),
+    })
+    return result
+
+
+def benchmark_source(source, path):
+    """Times each pipeline stage on one source file, returning a list of result dicts"""
+    file_format, frame_rate, channels, seconds = source
+    results = []
+    end_pos = CLIP_START + min(CLIP_LENGTH, seconds * 1000 - CLIP_START - 1)
+
+    if file_format == "sys":
+        # Existing pagefile.sys files: memory-map, then resample to the patched firmware's rate
+        with kerokero_audio.PagefileSys(path, frame_rate) as pagefile:
+            audio = time_stage(results, source, "decode", pagefile.to_audio_data, frames=pagefile.frame_count)
+            time_stage(results, source, "resample_pagefile",
+                       lambda: kerokero_resample.resample(audio.samples, frame_rate,
+                                                          kerokero_audio.PATCHED_SAMPLE_RATE))
+        return results
+
+    # The decoded audio cache is skipped for the first decode, then timed separately
+    with tempfile.TemporaryDirectory() as cache_dir:
+        os.environ["KEROKERO_CACHE_DIR"] = cache_dir
+        audio = time_stage(results, source, "decode", lambda: kerokero_audio.AudioData.from_file(path),
+                           repeats=DECODE_REPEATS)
+        if kerokero_audio.is_cacheable(path):
+            kerokero_audio.store_cached_audio(path, audio)
+            time_stage(results, source, "decode_cached", lambda: kerokero_audio.load_cached_audio(path),
+                       frames=audio.frame_count)
+
+    # The stages of rendering a clip, in the order the GUI runs them
+    clip = time_stage(results, source, "slice", lambda: audio.view(CLIP_START, end_pos))
+    mono = time_stage(results, source, "downmix", lambda: kerokero_audio.downmix(clip))
+    rendered = None
+    for target_rate in kerokero_audio.TARGET_SAMPLE_RATES:
+        rendered = time_stage(results, source, f"resample_{target_rate}",
+                              lambda: kerokero_resample.resample(mono, frame_rate, target_rate))
+    time_stage(results, source, "apply_gain", lambda: kerokero_audio.apply_gain(rendered, CLIP_GAIN))
+    time_stage(results, source, "measure_loudness",
+               lambda: kerokero_loudness.measure_loudness(rendered, kerokero_audio.PATCHED_SAMPLE_RATE),
+               frames=len(rendered))
+    time_stage(results, source, "render_samples",
+               lambda: kerokero_audio.render_samples(audio, CLIP_START, end_pos, CLIP_GAIN,
+                                                     kerokero_audio.STOCK_SAMPLE_RATE))
+
+    # Exporting: raw s16le pagefile.sys, PCM .WAV, and conversion of the sample array to and from a pydub AudioSegment
+    with tempfile.TemporaryDirectory() as output_dir:
+        output_file = os.path.join(output_dir, "pagefile.sys")
+        time_stage(results, source, "export_s16le", lambda: kerokero_audio.export_pagefile(rendered, output_file),
+                   frames=len(rendered))
+        wav_file = os.path.join(output_dir, "clip.wav")
+        time_stage(results, source, "export_wav", lambda: kerokero_audio.export_wav(clip, frame_rate, wav_file),
+                   frames=len(clip))
+    segment = time_stage(results, source, "to_segment",
+                         lambda: kerokero_audio.samples_to_segment(clip, frame_rate), frames=len(clip))
+    time_stage(results, source, "from_segment", lambda: kerokero_audio.AudioData.from_segment(segment),
+               frames=len(clip))
+
+    # pydub's set_frame_rate, which the resampler replaced, for reference (audioop was removed in Python 3.13)
+    try:
+        mono_segment = kerokero_audio.samples_to_segment(mono, frame_rate)
+        time_stage(results, source, "pydub_set_frame_rate",
+                   lambda: mono_segment.set_frame_rate(kerokero_audio.STOCK_SAMPLE_RATE), repeats=1, frames=len(mono))
+    except ImportError:
+        pass
+
+    return results
+
+
+def run_child(source_index, quick):
+    """Benchmarks one source in this process and prints its results as JSON (runs in a child process)"""
+    source = SOURCES[source_index]
+    if quick:
+        source = source[:3] + (QUICK_SECONDS,)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = write_source(source, folder)
+        results = benchmark_source(source, path)
+    print(json.dumps(results))
+
+
+def run_all(quick):
+    """Benchmarks every source, each in its own process, and returns the results document"""
+    results = []
+    for index, source in enumerate(SOURCES):
+        if source[0] == "mp3" and not can_encode_mp3():
+            print(f"Skipping {source_name(source)}: ffmpeg is needed to create MP3 sources", file=sys.stderr)
+            continue
+
+        command = [sys.executable, os.path.abspath(__file__), "--child", str(index)] + (["--quick"] if quick else [])
+        process = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True)
+        results.extend(json.loads(process.stdout.strip().splitlines()[-1]))
+
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "quick": quick,
+        "python_version": platform.python_version(),
+        "numpy_version": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "results": results,
+    }
+
+
+def can_encode_mp3():
+    from pydub.utils import get_encoder_name, which
+    return which(get_encoder_name()) is not None
+
+
+def print_results(document):
+    print(f"{'Source':<26}{'Stage':<24}{'Best (ms)':>12}{'Median (ms)':>13}{'Frames/s':>20}{'Peak RSS (MB)':>15}")
+    for result in document["results"]:
+        rate = f"{result['frames'] / result['best']:,.0f}" if result["frames"] and result["best"] else ""
+        rss = f"{result['peak_rss_mb']:.0f}" if result["peak_rss_mb"] is not None else ""
+        print(f"{result['source']:<26}{result['stage']:<24}{result['best'] * 1000:>12.2f}"
+              f"{result['median'] * 1000:>13.2f}{rate:>20}{rss:>15}")
+
+
+def compare(document, baseline, threshold):
+    """Prints the stages that got slower than the baseline by more than threshold, and returns how many there were"""
+    baseline_times = {(result["source"], result["stage"]): result["best"] for result in baseline["results"]}
+    regressions = 0
+    for result in document["results"]:
+        previous = baseline_times.get((result["source"], result["stage"]))
+        if not previous:
+            continue
+        change = result["best"] / previous - 1
+        if change > threshold and result["best"] - previous > MIN_REGRESSION_TIME:
+            regressions += 1
+            print(f"REGRESSION {result['source']} {result['stage']}: {previous * 1000:.2f} ms -> "
+                  f"{result['best'] * 1000:.2f} ms ({change:+.0%})")
+    print(f"{regressions} regression(s) above {threshold:.0%} compared to {baseline['timestamp']}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Kerokero audio pipeline on synthetic sources.")
+    parser.add_argument("--output", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                                         "latest.json"),
+                        help="JSON file to save the results to (default: benchmarks/results/latest.json)")
+    parser.add_argument("--compare", metavar="BASELINE", help="JSON results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help=f"Slowdown reported as a regression (default: {DEFAULT_THRESHOLD})")
+    parser.add_argument("--quick", action="store_true", help=f"Use {QUICK_SECONDS} second sources")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        run_child(args.child, args.quick)
+        return 0
+
+    document = run_all(args.quick)
+    print_results(document)
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(document, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            baseline = json.load(f)
+        if compare(document, baseline, args.threshold):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -30,13 +30,15 @@ copy LICENSE "dist\license.txt"
 copy requirements.txt "dist\requirements.txt"
 copy kerokero.py "dist\kerokero.py"
 copy kerokero.py "dist\kerokero.pyw"
+:: supporting modules used by kerokero.py
+copy kerokero_*.py "dist\"
 copy kerokero.svg "dist\kerokero.svg"
 copy install-required-packages.bat "dist\install-required-packages.bat"
 cd dist
 
 :: package .zip files
-7za a Kerokero-win-v%ver%.zip kerokero-%ver%.exe kerokero.pyw kerokero.svg readme.txt license.txt requirements.txt install-required-packages.bat
-7za a Kerokero-python-v%ver%.zip kerokero.py kerokero.svg readme.txt license.txt requirements.txt install-required-packages.bat
+7za a Kerokero-win-v%ver%.zip kerokero-%ver%.exe kerokero.pyw kerokero_*.py kerokero.svg readme.txt license.txt requirements.txt install-required-packages.bat
+7za a Kerokero-python-v%ver%.zip kerokero.py kerokero_*.py kerokero.svg readme.txt license.txt requirements.txt install-required-packages.bat
 cd ..
 
 :: cleanup
@@ -46,6 +48,7 @@ del dist\license.txt
 del dist\requirements.txt
 del dist\kerokero.py
 del dist\kerokero.pyw
+del dist\kerokero_*.py
 del dist\kerokero.svg
 del dist\install-required-packages.bat
 del kerokero-%ver%.exe.spec
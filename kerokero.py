@@ -1,15 +1,47 @@
 # Kerokero.py - SF2000+GB300 BGM Tool by Dteyn
 # https://github.com/Dteyn/SF2000_BGM_Tool
 
+import atexit
+import importlib
+import importlib.util
 import sys
+import time
 
 script_version = "0.2.0"
 
+# STARTUP PROFILING - run with --profile-startup to print how long each step of startup takes
+startup_time = time.perf_counter()
+profile_startup = "--profile-startup" in sys.argv
+
+# PERFORMANCE TRACING - run with --trace <file> to save a Chrome trace of the session's timing spans when it closes
+trace_file = sys.argv[sys.argv.index("--trace") + 1] if "--trace" in sys.argv[:-1] else None
+startup_steps = []
+
+
+def mark_startup(step):
+    """Records the time at which startup finished a step"""
+    startup_steps.append((step, time.perf_counter()))
+
+
+def print_startup_profile():
+    """Prints the time taken by each step of startup, and the total time until the window was shown"""
+    print(f"{'Startup step':<40}{'Step (ms)':>12}{'Total (ms)':>12}")
+    previous = startup_time
+    for step, step_time in startup_steps:
+        print(f"{step:<40}{(step_time - previous) * 1000:>12.1f}{(step_time - startup_time) * 1000:>12.1f}")
+        previous = step_time
+
+
 # VERSION CHECK - Python >3.6 is required
 if sys.version_info < (3, 6):
     print("This script requires Python 3.6 or later.")
     sys.exit(1)
 
+# Required for the batch converter's worker processes when running as a PyInstaller .EXE
+if getattr(sys, 'frozen', False):
+    import multiprocessing
+    multiprocessing.freeze_support()
+
 
 # PACKAGE CHECK - Check if packages required are installed, if not, display an error message
 packages_required = {
@@ -20,19 +52,44 @@ packages_required = {
 }
 
 
-def check_packages():
-    """Checks for missing packages that are required by this script"""
+# Command line commands, which run headless and do not require PyQt5 (see kerokero_cli.py)
+cli_commands = ("convert", "migrate")
+
+
+def check_packages(exclude=()):
+    """Checks for missing packages that are required by this script
+    Only looks the packages up rather than importing them, so the check costs almost nothing at startup
+    """
     packages_missing = []
 
     for lib_name, lib_import in packages_required.items():
-        try:
-            __import__(lib_import)
-        except ImportError:
+        if lib_name in exclude:
+            continue
+        if importlib.util.find_spec(lib_import) is None:
             packages_missing.append(lib_name)
 
     return packages_missing
 
 
+class LazyModule:
+    """Stands in for a module and imports it the first time one of its attributes is used
+    Keeps slow imports (numpy, pydub, and sounddevice, which initializes PortAudio) out of startup. Importing is
+    thread-safe, so the first use can come from any thread
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+
+    def __getattr__(self, attribute):
+        if self.module is None:
+            import_start = time.perf_counter()
+            self.module = importlib.import_module(self.name)
+            if profile_startup:
+                print(f"Imported {self.name} on first use in {(time.perf_counter() - import_start) * 1000:.1f} ms")
+        return getattr(self.module, attribute)
+
+
 def show_error_message(package_list):
     """Displays an error message if required packages are not found."""
     # Prepare the message
@@ -61,8 +118,20 @@ def show_error_message(package_list):
         print("ERROR: " + error_message)
 
 
+# COMMAND LINE MODE - run the headless batch converter without importing PyQt5 or starting the GUI
+if __name__ == "__main__" and len(sys.argv) > 1 and sys.argv[1] in cli_commands:
+    missing_packages = check_packages(exclude=("PyQt5", "sounddevice"))
+    if missing_packages:
+        print(f"ERROR: The following packages are required, but not installed: {', '.join(missing_packages)}")
+        sys.exit(1)
+
+    # Run kerokero_cli as __main__ so that worker processes import it instead of this script
+    import runpy
+    runpy.run_module("kerokero_cli", run_name="__main__", alter_sys=True)
+
 # Check for missing packages, if any are missing display an error. If not, proceed with imports
 missing_packages = check_packages()
+mark_startup("Package check")
 
 if missing_packages:
     show_error_message(missing_packages)
@@ -70,32 +139,58 @@ if missing_packages:
 else:
     import locale
     import logging
-    import numpy as np
+    import logging.handlers
     import os
+    import queue
     import platform
-    import sounddevice as sd
     import threading
-    import time
     from datetime import datetime
-    from PyQt5.QtCore import QTimer
+    from PyQt5.QtCore import QTimer, pyqtSignal, pyqtSlot
     from PyQt5.QtGui import QIcon
     from PyQt5.QtWidgets import QApplication, QFrame, QWidget, QVBoxLayout, QPushButton, QLabel
-    from PyQt5.QtWidgets import QFileDialog, QLineEdit, QMessageBox, QHBoxLayout, QTextEdit
-    from pydub import AudioSegment
+    from PyQt5.QtWidgets import QFileDialog, QLineEdit, QMessageBox, QHBoxLayout, QTextEdit, QComboBox, QProgressBar
+    from PyQt5.QtWidgets import QCheckBox
+    import kerokero_trace
+    import kerokero_widgets
+    mark_startup("Import PyQt5")
+
+    # The audio modules import numpy, pydub and sounddevice, which are slow to import, so they are imported when first
+    # used instead, after the window is shown
+    np = LazyModule("numpy")
+    kerokero_analysis = LazyModule("kerokero_analysis")
+    kerokero_audio = LazyModule("kerokero_audio")
+    kerokero_player = LazyModule("kerokero_player")
 
 
 class AudioConverterApp(QWidget):
+    # Emitted from the background thread when the waveform peaks of a file are ready: (audio, pyramid)
+    pyramid_ready = pyqtSignal(object, object)
+    stereo_ready = pyqtSignal(object, object)
+    # Emitted from the file loading thread: (cancel event of the load, fraction decoded / ProgressiveDecoder that can
+    # be played / AudioData / error message / guessed pagefile.sys sample rate and the reason for it)
+    load_progress = pyqtSignal(object, float)
+    load_playable = pyqtSignal(object, object)
+    load_finished = pyqtSignal(object, object)
+    load_failed = pyqtSignal(object, str)
+    pagefile_rate_guessed = pyqtSignal(object, int, str)
+
     def __init__(self):
         super().__init__()
 
-        # Set the timer interval for updating current position in ms
-        self.timer_interval = 10
+        # Set the timer interval for updating the current position label in ms (about 30 frames per second).
+        # The position itself is read from the audio stream clock, so this only affects how often the label redraws
+        self.timer_interval = 33
 
         # Initialize instance attributes
         self.layout = None
         self.file_label = None
         self.select_button = None
+        self.load_layout = None
+        self.load_progress_bar = None
+        self.cancel_load_button = None
         self.file_info_text_edit = None
+        self.waveform = None
+        self.spectrogram = None
         self.transport_layout = None
         self.mark_in_button = None
         self.play_button = None
@@ -109,31 +204,76 @@ class AudioConverterApp(QWidget):
         self.end_position = None
         self.gain_label = None
         self.gain_adjust = None
+        self.normalize_layout = None
+        self.normalize_loudness = None
+        self.target_loudness = None
+        self.crossfade_label = None
+        self.crossfade_length = None
+        self.downmix_label = None
+        self.downmix_mode = None
+        self.search_window_label = None
+        self.search_window = None
+        self.find_loop_button = None
+        self.suggest_loops_button = None
+        self.loop_suggestions = None
+        self.preview_as_label = None
+        self.preview_as = None
         self.preview_button = None
         self.preview_loop_button = None
         self.stop_preview_button = None
         self.process_button = None
+        self.export_layout = None
+        self.export_formats = None
+        self.export_button = None
         self.audio_file = None
         self.audio_filename_only = None
         self.audio = None
+        self.renders = None
+        self.load_cancel = None
+        self.decoder = None
+        self.beat_grid = None
+        self.suggestions = None
+        self.stereo = None
         self.timer = None
         self.current_position = None
         self.playing = None
-        self.preview_segment = None
         self.preview_samples = None
-        self.previewing = None
-        self.preview_thread = None
-        self.preview_segment_splice = None
-        self.clip_segment = None
-        self.play_segment = None
+        self.clip_samples = None
         self.play_samples = None
 
+        # Audio player used for playback and previews, created on first use (see the player property)
+        self.audio_player = None
+
+        # Show the waveform when it has been computed in the background
+        # noinspection PyUnresolvedReferences
+        self.pyramid_ready.connect(self.show_waveform)
+        # noinspection PyUnresolvedReferences
+        self.stereo_ready.connect(self.show_stereo_warning)
+
+        # Report progress and results of files decoded in the background
+        # noinspection PyUnresolvedReferences
+        self.load_progress.connect(self.show_load_progress)
+        # noinspection PyUnresolvedReferences
+        self.load_playable.connect(self.file_playable)
+        # noinspection PyUnresolvedReferences
+        self.load_finished.connect(self.file_loaded)
+        # noinspection PyUnresolvedReferences
+        self.load_failed.connect(self.file_load_failed)
+        # noinspection PyUnresolvedReferences
+        self.pagefile_rate_guessed.connect(self.open_pagefile)
+
         # Set up the UI
         self.init_ui()
 
+    @property
+    def player(self):
+        """The audio player, created on first use since opening the audio device is slow"""
+        if self.audio_player is None:
+            self.audio_player = kerokero_player.AudioPlayer()
+        return self.audio_player
+
     def init_ui(self):
         """Sets up the User Interface elements"""
-        logging.debug("Entering init_ui method")
         self.layout = QVBoxLayout()
 
         # Label for the currently selected file
@@ -148,12 +288,38 @@ class AudioConverterApp(QWidget):
         self.select_button.setToolTip("Select the audio file to process")
         self.layout.addWidget(self.select_button)
 
+        # Loading progress bar and Cancel button - only shown while a file is being decoded
+        self.load_layout = QHBoxLayout()
+        self.load_progress_bar = QProgressBar()
+        self.load_progress_bar.setRange(0, 100)
+        self.load_progress_bar.setVisible(False)
+        self.load_layout.addWidget(self.load_progress_bar)
+        self.cancel_load_button = QPushButton('Cancel')
+        # noinspection PyUnresolvedReferences
+        self.cancel_load_button.clicked.connect(self.cancel_load)
+        self.cancel_load_button.setVisible(False)
+        self.cancel_load_button.setToolTip("Stop loading the selected file")
+        self.load_layout.addWidget(self.cancel_load_button)
+        self.layout.addLayout(self.load_layout)
+
         # File information area
         self.file_info_text_edit = QTextEdit(self)
         self.file_info_text_edit.setReadOnly(True)
         self.file_info_text_edit.setFixedHeight(80)
         self.layout.addWidget(self.file_info_text_edit)
 
+        # Waveform overview - drawn from peaks computed in the background after a file is loaded
+        self.waveform = kerokero_widgets.WaveformView(self)
+        self.waveform.setFixedHeight(100)
+        # noinspection PyUnresolvedReferences
+        self.waveform.seek_requested.connect(self.seek_audio)
+        self.layout.addWidget(self.waveform)
+
+        # Spectrogram of the loop seam, computed in the background once a file has loaded
+        self.spectrogram = kerokero_widgets.SpectrogramView(self)
+        self.spectrogram.setFixedHeight(100)
+        self.layout.addWidget(self.spectrogram)
+
         # Create a horizontal layout for the transport controls
         self.transport_layout = QHBoxLayout()
 
@@ -229,13 +395,101 @@ class AudioConverterApp(QWidget):
         self.gain_adjust.setToolTip("Make the audio louder or quieter by adjusting the gain in dB (ex. +3 or -3)")
         self.layout.addWidget(self.gain_adjust)
 
-        # 'Preview Full Clip' button - preview the entire audio clip and loop. Clip is pre-looped 3x to prevent delay
+        # Loudness normalization checkbox and target - sets the gain so every clip plays at the same perceived volume
+        self.normalize_layout = QHBoxLayout()
+        self.normalize_loudness = QCheckBox('Normalize Loudness To (LUFS):')
+        # noinspection PyUnresolvedReferences
+        self.normalize_loudness.toggled.connect(self.toggle_normalize_loudness)
+        self.normalize_loudness.setToolTip("Measure the loudness of the clip and set the gain to reach the target\n"
+                                           "loudness, without letting the peaks go above -1 dBTP.\n"
+                                           "Replaces the Gain Adjustment.")
+        self.normalize_layout.addWidget(self.normalize_loudness)
+        self.target_loudness = QLineEdit('-16')
+        self.target_loudness.setEnabled(False)
+        self.target_loudness.setToolTip("Target loudness in LUFS (ex. -16). Higher values are louder")
+        self.normalize_layout.addWidget(self.target_loudness)
+        self.layout.addLayout(self.normalize_layout)
+
+        # Loop crossfade label and input box - blends the end of the clip into its start so it loops seamlessly
+        self.crossfade_label = QLabel('Loop Crossfade (ms):')
+        self.layout.addWidget(self.crossfade_label)
+        self.crossfade_length = QLineEdit('0')
+        self.crossfade_length.setToolTip("Fade the end of the clip into its start so the loop has no click (ex. 50).\n"
+                                         "The saved clip is shorter by this length. Both previews play the result.")
+        self.layout.addWidget(self.crossfade_length)
+
+        # Mono down-mix label and list - how stereo audio is made mono for pagefile.sys
+        self.downmix_label = QLabel('Mono Down-mix (pagefile.sys):')
+        self.layout.addWidget(self.downmix_label)
+        self.downmix_mode = QComboBox()
+        for label, mode in (("Mix (average the channels)", "mix"),
+                            ("Mid (average, then make up for phase cancellation)", "mid"),
+                            ("Left channel only", "left"),
+                            ("Right channel only", "right")):
+            self.downmix_mode.addItem(label, mode)
+        self.downmix_mode.setToolTip("How stereo audio is made mono for pagefile.sys. If the channels are out of\n"
+                                     "phase, averaging them sounds hollow or quiet: use Mid, Left or Right instead.")
+        self.layout.addWidget(self.downmix_mode)
+
+        # Loop search window label and input box - how far from the End Position to search for the best loop point
+        self.search_window_label = QLabel('Loop Search Window (ms):')
+        self.layout.addWidget(self.search_window_label)
+        self.search_window = QLineEdit('2000')
+        self.search_window.setToolTip("How far before and after the End Position to search for the best loop point")
+        self.layout.addWidget(self.search_window)
+
+        # 'Find Best Loop Point' button - searches near the End Position for the point that loops most seamlessly
+        self.find_loop_button = QPushButton('Find Best Loop Point')
+        # noinspection PyUnresolvedReferences
+        self.find_loop_button.clicked.connect(self.find_loop_point)
+        self.find_loop_button.setFixedHeight(50)
+        self.find_loop_button.setEnabled(False)
+        self.find_loop_button.setToolTip("Search around the End Position for the point that joins most seamlessly\n"
+                                         "back to the Start Position. Both points are moved to zero crossings.")
+        self.layout.addWidget(self.find_loop_button)
+
+        # 'Suggest Loops' button and list - proposes loops aligned to whole bars that fit within 90 seconds
+        self.suggest_loops_button = QPushButton('Suggest Bar-Aligned Loops')
+        # noinspection PyUnresolvedReferences
+        self.suggest_loops_button.clicked.connect(self.suggest_loops)
+        self.suggest_loops_button.setFixedHeight(50)
+        self.suggest_loops_button.setEnabled(False)
+        self.suggest_loops_button.setToolTip("Detect the tempo and bars of the track, and suggest loops made of whole\n"
+                                             "bars that fit within 90 seconds. Results are cached for each file.")
+        self.layout.addWidget(self.suggest_loops_button)
+        self.loop_suggestions = QComboBox()
+        # noinspection PyUnresolvedReferences
+        self.loop_suggestions.activated.connect(self.select_loop_suggestion)
+        self.loop_suggestions.setEnabled(False)
+        self.loop_suggestions.setToolTip("Select a suggested loop to set the Start and End positions")
+        self.layout.addWidget(self.loop_suggestions)
+
+        # 'Preview As' label and list - plays previews as the original audio, or as the pagefile the SF2000 plays.
+        # Each item holds the rate the clip is rendered at and the rate the firmware plays it at (None for original).
+        # The rates are written out so building the window doesn't import kerokero_audio before it is shown
+        self.preview_as_label = QLabel('Preview As:')
+        self.layout.addWidget(self.preview_as_label)
+        self.preview_as = QComboBox()
+        stock_rate, patched_rate = 21560, 22050
+        for label, rates in (("Original audio", (None, None)),
+                             ("Stock firmware (21560 Hz pagefile.sys)", (stock_rate, stock_rate)),
+                             ("Patched firmware (22050 Hz pagefile.sys)", (patched_rate, patched_rate)),
+                             ("21560 Hz pagefile.sys on patched firmware (plays fast)", (stock_rate, patched_rate)),
+                             ("22050 Hz pagefile.sys on stock firmware (plays slow)", (patched_rate, stock_rate))):
+            self.preview_as.addItem(label, rates)
+        self.preview_as.setToolTip("Play previews as the exact 16-bit mono samples saved to pagefile.sys,\n"
+                                   "at the speed the firmware plays them. Use the mismatched options to hear\n"
+                                   "a pagefile on the wrong firmware. Saving the clip afterwards re-uses the\n"
+                                   "rendered samples.")
+        self.layout.addWidget(self.preview_as)
+
+        # 'Preview Full Clip' button - preview the entire audio clip, looping seamlessly until stopped
         self.preview_button = QPushButton('Preview Full Audio Clip')
         # noinspection PyUnresolvedReferences
         self.preview_button.clicked.connect(self.preview_audio)
         self.preview_button.setFixedHeight(50)
         self.preview_button.setEnabled(False)
-        self.preview_button.setToolTip("Preview the entire audio clip from start to finish, looped 3x")
+        self.preview_button.setToolTip("Preview the entire audio clip from start to finish, looped until stopped")
         self.layout.addWidget(self.preview_button)
 
         # 'Preview Loop Transition' button - previews the loop point in the audio clip
@@ -274,6 +528,26 @@ class AudioConverterApp(QWidget):
         self.process_button.setToolTip("Process the audio and save the audio clip to file")
         self.layout.addWidget(self.process_button)
 
+        # Format checkboxes and 'Save Checked Formats' button - saves the clip in several formats to a folder at once
+        self.export_layout = QHBoxLayout()
+        self.export_formats = {}
+        for target, label, checked in (("stock", "pagefile.sys (21560 Hz)", True),
+                                       ("patched", "pagefile.sys (22050 Hz)", True),
+                                       ("wav", "WAV", False),
+                                       ("mp3", "MP3", False)):
+            self.export_formats[target] = QCheckBox(label)
+            self.export_formats[target].setChecked(checked)
+            self.export_layout.addWidget(self.export_formats[target])
+        self.layout.addLayout(self.export_layout)
+        self.export_button = QPushButton('Save Checked Formats to Folder')
+        # noinspection PyUnresolvedReferences
+        self.export_button.clicked.connect(self.export_all_formats)
+        self.export_button.setFixedHeight(50)
+        self.export_button.setEnabled(False)
+        self.export_button.setToolTip("Save the clip in every checked format to a folder, rendering it only once.\n"
+                                      "Pagefiles are saved as stock/pagefile.sys and patched/pagefile.sys.")
+        self.layout.addWidget(self.export_button)
+
         # Set the layout and display the window
         self.setLayout(self.layout)
         self.setWindowTitle(f'Kerokero v{script_version} by Dteyn')
@@ -282,11 +556,10 @@ class AudioConverterApp(QWidget):
         # Lock the window size
         self.setFixedSize(self.size())
 
-        logging.debug("Exiting init_ui method\n")
-
+    @pyqtSlot()
+    @kerokero_trace.traced()
     def select_file(self):
-        """Prompts the user to select a .WAV or .MP3 file for input, loads the file and displays information"""
-        logging.debug("Entering select_file method")
+        """Prompts the user to select a .WAV, .MP3 or .SYS file for input, loads the file and displays information"""
         try:
             self.audio_file, _ = QFileDialog.getOpenFileName(self, "Select the .WAV or .MP3, or .SYS file to convert",
                                                              "",
@@ -302,87 +575,316 @@ class AudioConverterApp(QWidget):
                 file_extension = os.path.splitext(self.audio_file)[1].lower()
 
                 if file_extension in ['.wav', '.mp3']:
-                    # Load audio file and display information
-                    self.audio = AudioSegment.from_file(self.audio_file)
-
-                    # Get the duration in mm:ss format
-                    minutes, seconds = divmod(len(self.audio) // 1000, 60)
-                    duration_formatted = f"{minutes}:{seconds:02d}"
-
-                    # Get the number of channels, display Stereo or Mono accordingly
-                    if self.audio.channels > 1:
-                        channels_text = "Stereo"
-                    else:
-                        channels_text = "Mono"
-
-                    # Display the file information
-                    file_info_text = (
-                        f"Format: {self.audio_file.split('.')[-1].upper()}, "
-                        f"Length: {len(self.audio)} ms ({duration_formatted}), "
-                        f"Sample Rate: {self.audio.frame_rate}Hz, "
-                        f"Channels: {channels_text}, "
-                        f"Bit Depth: {self.audio.sample_width * 8}-bit"
-                    )
-                    self.file_info_text_edit.setText(file_info_text)
-                    logging.info(f"Input File Information:\n {file_info_text}")
-
-                    # Set up a timer to display the current position
-                    self.timer = QTimer()
-                    # noinspection PyUnresolvedReferences
-                    self.timer.timeout.connect(self.update_current_position)
-                    self.timer.setInterval(self.timer_interval)
-                    self.current_position = 0
-                    self.playing = False
-
-                    # Enable buttons in the UI
-                    self.play_button.setEnabled(True)
-                    self.preview_button.setEnabled(True)
-                    self.preview_loop_button.setEnabled(True)
-                    self.process_button.setEnabled(True)
+                    # Decode the file in a background thread, so the window stays responsive and loading can be
+                    # cancelled. file_loaded displays it when decoding has finished
+                    self.start_loading(self.audio_file)
 
                 elif file_extension == '.sys':
-                    # Ask the user if they would like to convert an existing .sys file
-                    reply = QMessageBox.question(self, 'Convert .SYS File to 22050 Hz',
-                                                 "You have selected an existing pagefile.sys file.\n"
-                                                 "This tool can resample an existing pagefile.sys\n"
-                                                 "file to 22050 Hz, to fix the playback speed if\n"
-                                                 "you have applied the BGM Sample Rate fix.\n\n"
-                                                 "Would you like to resample the file?\n",
-                                                 QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
-
-                    if reply == QMessageBox.Yes:
-                        # Proceed to convert the .sys file
-                        self.convert_sys_file()
-                    else:
-                        # User chose not to convert the .sys file or closed the dialog, cancel the operation
-                        return
+                    # The sample rate is not stored in a pagefile.sys file, so it is guessed from the audio in the
+                    # background first. open_pagefile then asks how to open it
+                    self.start_loading(self.audio_file)
             else:
                 logging.info("File selection was cancelled")
 
         except Exception as e:
             logging.error(f"Error selecting file: {e}")
             QMessageBox.critical(self, "Error Selecting File", str(e))
-        logging.debug("Exiting select_file method\n")
 
-    def convert_sys_file(self):
+    def start_loading(self, audio_file, pagefile_rate=None):
+        """Starts decoding an audio file in a background thread, cancelling any file that is still loading
+        A pagefile.sys file is read as raw audio at pagefile_rate. Without a rate, its rate is guessed instead and
+        open_pagefile asks how to open it
         """
-        Converts an audio file from 21560 Hz to 22050 Hz and allows the user to select the output file path.
+        if self.load_cancel is not None:
+            self.load_cancel.set()
+        if self.audio_player is not None:
+            self.audio_player.stop()
+        if self.timer is not None:
+            self.timer.stop()
+        self.playing = False
+        self.audio = None
+        self.renders = None
+        self.decoder = None
+        self.waveform.clear()
+        self.spectrogram.clear()
+
+        # Disable everything that needs a loaded file until decoding has finished
+        for button in (self.mark_in_button, self.play_button, self.stop_button, self.mark_out_button,
+                       self.find_loop_button, self.suggest_loops_button, self.preview_button,
+                       self.preview_loop_button, self.stop_preview_button, self.process_button,
+                       self.export_button):
+            button.setEnabled(False)
+        self.loop_suggestions.setEnabled(False)
+        self.file_info_text_edit.setText(f"Loading {os.path.basename(audio_file)}...")
+
+        self.load_progress_bar.setValue(0)
+        self.load_progress_bar.setVisible(True)
+        self.cancel_load_button.setVisible(True)
+
+        # Each load has its own cancel event, which also identifies its results when they arrive
+        self.load_cancel = threading.Event()
+        threading.Thread(target=self.load_file, args=(audio_file, self.load_cancel, pagefile_rate),
+                         daemon=True).start()
+
+    def load_file(self, audio_file, cancel_event, pagefile_rate=None):
+        """Decodes an audio file, reporting progress and the result through signals (runs in a background thread)"""
+        def report_progress(fraction):
+            self.load_progress.emit(cancel_event, fraction)
+
+        try:
+            if pagefile_rate is None and os.path.splitext(audio_file)[1].lower() == '.sys':
+                # The sample rate is not stored in a pagefile.sys file, so guess it from the audio
+                with kerokero_audio.PagefileSys(audio_file) as pagefile:
+                    frame_rate, reason = kerokero_analysis.guess_pagefile_rate(pagefile.samples.reshape(-1, 1))
+                self.pagefile_rate_guessed.emit(cancel_event, frame_rate, reason)
+                return
+            if pagefile_rate is not None:
+                # pagefile.sys files are raw 16-bit mono samples, so they are memory-mapped instead of decoded
+                with kerokero_audio.PagefileSys(audio_file, pagefile_rate) as pagefile:
+                    audio = pagefile.to_audio_data()
+            elif not kerokero_audio.is_cacheable(audio_file):
+                audio = kerokero_audio.load_audio(audio_file, report_progress, cancel_event)
+            else:
+                # Files decoded before are memory-mapped from the cache. Others are decoded progressively, so playback
+                # and marking can start as soon as the first second has been decoded while the rest decodes behind
+                # the playhead
+                audio = kerokero_audio.load_cached_audio(audio_file)
+                if audio is None:
+                    decoder = kerokero_audio.ProgressiveDecoder(audio_file, report_progress, cancel_event)
+                    decoder.start()
+                    if decoder.wait_for(decoder.frame_rate):
+                        self.load_playable.emit(cancel_event, decoder)
+                    audio = decoder.result()
+                    kerokero_audio.store_cached_audio(audio_file, audio)
+            self.load_finished.emit(cancel_event, audio)
+        except kerokero_audio.DecodeCancelled:
+            logging.info(f"Loading was cancelled: {audio_file}")
+        except Exception as e:
+            self.load_failed.emit(cancel_event, str(e))
+
+    def show_load_progress(self, cancel_event, fraction):
+        """Updates the loading progress bar, ignoring progress from loads that have been replaced"""
+        if cancel_event is self.load_cancel:
+            self.load_progress_bar.setValue(int(fraction * 100))
+
+    def cancel_load(self):
+        """Cancels the file that is currently loading, if any"""
+        if self.load_cancel is not None:
+            self.load_cancel.set()
+            self.load_cancel = None
+            self.file_label.setText('No file selected')
+            self.file_info_text_edit.clear()
+
+            # Stop playing a file that was cancelled part way through decoding
+            if self.decoder is not None:
+                self.stop_audio()
+                self.play_button.setEnabled(False)
+                self.decoder = None
+        self.load_progress_bar.setVisible(False)
+        self.cancel_load_button.setVisible(False)
+
+    def file_load_failed(self, cancel_event, message):
+        """Reports a file that could not be decoded"""
+        if cancel_event is not self.load_cancel:
+            return
+        self.cancel_load()
+        logging.error(f"Error loading file: {message}")
+        QMessageBox.critical(self, "Error Loading File", message)
+
+    def open_pagefile(self, cancel_event, frame_rate, reason):
+        """Asks whether to edit a pagefile.sys file or convert it to 22050 Hz, once its sample rate has been guessed,
+        unless another file has been selected since
         """
-        logging.debug("Entering convert_sys_file method")
+        if cancel_event is not self.load_cancel:
+            return
+        self.cancel_load()
+        logging.info(f"Detected pagefile.sys sample rate: {frame_rate} Hz ({reason})")
+
         try:
-            # Specify the parameters for the RAW audio file
-            sample_rate = 21560  # Original sample rate
-            channels = 1  # Mono
-            sample_width = 2  # 16-bit
+            # Ask the user whether to edit the .sys file, or convert it to 22050 Hz
+            message_box = QMessageBox(QMessageBox.Question, 'Open .SYS File',
+                                      "You have selected an existing pagefile.sys file.\n"
+                                      f"It looks like a {frame_rate} Hz file: {reason}.\n\n"
+                                      "You can edit it like any other audio file, or\n"
+                                      "resample it to 22050 Hz to fix the playback speed\n"
+                                      "if you have applied the BGM Sample Rate fix.\n",
+                                      QMessageBox.Cancel, self)
+            edit_buttons = {}
+            for rate in kerokero_audio.TARGET_SAMPLE_RATES:
+                edit_buttons[message_box.addButton(f'Edit as {rate} Hz', QMessageBox.AcceptRole)] = rate
+            convert_button = message_box.addButton('Resample to 22050 Hz', QMessageBox.ActionRole)
+            message_box.setDefaultButton(next(button for button, rate in edit_buttons.items() if rate == frame_rate))
+            message_box.exec_()
+
+            clicked = message_box.clickedButton()
+            if clicked in edit_buttons:
+                # Load the .sys file for editing at the chosen sample rate
+                self.file_label.setText(self.audio_filename_only)
+                self.start_loading(self.audio_file, edit_buttons[clicked])
+            elif clicked is convert_button:
+                # Proceed to convert the .sys file
+                self.convert_sys_file()
+            # Otherwise the user cancelled or closed the dialog, so the operation is cancelled
+        except Exception as e:
+            logging.error(f"Error selecting file: {e}")
+            QMessageBox.critical(self, "Error Selecting File", str(e))
 
-            # Load the RAW audio file
-            audio = AudioSegment.from_raw(self.audio_file,
-                                          sample_width=sample_width,
-                                          frame_rate=sample_rate,
-                                          channels=channels)
+    @kerokero_trace.traced()
+    def file_loaded(self, cancel_event, audio):
+        """Displays information about a decoded file and enables the controls, unless another file has been selected
+        since it started loading
+        """
+        if cancel_event is not self.load_cancel:
+            return
+        self.load_cancel = None
+        self.load_progress_bar.setVisible(False)
+        self.cancel_load_button.setVisible(False)
+
+        try:
+            self.audio = audio
+            # Rendered clips are cached, so saving the same clip again, or with a different gain, is quick
+            self.renders = kerokero_audio.RenderCache(audio)
+
+            # Compute the waveform peaks in a background thread, so the window stays responsive
+            threading.Thread(target=self.build_waveform, args=(self.audio,), daemon=True).start()
+
+            # The spectrogram computes its tiles on its own thread pool as they are shown
+            self.spectrogram.set_tiles(kerokero_analysis.SpectrogramTiles(audio.samples, audio.frame_rate))
+            self.update_waveform_markers()
+
+            # Clear the loop suggestions and stereo analysis from the previous file
+            self.beat_grid = None
+            self.suggestions = None
+            self.stereo = None
+            self.loop_suggestions.clear()
+            self.loop_suggestions.setEnabled(False)
+
+            # Show the exact length now that the whole file has been decoded
+            self.show_file_info(self.audio)
+
+            # Set up playback, unless the file was already playable while it was decoding
+            if self.decoder is None:
+                self.prepare_playback()
+            self.decoder = None
+
+            # Enable the buttons that need the whole file. Previews stay disabled until playback is stopped
+            self.find_loop_button.setEnabled(True)
+            self.suggest_loops_button.setEnabled(True)
+            self.process_button.setEnabled(True)
+            self.export_button.setEnabled(True)
+            if not self.playing:
+                self.preview_button.setEnabled(True)
+                self.preview_loop_button.setEnabled(True)
+
+        except Exception as e:
+            logging.error(f"Error loading file: {e}")
+            QMessageBox.critical(self, "Error Loading File", str(e))
+
+    def file_playable(self, cancel_event, decoder):
+        """Enables playback and marking while the rest of a compressed file is still decoding"""
+        if cancel_event is not self.load_cancel:
+            return
+        try:
+            self.decoder = decoder
+            self.show_file_info(decoder)
+            self.waveform.set_length(decoder.expected_frames, decoder.frame_rate)
+            self.prepare_playback()
+            logging.info(f"File is playable while decoding: {decoder.audio_file}")
+        except Exception as e:
+            logging.error(f"Error loading file: {e}")
+            QMessageBox.critical(self, "Error Loading File", str(e))
+
+    def show_file_info(self, source):
+        """Displays the format of a loaded file (an AudioData, or a ProgressiveDecoder while it is decoding)"""
+        # Get the duration in mm:ss format
+        minutes, seconds = divmod(source.duration_ms // 1000, 60)
+        duration_formatted = f"{minutes}:{seconds:02d}"
+
+        # Get the number of channels, display Stereo or Mono accordingly
+        if source.channels > 1:
+            channels_text = "Stereo"
+        else:
+            channels_text = "Mono"
+
+        # Display the file information
+        file_info_text = (
+            f"Format: {self.audio_file.split('.')[-1].upper()}, "
+            f"Length: {source.duration_ms} ms ({duration_formatted}), "
+            f"Sample Rate: {source.frame_rate}Hz, "
+            f"Channels: {channels_text}, "
+            f"Bit Depth: {source.source_sample_width * 8}-bit"
+        )
+        self.file_info_text_edit.setText(file_info_text)
+        logging.info(f"Input File Information:\n {file_info_text}")
+
+    def prepare_playback(self):
+        """Sets up the position timer and enables the Play button for a newly loaded file"""
+        # Set up a timer to display the current position
+        self.timer = QTimer()
+        # noinspection PyUnresolvedReferences
+        self.timer.timeout.connect(self.update_current_position)
+        self.timer.setInterval(self.timer_interval)
+        self.current_position = 0
+        self.playing = False
+        self.play_button.setEnabled(True)
 
-            # Convert the sample rate to 22050 Hz
-            converted_audio = audio.set_frame_rate(22050)
+    def build_waveform(self, audio):
+        """Computes the waveform peak pyramid and stereo phase analysis of a file (runs in a background thread)"""
+        try:
+            self.pyramid_ready.emit(audio, kerokero_analysis.PeakPyramid(audio.samples))
+            if audio.channels > 1:
+                self.stereo_ready.emit(audio, kerokero_analysis.StereoAnalysis(audio.samples))
+        except Exception as e:
+            logging.error(f"An error occurred in build_waveform method: {e}")
+
+    def show_waveform(self, audio, pyramid):
+        """Displays the waveform once its peaks are ready, unless another file has been loaded since"""
+        if audio is self.audio:
+            self.waveform.set_pyramid(pyramid, audio.frame_rate)
+            self.update_waveform_markers()
+
+    def show_stereo_warning(self, audio, stereo):
+        """Keeps the stereo analysis of the loaded file, and warns if its channels cancel out when averaged"""
+        if audio is not self.audio:
+            return
+        self.stereo = stereo
+        message = stereo.warning()
+        if message:
+            logging.warning(message)
+            self.file_info_text_edit.append(message)
+
+    def get_downmix_mode(self, start_pos, end_pos):
+        """Returns the selected mono down-mix mode, logging a warning if averaging would cancel out the clip"""
+        downmix_mode = self.downmix_mode.currentData()
+        if downmix_mode == "mix" and self.stereo is not None:
+            message = self.stereo.warning(self.audio.ms_to_frame(start_pos), self.audio.ms_to_frame(end_pos))
+            if message:
+                logging.warning(message)
+        return downmix_mode
+
+    def update_waveform_markers(self):
+        """Moves the in and out markers of the waveform and spectrogram to the Start and End positions"""
+        try:
+            start_pos = float(self.start_pos.text())
+        except ValueError:
+            start_pos = None
+        try:
+            end_pos = float(self.end_position.text())
+        except ValueError:
+            end_pos = None
+        self.waveform.set_markers(start_pos, end_pos)
+        self.spectrogram.set_markers(start_pos, end_pos)
+
+    @kerokero_trace.traced()
+    def convert_sys_file(self):
+        """
+        Converts an audio file from 21560 Hz to 22050 Hz and allows the user to select the output file path.
+        """
+        try:
+            # Check the RAW audio file can be read before asking where to save it
+            with kerokero_audio.PagefileSys(self.audio_file, kerokero_audio.STOCK_SAMPLE_RATE) as pagefile:
+                logging.info(f"Input pagefile.sys: {pagefile.frame_count} samples, {pagefile.duration_ms} ms "
+                             f"@ {pagefile.sample_rate} Hz")
 
             # Prompt the user to select the output file path
             while True:
@@ -402,19 +904,60 @@ class AudioConverterApp(QWidget):
 
                 break  # Exit the loop if a valid new filename is provided
 
-            # Save the converted audio
-            converted_audio.export(output_file_path, format="s16le")  # Save as 16-bit little-endian
+            # Convert the sample rate from 21560 Hz to 22050 Hz and save as 16-bit little-endian
+            kerokero_audio.convert_pagefile(self.audio_file, output_file_path, kerokero_audio.STOCK_SAMPLE_RATE,
+                                            kerokero_audio.PATCHED_SAMPLE_RATE)
 
             QMessageBox.information(self, "Success", f"File converted successfully and saved to {output_file_path}")
         except Exception as e:
             QMessageBox.critical(self, "Error", f"An error occurred during the conversion: {e}")
-        logging.debug("Exiting convert_sys_file method\n")
 
+    def toggle_normalize_loudness(self, checked):
+        """Switches between the Gain Adjustment and loudness normalization"""
+        self.gain_adjust.setEnabled(not checked)
+        self.target_loudness.setEnabled(checked)
+
+    def get_loudness_target(self):
+        """Returns the target loudness in LUFS if loudness normalization is turned on, otherwise None"""
+        if not self.normalize_loudness.isChecked():
+            return None
+        return float(self.target_loudness.text())
+
+    def get_clip_gain(self, start_pos, end_pos, crossfade_length=0):
+        """Returns the gain in dB for previewing a clip: the Gain Adjustment, or the gain that normalizes the clip's
+        loudness (measured once per clip by the render cache)
+        """
+        loudness_target = self.get_loudness_target()
+        if loudness_target is None:
+            return float(self.gain_adjust.text())
+
+        loudness = self.renders.measure(start_pos, end_pos, crossfade_length=crossfade_length)
+        gain_value = round(loudness.normalization_gain(loudness_target), 2)
+        logging.info(f"Clip loudness: {loudness}, normalized to {loudness_target} LUFS with {gain_value} dB gain")
+        return gain_value
+
+    def render_preview(self, start_pos, end_pos, crossfade_length):
+        """Renders a clip as selected in 'Preview As'. Returns (samples, sample rate of the samples, rate to play them
+        at, gain in dB for the player). Pagefile previews are the exact samples that are saved, gain included
+        """
+        render_rate, play_rate = self.preview_as.currentData()
+        if render_rate is None:
+            gain_value = self.get_clip_gain(start_pos, end_pos, crossfade_length)
+            samples = self.renders.render(start_pos, end_pos, crossfade_length=crossfade_length)
+            return samples, self.audio.frame_rate, self.audio.frame_rate, gain_value
+
+        logging.info(f"Previewing the {render_rate} Hz pagefile.sys as played at {play_rate} Hz")
+        samples = self.renders.render(start_pos, end_pos, float(self.gain_adjust.text()), render_rate,
+                                      loudness_target=self.get_loudness_target(), crossfade_length=crossfade_length,
+                                      downmix_mode=self.get_downmix_mode(start_pos, end_pos))
+        return samples, render_rate, play_rate, 0.0
+
+    @pyqtSlot()
+    @kerokero_trace.traced()
     def preview_audio(self):
         """Previews the audio clip based on the start point and end point. Gain adjustment is applied if specified
-        Uses: pydub for processing audio, NumPy for samples array and sounddevice for playing the preview
+        Uses: NumPy (kerokero_audio) for the samples array and kerokero_player for playing the preview
         """
-        logging.debug("Entering preview_audio method")
         try:
             # Get the start position, end position, and calculate the clip length
             start_pos = float(self.start_pos.text())
@@ -425,23 +968,13 @@ class AudioConverterApp(QWidget):
             if clip_length > 90000 or clip_length <= 99:
                 raise ValueError("Clip length must be between 100 and 90,000 milliseconds.")
 
-            # Create the preview segment
-            self.preview_segment = self.audio[start_pos:end_pos]
-
-            # Pre-loop the preview segment 3 times to create a seamless loop
-            self.preview_segment = self.preview_segment * 3
-
-            # Apply the gain adjustment if specified
-            gain_value = float(self.gain_adjust.text())
+            # Render the clip with its loop crossfade, as it is saved. The player loops it and applies the gain
+            crossfade_length = float(self.crossfade_length.text())
+            self.preview_samples, _, play_rate, gain_value = self.render_preview(start_pos, end_pos, crossfade_length)
 
             if gain_value != 0:
-                self.preview_segment = self.preview_segment.apply_gain(gain_value)
                 logging.info(f"Gain adjustment applied: {gain_value} dB")
 
-            # Convert the pydub AudioSegment to numpy array
-            self.preview_samples = np.array(self.preview_segment.get_array_of_samples())
-            self.preview_samples = self.preview_samples.reshape((-1, self.preview_segment.channels))
-
             logging.info(f"Preview segment created: "
                          f"Start point: {start_pos} ms, "
                          f"End point: {end_pos} ms, "
@@ -455,12 +988,10 @@ class AudioConverterApp(QWidget):
             # Enable the 'Stop Preview' button
             self.stop_preview_button.setEnabled(True)
 
-            # Indicate the preview is playing
-            self.previewing = True
-
-            # Create a thread so the preview will play repeatedly until stopped
-            self.preview_thread = threading.Thread(target=self.loop_preview)
-            self.preview_thread.start()
+            # Play the preview on repeat until the 'Stop Preview' button is pressed. Pagefile previews are resampled to
+            # the sound card's rate as they play, as not every sound card can play 21560 Hz
+            self.player.play(self.preview_samples, play_rate, loop=True, gain_value=gain_value,
+                             resample=play_rate != self.audio.frame_rate)
 
         except ValueError as e:
             QMessageBox.critical(self, "Invalid input", str(e))
@@ -468,14 +999,14 @@ class AudioConverterApp(QWidget):
         except Exception as e:
             QMessageBox.critical(self, "Error", str(e))
             logging.error(f"An error occurred in preview_audio method: {e}")
-        logging.debug("Exiting preview_audio method\n")
 
+    @pyqtSlot()
+    @kerokero_trace.traced()
     def preview_loop_repeat(self):
         """Creates a section of audio of the last 5 seconds and first 5 seconds of the track to preview the transition
-        Uses: pydub for processing audio, NumPy for samples array and sounddevice for playing the preview
-        Creates a thread for previewing the loop repeatedly
+        Uses: NumPy (kerokero_audio) for the samples array and kerokero_player for playing the preview
+        The transition is played on repeat until stopped
         """
-        logging.debug("Entering preview_loop_repeat method")
         try:
             # Get the start position, end position, and calculate the clip length
             start_pos = float(self.start_pos.text())
@@ -488,33 +1019,21 @@ class AudioConverterApp(QWidget):
             if clip_length > 90000 or clip_length <= 9999:
                 raise ValueError("For this preview, clip length must be between 10,000 and 90,000 milliseconds.")
 
-            # Create the preview segment
-            self.preview_segment = self.audio[start_pos:end_pos]
-
-            # Apply the gain adjustment if specified
-            gain_value = float(self.gain_adjust.text())
+            # Create a preview that consists of the last 5 seconds of the clip followed by the first 5 seconds.
+            # The clip is rendered with its loop crossfade, so this is the same transition that is saved
+            crossfade_length = float(self.crossfade_length.text())
+            clip_samples, sample_rate, play_rate, gain_value = self.render_preview(start_pos, end_pos,
+                                                                                   crossfade_length)
+            transition_frames = 5 * sample_rate
+            self.preview_samples = np.concatenate((clip_samples[-transition_frames:],
+                                                   clip_samples[:transition_frames]))
 
             if gain_value != 0:
-                self.preview_segment = self.preview_segment.apply_gain(gain_value)
                 logging.info(f"Gain adjustment applied: {gain_value} dB")
 
-            # Pre-loop the preview segment twice to create a seamless loop
-            self.preview_segment = self.preview_segment * 2
-
-            # Create a segment that consists of the last 5 seconds of the loop and the first 5 seconds of the loop
-            loop_point = len(self.preview_segment) // 2  # Find the loop point (end of the first segment)
-            preview_start = max(0, loop_point - 5000)  # Start 5 seconds before the loop point
-            preview_end = min(len(self.preview_segment), loop_point + 5000)  # End 5 seconds after the loop point
-
-            # Create the spliced transition segment
-            self.preview_segment_splice = self.preview_segment[preview_start:preview_end]
-
-            # Convert the pydub AudioSegment to numpy array
-            self.preview_samples = np.array(self.preview_segment_splice.get_array_of_samples())
-            self.preview_samples = self.preview_samples.reshape((-1, self.preview_segment.channels))
-
-            logging.info(f"Loop point: {loop_point} ms, Preview Start: {preview_start} ms, "
-                         f"Preview End: {preview_end} ms")
+            loop_point = clip_length - crossfade_length
+            logging.info(f"Loop point: {loop_point} ms, Preview Start: {loop_point - 5000} ms, "
+                         f"Preview End: {loop_point + 5000} ms")
 
             # Disable the 'Preview Audio' and 'Play' buttons while the audio is playing
             self.preview_button.setEnabled(False)
@@ -524,12 +1043,10 @@ class AudioConverterApp(QWidget):
             # Enable the 'Stop Preview' button
             self.stop_preview_button.setEnabled(True)
 
-            # Indicate the preview is playing
-            self.previewing = True
-
-            # Create a thread so the preview will play repeatedly until stopped
-            self.preview_thread = threading.Thread(target=self.loop_preview)
-            self.preview_thread.start()
+            # Play the preview on repeat until the 'Stop Preview' button is pressed. Pagefile previews are resampled to
+            # the sound card's rate as they play, as not every sound card can play 21560 Hz
+            self.player.play(self.preview_samples, play_rate, loop=True, gain_value=gain_value,
+                             resample=play_rate != self.audio.frame_rate)
 
         except ValueError as e:
             QMessageBox.critical(self, "Invalid input", str(e))
@@ -538,38 +1055,82 @@ class AudioConverterApp(QWidget):
         except Exception as e:
             QMessageBox.critical(self, "Error", str(e))
             logging.error(f"An error occurred in preview_loop_repeat method: {e}")
-        logging.debug("Exiting preview_loop_repeat method\n")
 
-    def loop_preview(self):
-        """Plays the loop on repeat until Stop Preview is pressed"""
-        # Play the preview loop on repeat until the 'Stop Preview' button is pressed
-        while self.previewing:
-            # Play the preview segment
-            sd.play(self.preview_samples, self.preview_segment.frame_rate)
+    @pyqtSlot()
+    @kerokero_trace.traced()
+    def find_loop_point(self):
+        """Finds the End Position near the current one that loops back to the Start Position most seamlessly
+        Uses: kerokero_analysis to score candidate loop points by cross-correlation and spectral similarity
+        """
+        try:
+            # Get the start position, end position and the search window
+            start_pos = float(self.start_pos.text())
+            end_pos = float(self.end_position.text())
+            search_window = float(self.search_window.text())
+
+            if search_window <= 0:
+                raise ValueError("Loop search window must be greater than 0 milliseconds.")
+
+            candidate = kerokero_analysis.find_loop_point(self.audio, start_pos, end_pos, search_window)
+
+            logging.info(f"Best loop point found: Start position: {candidate.start_pos:.3f} ms, "
+                         f"End position: {candidate.end_pos:.3f} ms, Score: {candidate.score:.4f} "
+                         f"(correlation {candidate.correlation:.4f}, "
+                         f"spectral similarity {candidate.spectral_similarity:.4f})")
+
+            # Update the Start and End positions with the loop points found
+            self.start_pos.setText(f"{candidate.start_pos:.3f}")
+            self.end_position.setText(f"{candidate.end_pos:.3f}")
 
-            # Wait a bit before checking if we should continue playing
-            time.sleep(0.2)  # Sleep to prevent busy-waiting
+        except ValueError as e:
+            QMessageBox.critical(self, "Invalid input", str(e))
+            logging.error(f"Invalid input: {e}")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", str(e))
+            logging.error(f"An error occurred in find_loop_point method: {e}")
 
-            # Enter a loop until stop preview button is pressed
-            while sd.get_stream().active:
-                time.sleep(0.2)  # Continue to sleep to prevent busy-waiting
-                if not self.previewing:
-                    # If preview stop button was clicked, break from the loop
-                    break
+    @pyqtSlot()
+    @kerokero_trace.traced()
+    def suggest_loops(self):
+        """Fills the loop suggestions list with bar-aligned loops that fit within 90 seconds
+        Uses: kerokero_analysis to detect the tempo and bars, which are computed once per file and cached on disk
+        """
+        try:
+            if self.beat_grid is None:
+                self.beat_grid = kerokero_analysis.load_beat_grid(self.audio, self.audio_file)
+                logging.info(f"Tempo: {self.beat_grid.tempo:.1f} BPM, {len(self.beat_grid.bar_times)} bars")
+
+            self.suggestions = self.beat_grid.suggest_loops()
+            if not self.suggestions:
+                raise ValueError("No bar-aligned loops were found. The track may be too short.")
+
+            self.loop_suggestions.clear()
+            for suggestion in self.suggestions:
+                self.loop_suggestions.addItem(f"{suggestion.start_pos / 1000:.2f} s - "
+                                              f"{suggestion.end_pos / 1000:.2f} s "
+                                              f"({suggestion.bars} bars @ {self.beat_grid.tempo:.1f} BPM)")
+            self.loop_suggestions.setEnabled(True)
+            self.select_loop_suggestion(0)
 
-            # Stop playback
-            sd.stop()
+        except ValueError as e:
+            QMessageBox.critical(self, "Invalid input", str(e))
+            logging.error(f"Invalid input: {e}")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", str(e))
+            logging.error(f"An error occurred in suggest_loops method: {e}")
 
-            # Small delay to prevent immediate playback
-            time.sleep(0.2)
+    def select_loop_suggestion(self, index):
+        """Sets the Start and End positions to the selected loop suggestion"""
+        if self.suggestions and 0 <= index < len(self.suggestions):
+            suggestion = self.suggestions[index]
+            self.start_pos.setText(f"{suggestion.start_pos:.3f}")
+            self.end_position.setText(f"{suggestion.end_pos:.3f}")
+            logging.info(f"Loop suggestion selected: {suggestion}")
 
     def stop_preview(self):
         """Stops the currently playing preview that is playing"""
-        logging.debug("Entering stop_preview method")
         # Stop the preview playback
-        self.previewing = False
-        if sd.get_stream().active:
-            sd.stop()
+        self.player.stop()
 
         # Disable the 'Stop Preview' button
         self.stop_preview_button.setEnabled(False)
@@ -578,15 +1139,15 @@ class AudioConverterApp(QWidget):
         self.preview_button.setEnabled(True)
         self.preview_loop_button.setEnabled(True)
         self.play_button.setEnabled(True)
-        logging.debug("Exiting stop_preview method\n")
 
+    @pyqtSlot()
+    @kerokero_trace.traced()
     def process_audio(self):
         """Processes the audio clip based on the start and end point and applies gain if specified
         - SF2000+GB300 format: 16-bit signed little-endian, mono, 21560 Hz (to correct for playback speed issue)
         - WAV or MP3 format: Standard options, basic output
-        Uses: pydub to process the audio and export the audio segment
+        Uses: kerokero_audio to render (and cache) and write the clip, and pydub (ffmpeg) to encode .MP3 files
         """
-        logging.debug("Entering process_audio method")
         try:
             # Get the start position and length from the input fields
             start_pos = float(self.start_pos.text())
@@ -595,23 +1156,18 @@ class AudioConverterApp(QWidget):
 
             logging.info(f"Start Position: {start_pos} ms, End Position: {end_pos}, Clip Length: {clip_length} ms")
 
-            # Validate the start and end positions
-            if end_pos <= start_pos:
-                raise ValueError("End position must be greater than start position.")
+            # Validate the start and end positions and make sure the clip length is between 100 and 90,000 ms
+            kerokero_audio.validate_clip_range(start_pos, end_pos)
 
-            # Make sure the clip length is over 100 milliseconds
-            if clip_length > 90000 or clip_length <= 99:
-                raise ValueError("Clip length must be between 100 and 90,000 milliseconds.")
+            # Get the gain adjustment, or the loudness to normalize the clip to, applied when the clip is rendered
+            loudness_target = self.get_loudness_target()
+            gain_value = float(self.gain_adjust.text()) if loudness_target is None else 0.0
 
-            # Get the selected segment of the audio
-            self.clip_segment = self.audio[start_pos:end_pos]
+            # Get the length of the loop crossfade folded from the end of the clip into its start
+            crossfade_length = float(self.crossfade_length.text())
 
-            # Apply the gain adjustment if specified
-            gain_value = float(self.gain_adjust.text())
-
-            if gain_value != 0:
-                self.clip_segment = self.clip_segment.apply_gain(gain_value)
-                logging.info(f"Gain adjustment applied: {gain_value} dB")
+            # Get how stereo audio is down-mixed to mono for pagefile.sys, warning if averaging would cancel it out
+            downmix_mode = self.get_downmix_mode(start_pos, end_pos)
 
             # Create save dialog, allowing user to choose SF2000+GB300 pagefile.sys or standard .WAV file output
             file_filter = "Default pagefile.sys file (*.sys);;22050hz pagefile.sys file (*.sys);" \
@@ -632,39 +1188,50 @@ class AudioConverterApp(QWidget):
                 if selected_filter == "Default pagefile.sys file (*.sys)":
                     if not output_file.endswith('.sys'):
                         output_file += '.sys'
-                    # Down-mix to mono
-                    if self.clip_segment.channels > 1:
-                        self.clip_segment = self.clip_segment.set_channels(1)
-                    # Resample the audio to 21560 Hz for proper playback speed on the SF2000 stock firmware
-                    self.clip_segment = self.clip_segment.set_frame_rate(21560)
+                    # Down-mix to mono and resample to 21560 Hz for proper playback speed on the stock firmware
+                    self.clip_samples = self.renders.render(start_pos, end_pos, gain_value,
+                                                            kerokero_audio.STOCK_SAMPLE_RATE,
+                                                            loudness_target=loudness_target,
+                                                            crossfade_length=crossfade_length,
+                                                            downmix_mode=downmix_mode)
                     # Export the audio in 16-bit signed little-endian format
-                    self.clip_segment.export(output_file, format="s16le")
+                    kerokero_audio.export_pagefile(self.clip_samples, output_file)
 
                 # Save as fixed SF2000 'pagefile.sys' format - 22050hz for patched firmware with audio fix
                 elif selected_filter == "22050hz pagefile.sys file (*.sys)":
                     if not output_file.endswith('.sys'):
                         output_file += '.sys'
-                    # Down-mix to mono
-                    if self.clip_segment.channels > 1:
-                        self.clip_segment = self.clip_segment.set_channels(1)
-                    # Resample the audio to 22050 Hz for proper playback speed on the SF2000 patched firmware
-                    self.clip_segment = self.clip_segment.set_frame_rate(22050)
+                    # Down-mix to mono and resample to 22050 Hz for proper playback speed on the patched firmware
+                    self.clip_samples = self.renders.render(start_pos, end_pos, gain_value,
+                                                            kerokero_audio.PATCHED_SAMPLE_RATE,
+                                                            loudness_target=loudness_target,
+                                                            crossfade_length=crossfade_length,
+                                                            downmix_mode=downmix_mode)
                     # Export the audio in 16-bit signed little-endian format
-                    self.clip_segment.export(output_file, format="s16le")
+                    kerokero_audio.export_pagefile(self.clip_samples, output_file)
 
                 # Save as .WAV format if specified
                 elif selected_filter == "WAV file (*.wav)":
                     if not output_file.endswith('.wav'):
                         output_file += '.wav'
-                    # Export the audio in WAV format
-                    self.clip_segment.export(output_file, format="wav")
+                    # Export the audio in WAV format, written directly without pydub or ffmpeg
+                    self.clip_samples = self.renders.render(start_pos, end_pos, gain_value,
+                                                            loudness_target=loudness_target,
+                                                            crossfade_length=crossfade_length)
+                    kerokero_audio.export_clip(self.clip_samples, self.audio.frame_rate, output_file, "wav")
 
                 # Save as .MP3 format if specified
                 elif selected_filter == "MP3 file (*.mp3)":
                     if not output_file.endswith('.mp3'):
                         output_file += '.mp3'
-                    # Export the audio in MP3 format
-                    self.clip_segment.export(output_file, format="mp3")
+                    # Export the audio in MP3 format, encoded by ffmpeg through pydub
+                    self.clip_samples = self.renders.render(start_pos, end_pos, gain_value,
+                                                            loudness_target=loudness_target,
+                                                            crossfade_length=crossfade_length)
+                    kerokero_audio.export_clip(self.clip_samples, self.audio.frame_rate, output_file, "mp3")
+
+                if gain_value != 0:
+                    logging.info(f"Gain adjustment applied: {gain_value} dB")
 
                 QMessageBox.information(self, "Success", f"File successfully saved as {output_file}")
                 logging.info(f"File successfully saved as {output_file}")
@@ -685,10 +1252,50 @@ class AudioConverterApp(QWidget):
             # Handle other exceptions that are not OSErrors
             QMessageBox.critical(self, "Error", "An unexpected error occurred: {}".format(str(e)))
             logging.error("An unexpected error occurred: {}".format(e))
-        logging.debug("Exiting process_audio method\n")
+
+    @pyqtSlot()
+    @kerokero_trace.traced()
+    def export_all_formats(self):
+        """Saves the audio clip in every checked format to a folder chosen by the user
+        Uses: kerokero_audio.export_targets to render the clip once and write the formats at the same time
+        """
+        try:
+            start_pos = float(self.start_pos.text())
+            end_pos = float(self.end_position.text())
+            kerokero_audio.validate_clip_range(start_pos, end_pos)
+
+            loudness_target = self.get_loudness_target()
+            gain_value = float(self.gain_adjust.text()) if loudness_target is None else 0.0
+            crossfade_length = float(self.crossfade_length.text())
+            downmix_mode = self.get_downmix_mode(start_pos, end_pos)
+
+            targets = [target for target, checkbox in self.export_formats.items() if checkbox.isChecked()]
+            if not targets:
+                raise ValueError("Please tick at least one format to save.")
+
+            output_dir = QFileDialog.getExistingDirectory(self, "Select the folder to save the audio clips to")
+            if not output_dir:
+                logging.info("Save operation was cancelled")
+                return
+
+            logging.info(f"Saving {', '.join(targets)} to {output_dir}")
+            outputs = kerokero_audio.export_targets(self.renders, self.audio_file, output_dir, targets, start_pos,
+                                                    end_pos, gain_value, loudness_target=loudness_target,
+                                                    crossfade_length=crossfade_length, downmix_mode=downmix_mode)
+
+            QMessageBox.information(self, "Success", "Files successfully saved:\n" + "\n".join(outputs.values()))
+            logging.info(f"Files successfully saved: {', '.join(outputs.values())}")
+
+        except ValueError as e:
+            QMessageBox.critical(self, "Invalid input", str(e))
+            logging.error(f"Invalid input: {e}")
+        except Exception as e:
+            QMessageBox.critical(self, "Error", "An unexpected error occurred: {}".format(str(e)))
+            logging.error("An unexpected error occurred: {}".format(e))
 
     def update_clip_length(self):
         """Updates the Clip Length label on the UI"""
+        self.update_waveform_markers()
         try:
             start_pos_text = self.start_pos.text()
             end_pos_text = self.end_position.text()
@@ -717,6 +1324,10 @@ class AudioConverterApp(QWidget):
     def mark_in(self):
         """Marks the 'Start Position' when the audio is being previewed"""
         try:
+            # Read the exact position from the audio stream clock rather than the last timer update
+            if self.playing:
+                self.current_position = self.player.playhead_ms()
+
             if self.current_position:
                 self.start_pos.setText(str(self.current_position))
                 logging.info(f"In point marked: {(str(self.current_position))} ms")
@@ -727,43 +1338,47 @@ class AudioConverterApp(QWidget):
     def mark_out(self):
         """Marks the 'End Position' when the audio is being previewed"""
         try:
+            # Read the exact position from the audio stream clock rather than the last timer update
+            if self.playing:
+                self.current_position = self.player.playhead_ms()
+
             self.end_position.setText(str(self.current_position))
             logging.info(f"Out point marked: {(str(self.current_position))} ms")
         except Exception as e:
             QMessageBox.critical(self, "Error Marking Out Point", str(e))
             logging.error(f"An error occurred in the mark_out method: {e}")
 
+    @pyqtSlot()
+    @kerokero_trace.traced()
     def play_audio(self):
         """Plays the loaded audio file to preview the audio and set the Start and End points
-        Uses: pydub for processing audio and applying gain, NumPy for array, and sounddevice for playback
+        Uses: kerokero_player to stream the samples array to the sound card, applying gain as it plays
         """
-        logging.debug("Entering play_audio method")
         if not self.playing:
             try:
-                # Create a play segment from the loaded pydub audio segment
-                self.play_segment = self.audio
-
-                # Apply the gain adjustment if specified
-                gain_value = float(self.gain_adjust.text())
+                # Play the loaded audio buffer directly, the player applies the gain adjustment as it plays.
+                # Loudness normalization needs a clip to measure, so the whole file is played without it
+                gain_value = 0.0 if self.normalize_loudness.isChecked() else float(self.gain_adjust.text())
+                if self.audio is not None:
+                    self.play_samples = self.audio.samples
+                    frame_rate = self.audio.frame_rate
+                else:
+                    # The file is still decoding, so play from the decoder as the frames arrive
+                    self.play_samples = self.decoder
+                    frame_rate = self.decoder.frame_rate
 
                 if gain_value != 0:
-                    self.play_segment = self.play_segment.apply_gain(gain_value)
                     logging.info(f"Gain adjustment applied: {gain_value} dB")
 
-                # Convert the pydub AudioSegment to numpy array
-                self.play_samples = np.array(self.play_segment.get_array_of_samples())
-                self.play_samples = self.play_samples.reshape((-1, self.play_segment.channels))
-
                 # Reset position and start playing audio
                 self.current_position = 0
                 self.playing = True
                 self.timer.start()
 
-                logging.info(f"Playing audio: {len(self.play_samples)} samples @ "
-                             f"{str(self.play_segment.frame_rate)} Hz")
+                logging.info(f"Playing audio @ {frame_rate} Hz")
 
-                # Play the preview segment using sounddevice
-                sd.play(self.play_samples, self.play_segment.frame_rate)
+                # Play the audio using the sounddevice output stream
+                self.player.play(self.play_samples, frame_rate, gain_value=gain_value)
 
                 # Disable the 'Preview Audio' and 'Play' buttons while the audio is playing
                 self.preview_button.setEnabled(False)
@@ -781,15 +1396,28 @@ class AudioConverterApp(QWidget):
             except Exception as e:
                 QMessageBox.critical(self, "Error Playing Audio", str(e))
                 logging.error(f"An error occurred in the play_audio method: {e}")
-            logging.debug("Exiting play_audio method\n")
 
-    def stop_audio(self):
-        logging.debug("Entering stop_audio method")
+    def seek_audio(self, position):
+        """Moves playback to a position in milliseconds, when the waveform is clicked while playing
+        While the file is still decoding, a position past the decoded part moves to the last decoded frame instead
+        """
+        try:
+            if self.playing and self.audio is not None:
+                self.player.seek(self.audio.ms_to_frame(position))
+                logging.debug(f"Seek to {int(position)} ms")
+            elif self.playing and self.decoder is not None:
+                self.player.seek(int(round(position * self.decoder.frame_rate / 1000)))
+                logging.debug(f"Seek to {int(position)} ms while decoding")
+        except Exception as e:
+            QMessageBox.critical(self, "Error Seeking", str(e))
+            logging.error(f"An error occurred in the seek_audio method: {e}")
 
+    def stop_audio(self):
         try:
-            # Re-enable the 'Preview Audio' and 'Play' buttons when the audio stops
-            self.preview_button.setEnabled(True)
-            self.preview_loop_button.setEnabled(True)
+            # Re-enable the 'Preview Audio' and 'Play' buttons when the audio stops. Previews need the whole file,
+            # so they stay disabled if it is still decoding
+            self.preview_button.setEnabled(self.audio is not None)
+            self.preview_loop_button.setEnabled(self.audio is not None)
             self.play_button.setEnabled(True)
 
             # Disable the 'Mark In', 'Mark Out', and 'Stop' buttons
@@ -799,44 +1427,46 @@ class AudioConverterApp(QWidget):
 
             # Stop the audio playback and timer
             self.playing = False
-            sd.stop()
+            self.player.stop()
             self.timer.stop()
+            self.waveform.set_playhead(None)
 
             logging.info("Audio and timer stopped.")
 
         except Exception as e:
             QMessageBox.critical(self, "Error Stopping Audio", str(e))
             logging.error(f"An error occurred in the stop_audio method: {e}")
-        logging.debug("Exiting stop_audio method\n")
 
     def update_current_position(self):
-        """Updates the current position label based on the timer started when playback was started
+        """Updates the current position label from the audio stream clock, polled by the timer during playback
         Will also stop the audio playback once the end of the file is reached
         """
         # Update label to display the current position
         try:
             if self.playing:
-                # Increment the current position in sync with timer
-                self.current_position += self.timer_interval
+                # Read the position of the frame currently being heard from the audio player
+                self.current_position = self.player.playhead_ms()
 
                 minutes, seconds = divmod(self.current_position / 1000, 60)
                 position_formatted = f"{int(minutes)}:{int(seconds):02d}"
 
                 self.current_position_label.setText(
                     f'Current Position: {self.current_position} ms ({position_formatted})')
+                self.waveform.set_playhead(self.current_position)
 
                 # Stop playback once the end of the audio is reached
-                if self.current_position >= len(self.audio):
+                if not self.player.active:
                     logging.info("End of audio reached, stopping playback")
 
                     # Stop the audio playback and timer
                     self.playing = False
-                    self.play_obj.stop()
+                    self.player.stop()
                     self.timer.stop()
+                    self.waveform.set_playhead(None)
 
                     # Re-enable the 'Preview Audio' and 'Play' buttons when the audio stops
-                    self.preview_button.setEnabled(True)
-                    self.preview_loop_button.setEnabled(True)
+                    self.preview_button.setEnabled(self.audio is not None)
+                    self.preview_loop_button.setEnabled(self.audio is not None)
                     self.play_button.setEnabled(True)
 
                     # Disable the 'Mark In', 'Mark Out', and 'Stop' buttons
@@ -865,6 +1495,40 @@ def get_system_info():
     return info
 
 
+def log_system_info():
+    """Logs the startup banner with the system information"""
+    system_info = get_system_info()
+    startup_message = f"\n{'=' * 94}\n" \
+                      f"KEROKERO v{script_version} STARTED\n" \
+                      f"Time: {system_info['time']}\n" \
+                      f"OS: {system_info['operating_system']}\n" \
+                      f"Python Version: {system_info['python_version']}\n" \
+                      f"Processor: {system_info['processor']}\n" \
+                      f"Default Language: {system_info['default_language']}\n" \
+                      f"Time Zone: {system_info['time_zone']}\n" \
+                      f"Encoding: {system_info['encoding']}\n"
+    logger.info(startup_message)
+
+
+def finish_startup():
+    """Runs once the window is showing: logs the system information, which is slow to gather on some systems, and
+    imports the audio modules in the background so they are ready by the time a file is selected
+    """
+    mark_startup("Show window")
+    if profile_startup:
+        print_startup_profile()
+    log_system_info()
+    threading.Thread(target=preload_modules, daemon=True).start()
+
+
+def preload_modules():
+    """Imports the audio modules ahead of their first use (runs in a background thread)"""
+    preload_start = time.perf_counter()
+    for module_name in ("kerokero_audio", "kerokero_analysis"):
+        importlib.import_module(module_name)
+    logging.debug(f"Audio modules imported in {(time.perf_counter() - preload_start) * 1000:.0f} ms")
+
+
 # CONFIGURE LOGGING LEVEL
 
 # Logging level can be set to INFO, DEBUG, ERROR, or NONE to disable logging
@@ -881,36 +1545,43 @@ if log_level == "NONE":
 else:
     logger.setLevel(getattr(logging, log_level))
 
+# Log records are passed through a queue and written to the console and file by a background thread, so logging never
+# blocks the GUI thread on disk or console output
+log_handlers = []
+
 # Create a console handler and set the log level
 if 'console' in log_destinations and log_level != "NONE":
     console_handler = logging.StreamHandler()
     console_handler.setLevel(getattr(logging, log_level))
     console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    logger.addHandler(console_handler)
+    log_handlers.append(console_handler)
 
 # Create a file handler and set the log level
 if 'file' in log_destinations and log_level != "NONE":
     file_handler = logging.FileHandler('output.log', mode='a')
     file_handler.setLevel(getattr(logging, log_level))
     file_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
-    logger.addHandler(file_handler)
-
-system_info = get_system_info()
-startup_message = "\n==============================================================================================\n" \
-                  f"KEROKERO v{script_version} STARTED\n" \
-                  f"Time: {system_info['time']}\n" \
-                  f"OS: {system_info['operating_system']}\n" \
-                  f"Python Version: {system_info['python_version']}\n" \
-                  f"Processor: {system_info['processor']}\n" \
-                  f"Default Language: {system_info['default_language']}\n" \
-                  f"Time Zone: {system_info['time_zone']}\n" \
-                  f"Encoding: {system_info['encoding']}\n"
-logger.info(startup_message)
+    log_handlers.append(file_handler)
+
+if log_handlers:
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+    log_listener.start()
+    # Write out any queued records before the program exits
+    atexit.register(log_listener.stop)
+
+# Time the audio pipeline with kerokero_trace spans when they are being logged, or a trace is being saved
+if trace_file or logger.isEnabledFor(logging.DEBUG):
+    kerokero_trace.enable(record=trace_file is not None)
+if trace_file:
+    atexit.register(kerokero_trace.save_chrome_trace, trace_file)
 
 logging.debug("Script initialized - setting up application")
 
 # Set up application
 app = QApplication(sys.argv)
+mark_startup("Create QApplication")
 
 # Define the path for both icon files
 ico_icon_path = os.path.join(os.path.dirname(__file__), 'kerokero.ico')
@@ -925,6 +1596,10 @@ elif os.path.exists(svg_icon_path):
 
 # Run the AudioConvertApp class to start the application
 ex = AudioConverterApp()
+mark_startup("Create window")
+
+# Finish starting up once the event loop has shown the window
+QTimer.singleShot(0, finish_startup)
 
 # Exit the application
 sys.exit(app.exec_())
@@ -0,0 +1,758 @@
+# Kerokero audio analysis - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# NumPy-only analysis used to help find clean loops. This module must not import PyQt5.
+
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+
+import numpy as np
+
+import kerokero_audio
+import kerokero_cache
+import kerokero_trace
+
+# Length of audio after the 'in' point that candidate 'out' points are compared against, in ms
+LOOP_MATCH_LENGTH = 250
+# Number of best-correlated candidates that are re-scored by spectral similarity
+LOOP_CANDIDATES = 16
+# FFT size used for the spectral similarity score
+LOOP_SPECTRUM_SIZE = 2048
+# Weight of the spectral similarity in the combined loop score (the rest is the cross-correlation)
+LOOP_SPECTRAL_WEIGHT = 0.3
+# How far a loop point may move to reach a zero crossing, in ms
+ZERO_CROSSING_RADIUS = 5
+
+# Beat analysis: the track is reduced to mono at about this sample rate before the onset envelope is computed
+ONSET_SAMPLE_RATE = 11025
+ONSET_FRAME_SIZE = 1024
+ONSET_HOP_SIZE = 256
+ONSET_BANDS = 24  # Log-spaced frequency bands used to compare bars
+ONSET_BATCH_SIZE = 2048  # Frames per batched FFT, to bound memory on long tracks
+MIN_TEMPO = 60
+MAX_TEMPO = 200
+BEATS_PER_BAR = 4
+BARS_PER_PHRASE = 4  # Suggested loops are a whole number of phrases long
+LOOP_SUGGESTIONS = 10
+# Increase when the beat analysis changes, so cached results from older versions are not used
+BEAT_ANALYSIS_VERSION = 1
+
+# Pagefile sample rate detection. A 'pagefile.sys' file has no header, but music played at the wrong rate is about
+# 39 cents away from concert pitch (A = 440 Hz), so the rate that puts the spectral peaks closest in tune is chosen
+TUNING_FFT_SIZE = 16384
+TUNING_WINDOWS = 32  # FFT windows spread evenly through the file
+TUNING_PEAKS = 16  # Strongest spectral peaks used from each window
+TUNING_PEAK_RANGE = 30  # dB. Peaks further below the strongest peak of a window are window sidelobes or noise
+TUNING_RANGE = (200, 4000)  # Hz. Lower notes are too close together to resolve, higher partials drift from the grid
+MIN_TUNING_STRENGTH = 0.3  # Agreement of the peaks (0 to 1) below which the tuning is not used, ex. for drums
+
+# Stereo phase analysis: correlation between the channels for every block of the track, used to warn about tracks
+# that lose level when the channels are averaged to mono
+STEREO_BLOCK_SIZE = 4096
+CANCELLATION_THRESHOLD = 6.0  # dB lost by averaging a block for it to count as cancelling (correlation below -0.5)
+CANCELLATION_WARNING = 0.1  # Fraction of the (non-silent) blocks that must cancel before a warning is given
+SILENT_BLOCK_LEVEL = -60.0  # dBFS below which a block is ignored
+
+# Spectrogram: the STFT is computed in tiles of columns on a thread pool and the most recently used tiles are cached.
+# Columns are FFT size / SPECTROGRAM_OVERLAP frames apart, and levels are shown from -SPECTROGRAM_RANGE dBFS to 0 dBFS
+SPECTROGRAM_TILE_COLUMNS = 256
+SPECTROGRAM_CACHE_TILES = 128
+SPECTROGRAM_WORKERS = min(4, os.cpu_count() or 1)
+SPECTROGRAM_OVERLAP = 4
+SPECTROGRAM_RANGE = 90.0
+SPECTROGRAM_MAX_FREQUENCY = 11025  # Hz. Nothing above this survives in a pagefile.sys file
+
+# Waveform overview: bucket sizes (in frames) of each level of the min/max peak pyramid, finest first
+PEAK_BUCKET_SIZES = (256, 4096, 65536)
+PROCESS_CHUNK_FRAMES = 1 << 20
+
+
+class LoopCandidate:
+    """A scored pair of loop points, in frames and milliseconds"""
+
+    def __init__(self, start_frame, end_frame, frame_rate, correlation, spectral_similarity):
+        self.start_frame = start_frame
+        self.end_frame = end_frame
+        self.start_pos = start_frame * 1000 / frame_rate
+        self.end_pos = end_frame * 1000 / frame_rate
+        self.correlation = correlation
+        self.spectral_similarity = spectral_similarity
+        self.score = (1 - LOOP_SPECTRAL_WEIGHT) * correlation + LOOP_SPECTRAL_WEIGHT * spectral_similarity
+
+    def __repr__(self):
+        return (f"LoopCandidate(start_pos={self.start_pos:.3f}, end_pos={self.end_pos:.3f}, "
+                f"score={self.score:.4f})")
+
+
+def to_mono_float(samples):
+    """Returns a float32 mono copy of an int16 (frames, channels) array, scaled to -1.0 .. 1.0"""
+    return samples.mean(axis=1, dtype=np.float32) / np.float32(32768)
+
+
+def next_pow2(value):
+    """Returns the smallest power of two that is greater than or equal to value"""
+    return 1 << int(np.ceil(np.log2(max(value, 1))))
+
+
+def sliding_correlation(reference, signal):
+    """Normalized cross-correlation of reference against every position of signal, computed with the FFT
+    Returns an array of len(signal) - len(reference) + 1 values between -1.0 and 1.0
+    """
+    length = len(reference)
+    count = len(signal) - length + 1
+    fft_size = next_pow2(len(signal) + length)
+
+    # Correlation numerator for every lag at once: IFFT(FFT(signal) * conj(FFT(reference)))
+    spectrum = np.fft.rfft(signal, fft_size) * np.conj(np.fft.rfft(reference, fft_size))
+    numerator = np.fft.irfft(spectrum, fft_size)[:count]
+
+    # Energy of each window of the signal, from a cumulative sum of squares
+    energy = np.concatenate(([0.0], np.cumsum(signal.astype(np.float64) ** 2)))
+    window_energy = np.maximum(energy[length:length + count] - energy[:count], 0)
+    denominator = np.sqrt(window_energy * np.dot(reference, reference))
+
+    return np.where(denominator > 0, numerator / np.maximum(denominator, 1e-12), 0.0)
+
+
+def top_peaks(values, count):
+    """Returns the indexes of the largest local maxima of values, best first"""
+    peaks = np.flatnonzero((values[1:-1] >= values[:-2]) & (values[1:-1] >= values[2:])) + 1
+    if len(peaks) == 0:
+        peaks = np.arange(len(values))
+    return peaks[np.argsort(values[peaks])[::-1][:count]]
+
+
+def log_spectrum(frames):
+    """Returns the Hann-windowed log-magnitude spectrum of each row of frames"""
+    window = np.hanning(frames.shape[-1]).astype(np.float32)
+    return np.log1p(np.abs(np.fft.rfft(frames * window, axis=-1)))
+
+
+def spectral_similarity(reference, candidates):
+    """Cosine similarity between the log spectrum of reference and the log spectrum of each candidate row"""
+    reference_spectrum = log_spectrum(reference)
+    candidate_spectra = log_spectrum(candidates)
+    norms = np.linalg.norm(candidate_spectra, axis=1) * np.linalg.norm(reference_spectrum)
+    return np.where(norms > 0, candidate_spectra @ reference_spectrum / np.maximum(norms, 1e-12), 0.0)
+
+
+def snap_to_zero_crossing(signal, frame, radius, rising=None):
+    """Moves frame to the nearest zero crossing within radius frames, optionally only rising or falling crossings
+    Returns frame unchanged if there is no suitable crossing nearby
+    """
+    low = max(frame - radius, 1)
+    high = min(frame + radius, len(signal) - 1)
+    if high <= low:
+        return frame
+
+    # A crossing at i means the sign changes between i - 1 and i
+    before = signal[low - 1:high - 1]
+    after = signal[low:high]
+    if rising is None:
+        crossings = (before < 0) != (after < 0)
+    elif rising:
+        crossings = (before < 0) & (after >= 0)
+    else:
+        crossings = (before >= 0) & (after < 0)
+
+    indexes = np.flatnonzero(crossings) + low
+    if len(indexes) == 0:
+        return frame
+    return int(indexes[np.argmin(np.abs(indexes - frame))])
+
+
+def is_rising(signal, frame):
+    """True if the signal is rising at frame"""
+    return signal[min(frame, len(signal) - 1)] >= signal[max(frame - 1, 0)]
+
+
+@kerokero_trace.traced()
+def find_loop_point(audio, start_pos, end_pos, search_window=2000):
+    """Finds the 'out' point within search_window ms of end_pos that loops back to start_pos most seamlessly
+    Candidates are ranked by normalized cross-correlation between the audio following each candidate and the audio
+    following the 'in' point, the best are re-scored by spectral similarity, and both points are snapped to zero
+    crossings. Returns a LoopCandidate.
+    """
+    kerokero_audio.validate_clip_range(start_pos, end_pos)
+
+    frame_rate = audio.frame_rate
+    match_length = audio.ms_to_frame(LOOP_MATCH_LENGTH)
+    radius = audio.ms_to_frame(ZERO_CROSSING_RADIUS)
+
+    # Keep every candidate within the allowed clip length and inside the audio
+    start_frame = audio.ms_to_frame(start_pos)
+    first_end = max(audio.ms_to_frame(end_pos - search_window),
+                    audio.ms_to_frame(start_pos + kerokero_audio.MIN_CLIP_LENGTH))
+    last_end = min(audio.ms_to_frame(end_pos + search_window),
+                   audio.ms_to_frame(start_pos + kerokero_audio.MAX_CLIP_LENGTH),
+                   audio.frame_count - match_length)
+    if last_end <= first_end or start_frame + match_length > audio.frame_count:
+        raise ValueError("Not enough audio around the in and out points to search for a loop point.")
+
+    # Only the reference and the search region are converted to mono float, not the whole track
+    signal = to_mono_float(audio.samples[first_end:last_end + match_length + radius])
+    start_region = to_mono_float(audio.samples[max(start_frame - radius, 0):start_frame + match_length + radius])
+    start_offset = start_frame - max(start_frame - radius, 0)
+
+    # Snap the 'in' point to a zero crossing first, so the 'out' point can match its direction
+    snapped_start = snap_to_zero_crossing(start_region, start_offset, radius)
+    rising = is_rising(start_region, snapped_start)
+    reference = start_region[snapped_start:snapped_start + match_length]
+    start_frame += snapped_start - start_offset
+
+    # Score every candidate 'out' point by cross-correlation, then re-score the best few by spectral similarity
+    correlation = sliding_correlation(reference, signal)[:last_end - first_end + 1]
+    best = top_peaks(correlation, LOOP_CANDIDATES)
+
+    spectrum_size = min(LOOP_SPECTRUM_SIZE, match_length)
+    candidate_frames = np.stack([signal[offset:offset + spectrum_size] for offset in best])
+    similarity = spectral_similarity(reference[:spectrum_size], candidate_frames)
+
+    candidates = [LoopCandidate(start_frame, first_end + int(offset), frame_rate, float(correlation[offset]),
+                                float(similarity[index]))
+                  for index, offset in enumerate(best)]
+    result = max(candidates, key=lambda candidate: candidate.score)
+
+    # Snap the 'out' point to a zero crossing going in the same direction as the 'in' point
+    end_frame = first_end + snap_to_zero_crossing(signal, result.end_frame - first_end, radius, rising)
+    snapped = LoopCandidate(start_frame, end_frame, frame_rate, result.correlation, result.spectral_similarity)
+    try:
+        kerokero_audio.validate_clip_range(snapped.start_pos, snapped.end_pos)
+    except ValueError:
+        # Snapping pushed the clip just past the length limits, keep the unsnapped 'out' point
+        return LoopCandidate(start_frame, result.end_frame, frame_rate, result.correlation,
+                             result.spectral_similarity)
+    return snapped
+
+
+class LoopSuggestion:
+    """A suggested bar-aligned loop, in milliseconds"""
+
+    def __init__(self, start_pos, end_pos, bars, score):
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self.bars = bars
+        self.score = score
+
+    def __repr__(self):
+        return (f"LoopSuggestion(start_pos={self.start_pos:.3f}, end_pos={self.end_pos:.3f}, bars={self.bars}, "
+                f"score={self.score:.4f})")
+
+
+class BeatGrid:
+    """Tempo, beat and bar positions of a track, plus a spectral fingerprint of each bar for comparing bars"""
+
+    def __init__(self, tempo, beat_times, bar_times, bar_features):
+        self.tempo = tempo  # Beats per minute
+        self.beat_times = beat_times  # Seconds
+        self.bar_times = bar_times  # Seconds, start of each bar
+        self.bar_features = bar_features  # (bars, ONSET_BANDS), unit length rows
+
+    def save(self, path):
+        """Saves the beat grid to a .npz file"""
+        np.savez(path, tempo=self.tempo, beat_times=self.beat_times, bar_times=self.bar_times,
+                 bar_features=self.bar_features)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a beat grid saved with save()"""
+        with np.load(path) as data:
+            return cls(float(data["tempo"]), data["beat_times"], data["bar_times"], data["bar_features"])
+
+    def suggest_loops(self, max_length=kerokero_audio.MAX_CLIP_LENGTH, count=LOOP_SUGGESTIONS):
+        """Returns up to count bar-aligned loops no longer than max_length ms, best first
+        A loop scores well when the bar it returns to sounds like the bar after its end, and the bar before its end
+        sounds like the bar before its start
+        """
+        bar_count = len(self.bar_times) - 1
+        if bar_count < BARS_PER_PHRASE:
+            return []
+
+        similarity = self.bar_features @ self.bar_features.T
+        starts, lengths = np.meshgrid(np.arange(bar_count), np.arange(BARS_PER_PHRASE, bar_count + 1,
+                                                                      BARS_PER_PHRASE), indexing='ij')
+        ends = starts + lengths
+        durations = (self.bar_times[np.minimum(ends, bar_count)] - self.bar_times[starts]) * 1000
+        valid = (ends <= bar_count) & (durations <= max_length) & (durations >= kerokero_audio.MIN_CLIP_LENGTH)
+        if not valid.any():
+            return []
+
+        starts, ends, durations = starts[valid], ends[valid], durations[valid]
+        # The bar after the loop (or the last bar of the track) should match the first bar of the loop
+        score = similarity[starts, np.minimum(ends, bar_count - 1)]
+        # The last bar of the loop should match the bar before the start, when there is one
+        score = np.where(starts > 0, (score + similarity[np.maximum(starts - 1, 0), ends - 1]) / 2, score)
+        # Prefer longer loops slightly, so the whole 90 seconds is used when the music allows it
+        score = score + 0.05 * durations / max_length
+
+        order = np.argsort(score)[::-1][:count]
+        return [LoopSuggestion(self.bar_times[starts[i]] * 1000, self.bar_times[ends[i]] * 1000,
+                               int(ends[i] - starts[i]), float(score[i])) for i in order]
+
+
+def decimate_to_mono(samples, factor, chunk_frames=1 << 20):
+    """Reduces an int16 (frames, channels) array to float32 mono at 1/factor of the sample rate by block averaging
+    Works through the array in chunks, so the whole track is never converted to float at once
+    """
+    usable = len(samples) // factor * factor
+    output = np.empty(usable // factor, dtype=np.float32)
+    chunk_frames = chunk_frames // factor * factor
+    for start in range(0, usable, chunk_frames):
+        chunk = to_mono_float(samples[start:min(start + chunk_frames, usable)])
+        output[start // factor:(start + len(chunk)) // factor] = chunk.reshape(-1, factor).mean(axis=1)
+    return output
+
+
+def band_matrix(fft_size, sample_rate, bands):
+    """Returns an (fft bins, bands) matrix that sums FFT bins into log-spaced frequency bands"""
+    frequencies = np.fft.rfftfreq(fft_size, 1 / sample_rate)
+    edges = np.geomspace(60, sample_rate / 2, bands + 1)
+    band_index = np.clip(np.searchsorted(edges, frequencies) - 1, -1, bands - 1)
+    matrix = np.zeros((len(frequencies), bands), dtype=np.float32)
+    in_range = band_index >= 0
+    matrix[np.flatnonzero(in_range), band_index[in_range]] = 1
+    return matrix
+
+
+def onset_envelope(audio):
+    """Computes the spectral flux onset envelope and per-frame band energies of a track
+    Returns (envelope, band_energies, envelope_rate) where envelope_rate is in frames per second
+    """
+    factor = max(1, int(round(audio.frame_rate / ONSET_SAMPLE_RATE)))
+    sample_rate = audio.frame_rate / factor
+    signal = decimate_to_mono(audio.samples, factor)
+    if len(signal) < ONSET_FRAME_SIZE:
+        raise ValueError("The audio is too short to analyze.")
+
+    frames = np.lib.stride_tricks.sliding_window_view(signal, ONSET_FRAME_SIZE)[::ONSET_HOP_SIZE]
+    window = np.hanning(ONSET_FRAME_SIZE).astype(np.float32)
+    bands = band_matrix(ONSET_FRAME_SIZE, sample_rate, ONSET_BANDS)
+
+    envelope = np.zeros(len(frames), dtype=np.float32)
+    band_energies = np.empty((len(frames), ONSET_BANDS), dtype=np.float32)
+    previous = None
+
+    # Batched FFTs over zero-copy frame views: spectral flux is the summed increase in log magnitude per frame
+    for start in range(0, len(frames), ONSET_BATCH_SIZE):
+        magnitude = np.abs(np.fft.rfft(frames[start:start + ONSET_BATCH_SIZE] * window, axis=1))
+        log_magnitude = np.log1p(100 * magnitude).astype(np.float32)
+        band_energies[start:start + len(magnitude)] = log_magnitude @ bands
+
+        if previous is None:
+            previous = log_magnitude[:1]
+        difference = np.diff(np.concatenate((previous, log_magnitude)), axis=0)
+        envelope[start:start + len(magnitude)] = np.maximum(difference, 0).sum(axis=1)
+        previous = log_magnitude[-1:]
+
+    # Remove the local average so only the peaks (onsets) remain
+    envelope_rate = sample_rate / ONSET_HOP_SIZE
+    smoothing = max(1, int(envelope_rate / 2))
+    local_mean = np.convolve(envelope, np.ones(smoothing, dtype=np.float32) / smoothing, mode='same')
+    envelope = np.maximum(envelope - local_mean, 0)
+
+    return envelope, band_energies, envelope_rate
+
+
+def estimate_tempo(envelope, envelope_rate):
+    """Estimates the beat period (in envelope frames) from the autocorrelation of the onset envelope"""
+    centered = envelope - envelope.mean()
+    fft_size = next_pow2(2 * len(centered))
+    spectrum = np.fft.rfft(centered, fft_size)
+    autocorrelation = np.fft.irfft(spectrum * np.conj(spectrum), fft_size)[:len(centered)]
+
+    min_lag = max(1, int(envelope_rate * 60 / MAX_TEMPO))
+    max_lag = min(len(autocorrelation) - 2, int(np.ceil(envelope_rate * 60 / MIN_TEMPO)))
+    if max_lag <= min_lag:
+        raise ValueError("The audio is too short to estimate the tempo.")
+
+    # Weight the lags towards 120 BPM (log-normal), which favours the beat level over half or double time
+    lags = np.arange(min_lag, max_lag + 1)
+    tempos = 60 * envelope_rate / lags
+    weights = np.exp(-0.5 * np.log2(tempos / 120) ** 2)
+    best = lags[np.argmax(autocorrelation[lags] * weights)]
+
+    # Refine to a fractional lag with parabolic interpolation around the peak
+    left, middle, right = autocorrelation[best - 1:best + 2]
+    curvature = left - 2 * middle + right
+    offset = 0.5 * (left - right) / curvature if curvature < 0 else 0.0
+    return best + float(np.clip(offset, -0.5, 0.5))
+
+
+def fit_beat_grid(envelope, period):
+    """Refines the beat period and finds the beat phase, by choosing the evenly spaced grid (within 2% of period)
+    whose beats land on the most onset energy. A small period error adds up over a whole track, so the
+    autocorrelation estimate alone is not accurate enough. Returns (period, phase) in envelope frames
+    """
+    periods = period * np.linspace(0.98, 1.02, 161)
+    phases = np.arange(0, period, 0.5)
+    beat_numbers = np.arange(int(len(envelope) / periods.min()) + 1)
+
+    best_score, best = -1.0, (period, 0.0)
+    for candidate in periods:
+        indexes = np.round(phases[:, np.newaxis] + beat_numbers * candidate).astype(np.int64)
+        scores = np.where(indexes < len(envelope), envelope[np.minimum(indexes, len(envelope) - 1)], 0).sum(axis=1)
+        if scores.max() > best_score:
+            best_score, best = scores.max(), (float(candidate), float(phases[np.argmax(scores)]))
+    return best
+
+
+@kerokero_trace.traced()
+def analyze_beats(audio):
+    """Builds the beat grid of a track: tempo from the onset envelope, then the beat phase and downbeat that line up
+    with the strongest onsets
+    """
+    envelope, band_energies, envelope_rate = onset_envelope(audio)
+    period, phase = fit_beat_grid(envelope, estimate_tempo(envelope, envelope_rate))
+
+    beats = np.round(phase + np.arange(int((len(envelope) - 1 - phase) / period) + 1) * period).astype(np.int64)
+
+    # Downbeat: the first beat of the bar is assumed to be the one with the strongest onsets
+    downbeat = int(np.argmax([envelope[beats[offset::BEATS_PER_BAR]].sum()
+                              for offset in range(min(BEATS_PER_BAR, len(beats)))]))
+    bars = beats[downbeat::BEATS_PER_BAR]
+
+    # Average the band energies over each bar, using a cumulative sum for fast means
+    cumulative = np.concatenate((np.zeros((1, ONSET_BANDS), dtype=np.float64),
+                                 np.cumsum(band_energies, axis=0, dtype=np.float64)))
+    bar_features = (cumulative[bars[1:]] - cumulative[bars[:-1]]) / np.diff(bars)[:, np.newaxis]
+    bar_features -= bar_features.mean(axis=1, keepdims=True)
+    norms = np.linalg.norm(bar_features, axis=1, keepdims=True)
+    bar_features = (bar_features / np.maximum(norms, 1e-12)).astype(np.float32)
+
+    # Convert envelope frames to seconds, allowing for the frame centre
+    frame_offset = ONSET_FRAME_SIZE / 2 / (envelope_rate * ONSET_HOP_SIZE)
+    tempo = 60 * envelope_rate / period
+    return BeatGrid(tempo, beats / envelope_rate + frame_offset, bars / envelope_rate + frame_offset, bar_features)
+
+
+def load_beat_grid(audio, audio_file):
+    """Returns the beat grid of a track, from the cache if the same file has been analyzed at the same rate before
+
+    The frame rate is part of the key because a pagefile.sys can be loaded at either firmware rate, which changes
+    the tempo and every beat time.
+    """
+    cache_file = os.path.join(kerokero_cache.get_cache_dir("beats"),
+                              f"{kerokero_cache.cached_file_hash(audio_file)}-{audio.frame_rate}"
+                              f"-v{BEAT_ANALYSIS_VERSION}.npz")
+    if os.path.exists(cache_file):
+        try:
+            return BeatGrid.load(cache_file)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Could not read cached beat grid {cache_file}: {e}")
+
+    beat_grid = analyze_beats(audio)
+    try:
+        beat_grid.save(cache_file)
+    except OSError as e:
+        logging.warning(f"Could not cache beat grid {cache_file}: {e}")
+    return beat_grid
+
+
+def tuning_offset(samples, sample_rate):
+    """Returns (offset, strength): how far the spectral peaks of an int16 (frames, channels) array are from equal
+    temperament at A = 440 Hz in cents (-50 to 50), and how well the peaks agree on it, from 0 (noise) to 1
+    """
+    signal = to_mono_float(samples)
+    if len(signal) < TUNING_FFT_SIZE:
+        return 0.0, 0.0
+
+    starts = np.linspace(0, len(signal) - TUNING_FFT_SIZE, TUNING_WINDOWS).astype(np.int64)
+    spectra = log_spectrum(signal[starts[:, np.newaxis] + np.arange(TUNING_FFT_SIZE)])
+
+    # Local maxima within the range, with their neighbours for parabolic interpolation of the peak frequency.
+    # The spectrum is a natural log magnitude, so the dB range is converted to the same scale
+    low, high = (int(frequency * TUNING_FFT_SIZE / sample_rate) for frequency in TUNING_RANGE)
+    centre, left, right = spectra[:, low:high], spectra[:, low - 1:high - 1], spectra[:, low + 1:high + 1]
+    score = np.where((centre > left) & (centre >= right), centre, -np.inf)
+    top = np.argpartition(score, -TUNING_PEAKS, axis=1)[:, -TUNING_PEAKS:]
+    rows = np.arange(len(spectra))[:, np.newaxis]
+    floor = score.max(axis=1, keepdims=True) - TUNING_PEAK_RANGE * np.log(10) / 20
+    valid = np.isfinite(score[rows, top]) & (score[rows, top] >= floor)
+    centre, left, right = centre[rows, top][valid], left[rows, top][valid], right[rows, top][valid]
+    if len(centre) == 0:
+        return 0.0, 0.0
+    shift = 0.5 * (left - right) / np.minimum(left - 2 * centre + right, -1e-9)
+    frequencies = (top[valid] + low + shift) * sample_rate / TUNING_FFT_SIZE
+
+    # Cents wrap around every semitone, so average them as angles
+    cents = 1200 * np.log2(frequencies / 440)
+    mean = np.exp(2j * np.pi * cents / 100).mean()
+    return float(np.angle(mean) * 100 / (2 * np.pi)), float(abs(mean))
+
+
+def guess_pagefile_rate(samples):
+    """Guesses whether an int16 'pagefile.sys' array was made for stock (21560 Hz) or patched (22050 Hz) firmware
+    Returns (sample rate, reason). Tonal music is judged by its tuning. Otherwise a file that is only short enough
+    for a clip at 22050 Hz is taken as 22050 Hz, and anything else as stock
+    """
+    stock_rate, patched_rate = kerokero_audio.STOCK_SAMPLE_RATE, kerokero_audio.PATCHED_SAMPLE_RATE
+    with kerokero_trace.span("guess_pagefile_rate", frames=len(samples)):
+        offset, strength = tuning_offset(samples, stock_rate)
+    logging.debug(f"Pagefile tuning at {stock_rate} Hz: {offset:.1f} cents, strength {strength:.2f}")
+
+    if strength >= MIN_TUNING_STRENGTH:
+        # Reading the same samples at the higher rate raises every frequency by the same number of cents
+        patched_offset = (offset + 1200 * np.log2(patched_rate / stock_rate) + 50) % 100 - 50
+        if abs(patched_offset) < abs(offset):
+            return patched_rate, f"in tune at {patched_rate} Hz, {patched_offset:+.0f} cents from A = 440 Hz"
+        return stock_rate, f"in tune at {stock_rate} Hz, {offset:+.0f} cents from A = 440 Hz"
+
+    if stock_rate * kerokero_audio.MAX_CLIP_LENGTH / 1000 < len(samples) <= \
+            patched_rate * kerokero_audio.MAX_CLIP_LENGTH / 1000:
+        return patched_rate, f"longer than {kerokero_audio.MAX_CLIP_LENGTH // 1000} seconds at {stock_rate} Hz"
+    return stock_rate, "no clear pitch, assumed stock firmware"
+
+
+class StereoAnalysis:
+    """Correlation between the left and right channels of a track, and the level lost by averaging them to mono, for
+    every block of STEREO_BLOCK_SIZE frames. Computed once per file, so any clip can then be checked instantly
+    """
+
+    @kerokero_trace.traced("analyze_stereo")
+    def __init__(self, samples, block_size=STEREO_BLOCK_SIZE):
+        self.block_size = block_size
+        count = len(samples) // block_size
+
+        # Sums of left * left, right * right and left * right over each block. The channels are read through strided
+        # views of the decoded buffer, and only one chunk at a time is converted to float
+        self.sums = np.zeros((3, count))
+        if samples.shape[1] >= 2:
+            chunk_frames = PROCESS_CHUNK_FRAMES // block_size * block_size
+            for start in range(0, count * block_size, chunk_frames):
+                end = min(start + chunk_frames, count * block_size)
+                left = samples[start:end, 0].astype(np.float32).reshape(-1, block_size)
+                right = samples[start:end, 1].astype(np.float32).reshape(-1, block_size)
+                blocks = slice(start // block_size, end // block_size)
+                self.sums[0, blocks] = np.einsum('ij,ij->i', left, left)
+                self.sums[1, blocks] = np.einsum('ij,ij->i', right, right)
+                self.sums[2, blocks] = np.einsum('ij,ij->i', left, right)
+
+    @property
+    def correlation(self):
+        """Correlation between the channels of each block, from -1 (out of phase) to 1 (the same), 0 if silent"""
+        left, right, product = self.sums
+        norms = np.sqrt(left * right)
+        return np.where(norms > 0, product / np.maximum(norms, 1e-12), 0.0)
+
+    def _blocks(self, start_frame, end_frame):
+        """Returns the sums of the blocks that are loud enough to judge between two frames"""
+        sums = self.sums[:, start_frame // self.block_size:-(-end_frame // self.block_size)]
+        silent_energy = self.block_size * (32768 * 10 ** (SILENT_BLOCK_LEVEL / 20)) ** 2
+        return sums[:, (sums[0] + sums[1]) / 2 > silent_energy]
+
+    def cancellation(self, start_frame=0, end_frame=None):
+        """Returns the level in dB lost by averaging the channels between two frames, compared to the channels on
+        their own: 0 dB for mono, about 3 dB for unrelated channels and more for channels that are out of phase
+        """
+        left, right, product = self._blocks(start_frame, end_frame or self.block_size * self.sums.shape[1])
+        channel_energy = (left.sum() + right.sum()) / 2
+        mid_energy = (left.sum() + right.sum() + 2 * product.sum()) / 4
+        if channel_energy == 0:
+            return 0.0
+        return float(10 * np.log10(channel_energy / max(mid_energy, channel_energy * 1e-6)))
+
+    def cancelling_fraction(self, start_frame=0, end_frame=None):
+        """Returns the fraction of the blocks between two frames that lose more than CANCELLATION_THRESHOLD dB"""
+        left, right, product = self._blocks(start_frame, end_frame or self.block_size * self.sums.shape[1])
+        if len(left) == 0:
+            return 0.0
+        loss = 10 * np.log10((left + right) / 2 / np.maximum((left + right + 2 * product) / 4, 1e-12))
+        return float(np.mean(loss > CANCELLATION_THRESHOLD))
+
+    def warning(self, start_frame=0, end_frame=None):
+        """Returns a warning if averaging the channels between two frames would cancel out too much, otherwise None"""
+        fraction = self.cancelling_fraction(start_frame, end_frame)
+        if fraction < CANCELLATION_WARNING:
+            return None
+        return (f"Phase cancellation: averaging the stereo channels to mono loses more than "
+                f"{CANCELLATION_THRESHOLD:.0f} dB in {fraction:.0%} of the audio "
+                f"({self.cancellation(start_frame, end_frame):.1f} dB overall). "
+                f"Try the 'Mid', 'Left' or 'Right' mono down-mix.")
+
+
+class SpectrogramTiles:
+    """Short-time Fourier transform of a track, computed on demand in tiles of SPECTROGRAM_TILE_COLUMNS columns by a
+    thread pool and kept in an LRU cache keyed by (tile index, FFT size). Each tile is a uint8 (bins, columns) array of
+    levels, 0 for -SPECTROGRAM_RANGE dBFS or below and 255 for 0 dBFS. Column c is centred on frame c * hop
+    """
+
+    def __init__(self, samples, frame_rate, max_tiles=SPECTROGRAM_CACHE_TILES, workers=SPECTROGRAM_WORKERS):
+        self.samples = samples
+        self.frame_rate = frame_rate
+        self.max_tiles = max_tiles
+        self.tiles = collections.OrderedDict()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers,
+                                                              thread_name_prefix="spectrogram")
+
+    @staticmethod
+    def hop(fft_size):
+        """Returns the number of frames between columns"""
+        return fft_size // SPECTROGRAM_OVERLAP
+
+    def bins(self, fft_size):
+        """Returns the number of frequency bins in each column, up to SPECTROGRAM_MAX_FREQUENCY"""
+        return min(fft_size // 2 + 1, int(SPECTROGRAM_MAX_FREQUENCY * fft_size / self.frame_rate) + 1)
+
+    @kerokero_trace.traced("spectrogram_tile")
+    def compute_tile(self, index, fft_size):
+        """Computes one tile with a single batched FFT over all of its columns"""
+        hop = self.hop(fft_size)
+        first = index * SPECTROGRAM_TILE_COLUMNS * hop - fft_size // 2
+        length = (SPECTROGRAM_TILE_COLUMNS - 1) * hop + fft_size
+
+        # Read the tile's frames as mono float, zero-padded past either end of the track
+        signal = np.zeros(length, dtype=np.float32)
+        start, end = max(first, 0), min(first + length, len(self.samples))
+        if start < end:
+            signal[start - first:end - first] = to_mono_float(self.samples[start:end])
+
+        # Zero-copy view of every column's frames, then one windowed FFT per column
+        frames = np.lib.stride_tricks.sliding_window_view(signal, fft_size)[::hop]
+        window = np.hanning(fft_size).astype(np.float32)
+        magnitude = np.abs(np.fft.rfft(frames * window, axis=1)[:, :self.bins(fft_size)])
+
+        # A full-scale sine peaks at fft_size / 4 with a Hann window
+        levels = 20 * np.log10(np.maximum(magnitude * (4 / fft_size), 1e-9))
+        scaled = np.clip((levels + SPECTROGRAM_RANGE) * (255 / SPECTROGRAM_RANGE), 0, 255)
+        return np.ascontiguousarray(scaled.T.astype(np.uint8))
+
+    def tile(self, index, fft_size, ready_callback=None):
+        """Returns a cached tile, or None after starting to compute it on the thread pool. ready_callback() is called
+        from the worker thread when it is done
+        """
+        key = (index, fft_size)
+        with self.lock:
+            if key in self.tiles:
+                self.tiles.move_to_end(key)
+                return self.tiles[key]
+            if key in self.pending:
+                return None
+            self.pending.add(key)
+
+        def compute():
+            try:
+                tile = self.compute_tile(index, fft_size)
+                with self.lock:
+                    self.tiles[key] = tile
+                    while len(self.tiles) > self.max_tiles:
+                        self.tiles.popitem(last=False)
+            except Exception as e:
+                logging.error(f"An error occurred computing spectrogram tile {key}: {e}")
+            finally:
+                with self.lock:
+                    self.pending.discard(key)
+            if ready_callback is not None:
+                ready_callback()
+
+        try:
+            self.executor.submit(compute)
+        except RuntimeError:
+            # The pool has been shut down because another file was loaded
+            with self.lock:
+                self.pending.discard(key)
+        return None
+
+    def columns(self, start_frame, end_frame, fft_size, ready_callback=None):
+        """Returns the uint8 (bins, columns) spectrogram of the columns centred between two frames. Tiles that are
+        not ready yet are started on the thread pool and left at 0 until ready_callback() says they have arrived
+        """
+        hop = self.hop(fft_size)
+        first = max(-(-int(start_frame) // hop), 0)
+        last = max(int(end_frame) // hop + 1, first)
+        output = np.zeros((self.bins(fft_size), last - first), dtype=np.uint8)
+        for index in range(first // SPECTROGRAM_TILE_COLUMNS, -(-last // SPECTROGRAM_TILE_COLUMNS)):
+            tile = self.tile(index, fft_size, ready_callback)
+            if tile is None:
+                continue
+            tile_first = index * SPECTROGRAM_TILE_COLUMNS
+            start, end = max(first, tile_first), min(last, tile_first + SPECTROGRAM_TILE_COLUMNS)
+            output[:, start - first:end - first] = tile[:, start - tile_first:end - tile_first]
+        return output
+
+    def close(self):
+        """Stops the thread pool once it has finished the tiles it is computing"""
+        self.executor.shutdown(wait=False)
+
+
+class PeakPyramid:
+    """Multi-resolution min/max peaks of a track, so a waveform can be drawn at any zoom level without reading
+    the raw samples. Each level holds the minimum and maximum sample (over all channels) of every bucket
+    """
+
+    @kerokero_trace.traced("build_peak_pyramid")
+    def __init__(self, samples, bucket_sizes=PEAK_BUCKET_SIZES):
+        self.samples = samples
+        self.frame_count = len(samples)
+        self.levels = []
+
+        # Build the finest level from the samples in chunks, then each coarser level from the one below it
+        finest = bucket_sizes[0]
+        bucket_count = -(-self.frame_count // finest)
+        minimums = np.empty(bucket_count, dtype=np.int16)
+        maximums = np.empty(bucket_count, dtype=np.int16)
+        chunk_frames = PROCESS_CHUNK_FRAMES // finest * finest
+        for start in range(0, self.frame_count, chunk_frames):
+            # Reduce over the channels and the frames of each bucket together, (frames, channels) is contiguous
+            chunk = np.ascontiguousarray(samples[start:start + chunk_frames]).reshape(-1)
+            first = start // finest
+            last = first + -(-len(chunk) // (finest * samples.shape[1]))
+            minimums[first:last] = bucket_reduce(chunk, finest * samples.shape[1], np.min)
+            maximums[first:last] = bucket_reduce(chunk, finest * samples.shape[1], np.max)
+        self.levels.append((finest, minimums, maximums))
+
+        for bucket_size in bucket_sizes[1:]:
+            previous_size, minimums, maximums = self.levels[-1]
+            factor = bucket_size // previous_size
+            self.levels.append((bucket_size, bucket_reduce(minimums, factor, np.min),
+                                bucket_reduce(maximums, factor, np.max)))
+
+    def peaks(self, start_frame, end_frame, width):
+        """Returns (minimums, maximums) arrays of length width covering frames start_frame to end_frame
+        Uses the coarsest pyramid level that still has at least one bucket per pixel, or the raw samples when
+        zoomed in closer than the finest level
+        """
+        start_frame = min(max(int(start_frame), 0), self.frame_count)
+        end_frame = min(max(int(end_frame), start_frame), self.frame_count)
+        frames_per_pixel = (end_frame - start_frame) / max(width, 1)
+        if end_frame <= start_frame or width <= 0:
+            return np.zeros(max(width, 0), dtype=np.int16), np.zeros(max(width, 0), dtype=np.int16)
+
+        bucket_size, minimums, maximums = 1, None, None
+        for level_size, level_minimums, level_maximums in self.levels:
+            if level_size <= frames_per_pixel:
+                bucket_size, minimums, maximums = level_size, level_minimums, level_maximums
+
+        if minimums is None:
+            # Zoomed in past the finest level: the visible range is small, so read the samples directly
+            view = self.samples[start_frame:end_frame]
+            edges = pixel_edges(0, len(view), width)
+            return (np.minimum.reduceat(view, edges, axis=0).min(axis=1),
+                    np.maximum.reduceat(view, edges, axis=0).max(axis=1))
+
+        first_bucket = start_frame // bucket_size
+        last_bucket = -(-end_frame // bucket_size)
+        edges = pixel_edges(first_bucket, last_bucket, width) - first_bucket
+        return (np.minimum.reduceat(minimums[first_bucket:last_bucket], edges),
+                np.maximum.reduceat(maximums[first_bucket:last_bucket], edges))
+
+
+def pixel_edges(first, last, width):
+    """Returns the index of the first bucket of each of width pixels spanning buckets first to last"""
+    edges = np.linspace(first, last, width + 1)[:-1].astype(np.int64)
+    return np.minimum(edges, last - 1)
+
+
+def bucket_reduce(values, bucket_size, function):
+    """Reduces consecutive buckets of bucket_size values of a 1-D array with np.min or np.max
+    The last bucket may be partial
+    """
+    full = len(values) // bucket_size * bucket_size
+    reduced = function(values[:full].reshape(-1, bucket_size), axis=1)
+    if full < len(values):
+        reduced = np.append(reduced, function(values[full:]))
+    return reduced
@@ -0,0 +1,763 @@
+# Kerokero audio core - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Audio processing pipeline shared by the GUI (kerokero.py) and the headless command line tool (kerokero_cli.py).
+# This module must not import PyQt5, so that batch conversions can run without a display.
+
+import collections
+import concurrent.futures
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+from pydub import AudioSegment
+from pydub.utils import get_encoder_name, mediainfo_json
+
+import kerokero_cache
+import kerokero_loudness
+import kerokero_resample
+import kerokero_trace
+
+# SF2000+GB300 'pagefile.sys' format: headerless 16-bit signed little-endian mono PCM
+STOCK_SAMPLE_RATE = 21560  # Stock firmware plays BGM slightly fast, so audio is resampled to 21560 Hz
+PATCHED_SAMPLE_RATE = 22050  # Firmware with the BGM sample rate fix applied
+TARGET_SAMPLE_RATES = (STOCK_SAMPLE_RATE, PATCHED_SAMPLE_RATE)
+PAGEFILE_SAMPLE_WIDTH = 2  # 16-bit
+PAGEFILE_CHANNELS = 1  # Mono
+
+# Ways of down-mixing stereo to mono for pagefiles (see downmix), and the most gain the 'mid' mode may add back to make
+# up for phase cancellation, in dB
+DOWNMIX_MODES = ("mix", "mid", "left", "right")
+DEFAULT_DOWNMIX_MODE = "mix"
+MAX_MID_COMPENSATION = 6.0
+
+# Clip length limits in milliseconds
+MIN_CLIP_LENGTH = 100
+MAX_CLIP_LENGTH = 90000
+
+# Write buffer size for output files, and chunk size (in samples) for in-place processing of memory-mapped files
+WRITE_BUFFER_SIZE = 1024 * 1024
+PROCESS_CHUNK_SIZE = 1 << 20
+
+# Number of bytes read from the decoder between progress updates and cancellation checks
+DECODE_CHUNK_SIZE = 256 * 1024
+
+# Decoded audio cache: files that need ffmpeg are decoded once, then memory-mapped from the cache when opened again.
+# Bump the version to invalidate old entries, and the least recently used entries are deleted above the size limit
+AUDIO_CACHE_VERSION = 1
+AUDIO_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+
+# Memory used by each file's render cache. One stage of a 90 second stereo clip at 48 kHz takes about 17 MB
+RENDER_CACHE_MAX_BYTES = 128 * 1024 * 1024
+
+# Targets for export_targets: output path in the chosen folder ({name} is the source file name without its extension)
+# and sample rate. Pagefiles go in their own folders, as the console needs them to be named pagefile.sys
+EXPORT_TARGETS = {
+    "stock": (os.path.join("stock", "pagefile.sys"), STOCK_SAMPLE_RATE),
+    "patched": (os.path.join("patched", "pagefile.sys"), PATCHED_SAMPLE_RATE),
+    "wav": ("{name}.wav", None),
+    "mp3": ("{name}.mp3", None),
+}
+EXPORT_WORKERS = len(EXPORT_TARGETS)
+
+
+def validate_clip_range(start_pos, end_pos):
+    """Raises a ValueError if the in and out points do not describe a valid clip"""
+    if end_pos <= start_pos:
+        raise ValueError("End position must be greater than start position.")
+
+    clip_length = end_pos - start_pos
+    if clip_length > MAX_CLIP_LENGTH or clip_length < MIN_CLIP_LENGTH:
+        raise ValueError("Clip length must be between 100 and 90,000 milliseconds.")
+
+
+def gain_to_factor(gain_value):
+    """Converts a gain adjustment in dB to a linear amplitude factor"""
+    return 10 ** (gain_value / 20)
+
+
+def apply_gain(samples, gain_value):
+    """Applies a gain adjustment in dB to an int16 sample array, clipping to the 16-bit range
+    Returns the input unchanged (no copy) if gain_value is 0, otherwise a new int16 array of the same shape
+    """
+    if gain_value == 0:
+        return samples
+
+    # Multiply in place on a single float32 working copy of the region, then clip back to 16-bit
+    work = samples.astype(np.float32)
+    work *= gain_to_factor(gain_value)
+    np.clip(work, -32768, 32767, out=work)
+    return work.astype(np.int16)
+
+
+def crossfade_loop(samples, fade_frames):
+    """Bakes an equal-power crossfade of the last fade_frames of a clip into its first fade_frames, so that playing
+    the result on repeat flows from its end back into its start without a click
+    Returns the input unchanged (no copy) if fade_frames is 0, otherwise a new int16 array fade_frames shorter
+    """
+    if fade_frames <= 0:
+        return samples
+    if fade_frames > len(samples) // 2:
+        raise ValueError("Loop crossfade must be no longer than half of the clip.")
+
+    # The tail fades out (cos) while the head fades in (sin), so their powers always sum to 1
+    angle = (np.arange(fade_frames, dtype=np.float32) + 0.5) * np.float32(np.pi / 2 / fade_frames)
+    head = samples[:fade_frames] * np.sin(angle)[:, np.newaxis]
+    head += samples[-fade_frames:] * np.cos(angle)[:, np.newaxis]
+    np.clip(np.round(head, out=head), -32768, 32767, out=head)
+
+    output = samples[:len(samples) - fade_frames].copy()
+    output[:fade_frames] = head
+    return output
+
+
+def downmix(samples, mode=DEFAULT_DOWNMIX_MODE):
+    """Down-mixes an int16 (frames, channels) array to mono
+    'mix' averages the channels, like pydub's set_channels(1). 'left' and 'right' return a zero-copy view of one
+    channel, for tracks whose channels cancel out when averaged. 'mid' averages the channels, then adds back the level
+    lost to cancellation (up to MAX_MID_COMPENSATION dB) so the result is as loud as the channels on their own
+    """
+    if mode not in DOWNMIX_MODES:
+        raise ValueError(f"Down-mix mode must be one of {', '.join(DOWNMIX_MODES)}, not {mode}.")
+    if samples.shape[1] == 1:
+        return samples
+    if mode == "left":
+        return samples[:, 0:1]
+    if mode == "right":
+        return samples[:, 1:2]
+
+    mono = samples.mean(axis=1, dtype=np.float32)
+    if mode == "mid":
+        channel_energy = np.square(samples, dtype=np.float32).sum(dtype=np.float64) / samples.shape[1]
+        mid_energy = float(np.dot(mono, mono))
+        if mid_energy > 0:
+            mono *= np.float32(min(np.sqrt(channel_energy / mid_energy), gain_to_factor(MAX_MID_COMPENSATION)))
+            np.clip(mono, -32768, 32767, out=mono)
+    return mono.astype(np.int16).reshape(-1, 1)
+
+
+class AudioData:
+    """Decoded audio held in a single contiguous int16 NumPy buffer of shape (frames, channels)
+    The source buffer is never modified: slices are zero-copy views and gain is only applied to the region rendered
+    """
+
+    def __init__(self, samples, frame_rate, source_sample_width=2):
+        if samples.ndim == 1:
+            samples = samples.reshape(-1, 1)
+        self.samples = samples
+        self.frame_rate = frame_rate
+        self.source_sample_width = source_sample_width  # Bit depth of the original file, for display only
+
+    @classmethod
+    def from_segment(cls, segment):
+        """Wraps a pydub AudioSegment without copying its sample data (converting to 16-bit first if needed)"""
+        source_sample_width = segment.sample_width
+        if segment.sample_width != 2:
+            segment = segment.set_sample_width(2)
+
+        # np.frombuffer shares memory with the AudioSegment's raw bytes, so the whole track is held only once
+        samples = np.frombuffer(segment.raw_data, dtype='<i2').reshape(-1, segment.channels)
+        return cls(samples, segment.frame_rate, source_sample_width)
+
+    @classmethod
+    def from_file(cls, audio_file, progress_callback=None, cancel_event=None):
+        """Decodes an audio file once into an AudioData buffer (see decode_file)"""
+        return decode_file(audio_file, progress_callback, cancel_event)
+
+    @property
+    def channels(self):
+        return self.samples.shape[1]
+
+    @property
+    def frame_count(self):
+        return self.samples.shape[0]
+
+    @property
+    def duration_ms(self):
+        return int(self.frame_count * 1000 / self.frame_rate)
+
+    def ms_to_frame(self, position):
+        """Converts a position in milliseconds to a frame index, clamped to the length of the audio"""
+        return min(max(int(round(position * self.frame_rate / 1000)), 0), self.frame_count)
+
+    def view(self, start_pos, end_pos):
+        """Returns a zero-copy view of the audio between two positions in milliseconds"""
+        return self.samples[self.ms_to_frame(start_pos):self.ms_to_frame(end_pos)]
+
+
+def samples_to_segment(samples, frame_rate):
+    """Wraps an int16 (frames, channels) array in a pydub AudioSegment, for resampling and export via pydub"""
+    return AudioSegment(data=np.ascontiguousarray(samples).tobytes(), sample_width=2, frame_rate=frame_rate,
+                        channels=samples.shape[1])
+
+
+class DecodeCancelled(Exception):
+    """Raised when decoding is cancelled through its cancel_event"""
+
+
+def load_audio(audio_file, progress_callback=None, cancel_event=None):
+    """Decodes an audio file into an AudioData buffer, using the decoded audio cache for files that need ffmpeg"""
+    if not is_cacheable(audio_file):
+        return AudioData.from_file(audio_file, progress_callback, cancel_event)
+
+    audio = load_cached_audio(audio_file)
+    if audio is None:
+        audio = AudioData.from_file(audio_file, progress_callback, cancel_event)
+        store_cached_audio(audio_file, audio)
+    return audio
+
+
+def is_cacheable(audio_file):
+    """True if a file's decoded audio should be cached. .WAV files are read directly, which is as fast as the cache"""
+    return os.path.splitext(audio_file)[1].lower() != '.wav'
+
+
+def audio_cache_path(audio_file):
+    """Returns the path of a file's entry in the decoded audio cache, without the .npy or .json extension"""
+    return os.path.join(kerokero_cache.get_cache_dir("audio"),
+                        f"{kerokero_cache.cached_file_hash(audio_file)}-v{AUDIO_CACHE_VERSION}")
+
+
+@kerokero_trace.traced("decode_cached")
+def load_cached_audio(audio_file):
+    """Returns a file's decoded audio memory-mapped (read-only) from the cache, or None if it is not cached"""
+    cache_path = audio_cache_path(audio_file)
+    try:
+        with open(cache_path + '.json', 'r') as f:
+            info = json.load(f)
+        samples = np.load(cache_path + '.npy', mmap_mode='r')
+        # Mark the entry as recently used, so it is evicted last
+        os.utime(cache_path + '.npy')
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.warning(f"Could not read cached audio {cache_path}: {e}")
+        return None
+
+    logging.info(f"Loaded decoded audio from the cache: {cache_path}.npy")
+    return AudioData(samples, info["frame_rate"], info["source_sample_width"])
+
+
+def store_cached_audio(audio_file, audio):
+    """Saves decoded audio to the cache, then evicts the least recently used entries if the cache is too large"""
+    cache_path = audio_cache_path(audio_file)
+    try:
+        # The samples are written before the metadata, so an entry with metadata is always complete
+        temp_file = f"{cache_path}.{os.getpid()}.tmp"
+        with open(temp_file, 'wb') as f:
+            np.save(f, np.ascontiguousarray(audio.samples))
+        os.replace(temp_file, cache_path + '.npy')
+        info = {"frame_rate": audio.frame_rate, "source_sample_width": audio.source_sample_width,
+                "source_file": os.path.abspath(audio_file)}
+        kerokero_cache.write_atomic(cache_path + '.json', json.dumps(info).encode())
+        kerokero_cache.evict_lru(os.path.dirname(cache_path), AUDIO_CACHE_MAX_BYTES, '.npy')
+    except OSError as e:
+        logging.warning(f"Could not cache decoded audio {cache_path}: {e}")
+
+
+def decode_file(audio_file, progress_callback=None, cancel_event=None):
+    """Decodes an audio file in chunks, so progress can be reported and decoding can be cancelled
+    progress_callback(fraction) is called as data arrives, and setting cancel_event (a threading.Event) raises
+    DecodeCancelled. 16-bit PCM .WAV files are read directly, anything else is decoded through an ffmpeg pipe
+    """
+    if os.path.splitext(audio_file)[1].lower() == '.wav':
+        try:
+            return decode_wav(audio_file, progress_callback, cancel_event)
+        except (wave.Error, EOFError, ValueError) as e:
+            logging.debug(f"Reading {audio_file} with ffmpeg instead of the wave module: {e}")
+    return decode_ffmpeg(audio_file, progress_callback, cancel_event)
+
+
+def _check_cancelled(cancel_event):
+    if cancel_event is not None and cancel_event.is_set():
+        raise DecodeCancelled("Loading was cancelled.")
+
+
+@kerokero_trace.traced("decode_wav")
+def decode_wav(audio_file, progress_callback=None, cancel_event=None):
+    """Reads a 16-bit PCM .WAV file straight into a preallocated buffer, without ffmpeg"""
+    with wave.open(audio_file, 'rb') as wav_file:
+        if wav_file.getsampwidth() != 2:
+            raise ValueError("Only 16-bit .WAV files are read directly.")
+        channels = wav_file.getnchannels()
+        frame_rate = wav_file.getframerate()
+        frame_count = wav_file.getnframes()
+        samples = np.empty((frame_count, channels), dtype='<i2')
+        chunk_frames = max(DECODE_CHUNK_SIZE // (2 * channels), 1)
+
+        position = 0
+        while position < frame_count:
+            _check_cancelled(cancel_event)
+            data = wav_file.readframes(chunk_frames)
+            if not data:
+                break
+            chunk = np.frombuffer(data, dtype='<i2').reshape(-1, channels)
+            samples[position:position + len(chunk)] = chunk
+            position += len(chunk)
+            if progress_callback is not None:
+                progress_callback(position / frame_count)
+
+    return AudioData(samples[:position], frame_rate)
+
+
+def probe_audio(audio_file):
+    """Returns (channels, sample rate, duration in seconds or None, sample width in bytes) of the first audio stream,
+    using ffprobe
+    """
+    info = mediainfo_json(audio_file)
+    stream = next((stream for stream in info.get("streams", []) if stream.get("codec_type") == "audio"), None)
+    if stream is None:
+        raise ValueError(f"No audio stream was found in {audio_file}.")
+
+    duration = stream.get("duration") or info.get("format", {}).get("duration")
+    try:
+        duration = float(duration)
+    except (TypeError, ValueError):
+        duration = None
+
+    # Compressed formats such as MP3 report 0 bits per sample; they are decoded to 16-bit
+    bits = int(stream.get("bits_per_raw_sample") or stream.get("bits_per_sample") or 16)
+    return int(stream["channels"]), int(stream["sample_rate"]), duration, max(bits // 8, 2)
+
+
+def open_decoder(audio_file, channels):
+    """Starts ffmpeg decoding audio_file to 16-bit little-endian PCM on its stdout"""
+    command = [get_encoder_name(), '-nostdin', '-v', 'error', '-i', audio_file, '-vn',
+               '-f', 's16le', '-acodec', 'pcm_s16le', '-ac', str(channels), '-']
+    # Don't flash a console window for ffmpeg when running as a Windows .EXE without a console
+    creationflags = subprocess.CREATE_NO_WINDOW if sys.platform == "win32" else 0
+    return subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, stdin=subprocess.DEVNULL,
+                            creationflags=creationflags)
+
+
+def decode_ffmpeg(audio_file, progress_callback=None, cancel_event=None):
+    """Decodes any format ffmpeg supports, blocking until the whole file has been decoded"""
+    decoder = ProgressiveDecoder(audio_file, progress_callback, cancel_event)
+    decoder.run()
+    return decoder.result()
+
+
+class ProgressiveDecoder:
+    """Decodes a file through an ffmpeg pipe into a growable buffer that can be read while decoding continues
+    Call start() to decode on a background thread, wait_for(frame) to block until a frame has been decoded, and
+    result() for the finished AudioData. snapshot() returns the buffer and the number of frames decoded so far,
+    which is what the player reads from to play a file before it has finished loading
+    """
+
+    def __init__(self, audio_file, progress_callback=None, cancel_event=None):
+        self.audio_file = audio_file
+        self.progress_callback = progress_callback
+        self.cancel_event = cancel_event
+        self.channels, self.frame_rate, duration, self.source_sample_width = probe_audio(audio_file)
+        self.expected_frames = int(duration * self.frame_rate) if duration else 0
+
+        # Size the buffer from the probed duration (plus a little), growing it if the estimate was short
+        chunk_frames = DECODE_CHUNK_SIZE // (2 * self.channels)
+        self.samples = np.empty((int(self.expected_frames * 1.01) + chunk_frames, self.channels), dtype='<i2')
+        self.frames_ready = 0
+        self.complete = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = None
+
+    @property
+    def duration_ms(self):
+        """Expected length in milliseconds, from the probed duration until decoding has finished"""
+        frames = self.frames_ready if self.complete else max(self.expected_frames, self.frames_ready)
+        return int(frames * 1000 / self.frame_rate)
+
+    def start(self):
+        """Starts decoding on a background thread"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def snapshot(self):
+        """Returns (buffer, frames decoded, complete). Frames below the count never change once decoded"""
+        with self.condition:
+            return self.samples, self.frames_ready, self.complete
+
+    def wait_for(self, frame, timeout=None):
+        """Blocks until the given frame has been decoded or decoding has ended. Returns True if the frame is ready"""
+        with self.condition:
+            self.condition.wait_for(lambda: self.frames_ready > frame or self.complete, timeout)
+            return self.frames_ready > frame
+
+    def result(self):
+        """Waits for decoding to finish and returns the AudioData, raising any decoding error"""
+        if self.thread is not None:
+            self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return AudioData(self.samples[:self.frames_ready], self.frame_rate, self.source_sample_width)
+
+    def run(self):
+        """Decodes the whole file, recording any error for result() to raise"""
+        try:
+            with kerokero_trace.span("decode_ffmpeg", file=os.path.basename(self.audio_file)):
+                self._decode()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self.condition:
+                self.complete = True
+                self.condition.notify_all()
+
+    def _grow(self):
+        """Moves the decoded frames into a buffer half as large again. Readers holding the old buffer can keep
+        reading it, since decoded frames are never changed
+        """
+        samples = np.empty((len(self.samples) * 3 // 2, self.channels), dtype='<i2')
+        samples[:self.frames_ready] = self.samples[:self.frames_ready]
+        with self.condition:
+            self.samples = samples
+
+    def _decode(self):
+        frame_size = 2 * self.channels
+        size = 0  # Bytes decoded, which can end part way through a frame
+
+        process = open_decoder(self.audio_file, self.channels)
+        try:
+            while True:
+                _check_cancelled(self.cancel_event)
+                if size + DECODE_CHUNK_SIZE > self.samples.nbytes:
+                    self._grow()
+
+                with memoryview(self.samples).cast('B') as view:
+                    count = process.stdout.readinto(view[size:size + DECODE_CHUNK_SIZE])
+                if not count:
+                    break
+                size += count
+
+                with self.condition:
+                    self.frames_ready = size // frame_size
+                    self.condition.notify_all()
+                if self.progress_callback is not None and self.expected_frames:
+                    self.progress_callback(min(self.frames_ready / self.expected_frames, 1.0))
+        finally:
+            if process.poll() is None:
+                process.kill()
+            process.stdout.close()
+            return_code = process.wait()
+
+        if return_code != 0 and size == 0:
+            raise OSError(f"ffmpeg could not decode {self.audio_file} (exit code {return_code}).")
+
+
+class PagefileSys:
+    """A 'pagefile.sys' (headerless 16-bit signed little-endian mono) file, memory-mapped with np.memmap
+    The sample rate is not stored in the file, so it must be given (21560 Hz for stock firmware, 22050 Hz if patched)
+    """
+
+    def __init__(self, path, sample_rate=STOCK_SAMPLE_RATE, writable=False):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.writable = writable
+        self.samples = None
+        self._map()
+
+    def _map(self):
+        """Memory-maps the file, ignoring a trailing odd byte"""
+        frame_count = os.path.getsize(self.path) // PAGEFILE_SAMPLE_WIDTH
+        if frame_count == 0:
+            # np.memmap cannot map an empty file
+            self.samples = np.zeros(0, dtype='<i2')
+        else:
+            self.samples = np.memmap(self.path, dtype='<i2', mode='r+' if self.writable else 'r',
+                                     shape=(frame_count,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Flushes any changes and releases the memory map"""
+        if isinstance(self.samples, np.memmap) and self.writable:
+            self.samples.flush()
+        self.samples = None
+
+    @property
+    def frame_count(self):
+        return len(self.samples)
+
+    @property
+    def duration_ms(self):
+        return int(self.frame_count * 1000 / self.sample_rate)
+
+    def to_audio_data(self):
+        """Returns the file as AudioData without copying it (the samples stay memory-mapped)"""
+        return AudioData(self.samples.reshape(-1, 1), self.sample_rate)
+
+    def _require_writable(self):
+        if not self.writable:
+            raise ValueError(f"{self.path} was opened read-only.")
+
+    def trim(self, start_pos, end_pos):
+        """Trims the file in place to the audio between two positions in milliseconds"""
+        self._require_writable()
+        start_frame = min(max(int(round(start_pos * self.sample_rate / 1000)), 0), self.frame_count)
+        end_frame = min(max(int(round(end_pos * self.sample_rate / 1000)), start_frame), self.frame_count)
+
+        # Move the kept region to the start of the file, then truncate the file after it
+        if start_frame > 0:
+            self.samples[:end_frame - start_frame] = self.samples[start_frame:end_frame]
+        self.close()
+        os.truncate(self.path, (end_frame - start_frame) * PAGEFILE_SAMPLE_WIDTH)
+        self._map()
+
+    def apply_gain(self, gain_value):
+        """Applies a gain adjustment in dB to the file in place, clipping to the 16-bit range"""
+        self._require_writable()
+        if gain_value == 0:
+            return
+
+        # Work through the file in chunks, so only one chunk is held in memory as float at a time
+        for start in range(0, self.frame_count, PROCESS_CHUNK_SIZE):
+            chunk = self.samples[start:start + PROCESS_CHUNK_SIZE]
+            chunk[:] = apply_gain(chunk, gain_value)
+
+    @staticmethod
+    def write(path, samples):
+        """Writes int16 samples (mono, or (frames, 1)) as a 'pagefile.sys' file in a single buffered write"""
+        samples = np.ascontiguousarray(samples, dtype='<i2')
+        with open(path, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+            f.write(memoryview(samples).cast('B'))
+
+
+def render_samples(audio, start_pos, end_pos, gain_value=0.0, target_rate=None,
+                   quality=kerokero_resample.DEFAULT_QUALITY, loudness_target=None, crossfade_length=0,
+                   downmix_mode=DEFAULT_DOWNMIX_MODE):
+    """Renders a clip from decoded AudioData: slice -> downmix -> resample -> crossfade -> gain, returned as an int16
+    array. If target_rate is None, the clip is returned at its original sample rate and channel count (for WAV/MP3
+    export), otherwise it is down-mixed to mono as set by downmix_mode. If loudness_target (LUFS) is given, the clip
+    is normalized to that loudness instead of applying gain_value. A crossfade_length (ms) folds that much of the end
+    of the clip into its start (see crossfade_loop). Use a RenderCache instead when the same clip is rendered more
+    than once
+    """
+    return RenderCache(audio).render(start_pos, end_pos, gain_value, target_rate, quality, loudness_target,
+                                     crossfade_length, downmix_mode)
+
+
+class RenderCache:
+    """Memoizes the stages of render_samples for one AudioData. Each stage's output is cached by the parameters it
+    depends on, so rendering a clip again is instant and changing only the gain re-uses the resampled audio
+    The least recently used outputs are dropped once they take up more than max_bytes. Rendered arrays are shared with
+    the cache, so they are read-only
+    """
+
+    def __init__(self, audio, max_bytes=RENDER_CACHE_MAX_BYTES):
+        self.audio = audio
+        self.max_bytes = max_bytes
+        self.outputs = collections.OrderedDict()
+        self.size = 0
+        self.measurements = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def stage(self, key, compute):
+        """Returns the cached output for key, or calls compute() and caches its result
+        If another thread is already computing the same stage, waits for its result instead of computing it again
+        """
+        with self.lock:
+            if key in self.outputs:
+                self.outputs.move_to_end(key)
+                return self.outputs[key]
+            computing = self.pending.get(key)
+            if computing is None:
+                self.pending[key] = threading.Event()
+
+        if computing is not None:
+            computing.wait()
+            return self.stage(key, compute)
+
+        # Compute outside the lock, so other threads can use the cache meanwhile
+        try:
+            with kerokero_trace.span(f"render_{key[0]}"):
+                output = compute()
+            output.flags.writeable = False
+
+            with self.lock:
+                self.outputs[key] = output
+                self.size += output.nbytes
+                # Drop the least recently used outputs, always keeping the newest
+                while self.size > self.max_bytes and len(self.outputs) > 1:
+                    _, dropped = self.outputs.popitem(last=False)
+                    self.size -= dropped.nbytes
+            return output
+        finally:
+            with self.lock:
+                self.pending.pop(key).set()
+
+    def measure(self, start_pos, end_pos, target_rate=None, quality=kerokero_resample.DEFAULT_QUALITY,
+                crossfade_length=0, downmix_mode=DEFAULT_DOWNMIX_MODE):
+        """Returns the Loudness of a clip as rendered without gain, measured once per clip and target rate"""
+        audio = self.audio
+        key = (audio.ms_to_frame(start_pos), audio.ms_to_frame(end_pos), target_rate, quality, crossfade_length,
+               downmix_mode if target_rate is not None else None)
+        with self.lock:
+            if key in self.measurements:
+                return self.measurements[key]
+
+        samples = self.render(start_pos, end_pos, 0.0, target_rate, quality, crossfade_length=crossfade_length,
+                              downmix_mode=downmix_mode)
+        loudness = kerokero_loudness.measure_loudness(samples, target_rate or audio.frame_rate)
+        with self.lock:
+            self.measurements[key] = loudness
+        return loudness
+
+    def render(self, start_pos, end_pos, gain_value=0.0, target_rate=None,
+               quality=kerokero_resample.DEFAULT_QUALITY, loudness_target=None, crossfade_length=0,
+               downmix_mode=DEFAULT_DOWNMIX_MODE):
+        """Renders a clip like render_samples, re-using any stages that have been rendered before"""
+        if loudness_target is not None:
+            loudness = self.measure(start_pos, end_pos, target_rate, quality, crossfade_length, downmix_mode)
+            gain_value = round(loudness.normalization_gain(loudness_target), 2)
+            logging.info(f"Clip loudness: {loudness}, normalized to {loudness_target} LUFS with {gain_value} dB gain")
+
+        audio = self.audio
+        start_frame, end_frame = audio.ms_to_frame(start_pos), audio.ms_to_frame(end_pos)
+        clip = (start_frame, end_frame)
+
+        # Slicing is a zero-copy view, so it is not cached
+        samples = audio.samples[start_frame:end_frame]
+        if target_rate is not None:
+            # Down-mix to mono, then resample the audio to the target rate for proper playback speed on the SF2000
+            clip += (downmix_mode,)
+            mono = self.stage(("downmix",) + clip, lambda: downmix(samples, downmix_mode))
+            clip += (target_rate, quality)
+            samples = self.stage(("resample",) + clip,
+                                 lambda: kerokero_resample.resample(mono, audio.frame_rate, target_rate, quality))
+
+        # Fold the end of the clip into its start, at the rate of the audio that is written out
+        fade_frames = int(round(crossfade_length * (target_rate or audio.frame_rate) / 1000))
+        if fade_frames > 0:
+            clip += (fade_frames,)
+            unfaded = samples
+            samples = self.stage(("crossfade",) + clip, lambda: crossfade_loop(unfaded, fade_frames))
+
+        # Gain comes last, so a gain change only repeats this stage
+        if gain_value == 0:
+            return samples
+        return self.stage(("gain", gain_value) + clip, lambda: apply_gain(samples, gain_value))
+
+
+@kerokero_trace.traced("export")
+def export_pagefile(samples, output_file):
+    """Exports rendered int16 samples in SF2000+GB300 'pagefile.sys' format (16-bit signed little-endian)"""
+    PagefileSys.write(output_file, samples)
+
+
+@kerokero_trace.traced("export_wav")
+def export_wav(samples, frame_rate, output_file):
+    """Exports rendered int16 (frames, channels) samples as a 16-bit PCM .WAV file, written directly with the wave
+    module instead of through pydub, without copying the samples
+    """
+    samples = np.ascontiguousarray(samples, dtype='<i2')
+    with open(output_file, 'wb', buffering=WRITE_BUFFER_SIZE) as f:
+        with wave.open(f, 'wb') as wav_file:
+            wav_file.setnchannels(samples.shape[1])
+            wav_file.setsampwidth(2)
+            wav_file.setframerate(frame_rate)
+            wav_file.writeframesraw(memoryview(samples).cast('B'))
+
+
+def export_clip(samples, frame_rate, output_file, file_format):
+    """Exports rendered int16 samples as 'sys' (pagefile.sys), 'wav' or any other format pydub can encode
+    Only formats other than 'sys' and 'wav' (such as 'mp3') need ffmpeg
+    """
+    if file_format == "sys":
+        export_pagefile(samples, output_file)
+    elif file_format == "wav":
+        export_wav(samples, frame_rate, output_file)
+    else:
+        with kerokero_trace.span("export_ffmpeg", format=file_format):
+            samples_to_segment(samples, frame_rate).export(output_file, format=file_format)
+
+
+def export_targets(renders, input_file, output_dir, targets, start_pos, end_pos, gain_value=0.0,
+                   quality=kerokero_resample.DEFAULT_QUALITY, loudness_target=None, crossfade_length=0,
+                   downmix_mode=DEFAULT_DOWNMIX_MODE, max_workers=EXPORT_WORKERS):
+    """Renders a clip of input_file once and writes it to several EXPORT_TARGETS in output_dir at the same time, on
+    a thread pool. Stages shared by the targets (such as the down-mix) are computed once by the RenderCache. Every
+    file is written to a temporary file and renamed into place, so a failed export never leaves a partly written file.
+    Returns a dict of target -> output file. If any target fails, the first error is raised once the others finish
+    """
+    name = os.path.splitext(os.path.basename(input_file))[0]
+    outputs = {target: os.path.join(output_dir, EXPORT_TARGETS[target][0].format(name=name)) for target in targets}
+    if any(os.path.abspath(output_file) == os.path.abspath(input_file) for output_file in outputs.values()):
+        raise ValueError("Input and Output files cannot be the same.")
+
+    def export(target):
+        output_file = outputs[target]
+        target_rate = EXPORT_TARGETS[target][1]
+        samples = renders.render(start_pos, end_pos, gain_value, target_rate, quality, loudness_target,
+                                 crossfade_length, downmix_mode)
+
+        os.makedirs(os.path.dirname(output_file), exist_ok=True)
+        with kerokero_cache.atomic_path(output_file) as temp_file:
+            export_clip(samples, target_rate or renders.audio.frame_rate, temp_file,
+                        "sys" if target_rate is not None else target)
+        logging.info(f"Exported {target}: {output_file}")
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(export, target) for target in targets]
+        errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        raise errors[0]
+    return outputs
+
+
+def convert_pagefile(input_file, output_file, source_rate=STOCK_SAMPLE_RATE, target_rate=PATCHED_SAMPLE_RATE,
+                     quality=kerokero_resample.DEFAULT_QUALITY):
+    """Resamples an existing 'pagefile.sys' file to a new sample rate, without ffmpeg
+    Returns the number of frames written
+    """
+    if os.path.abspath(output_file) == os.path.abspath(input_file):
+        raise ValueError("Input and Output files cannot be the same.")
+
+    with PagefileSys(input_file, source_rate) as pagefile:
+        samples = kerokero_resample.resample(pagefile.to_audio_data().samples, source_rate, target_rate, quality)
+    PagefileSys.write(output_file, samples)
+    return len(samples)
+
+
+def convert_file(input_file, output_file, start_pos, end_pos, gain_value=0.0, target_rate=STOCK_SAMPLE_RATE,
+                 quality=kerokero_resample.DEFAULT_QUALITY, loudness_target=None, crossfade_length=0,
+                 downmix_mode=DEFAULT_DOWNMIX_MODE):
+    """Converts a single audio file to a 'pagefile.sys' file, returning a dict of timing statistics
+    Used by the batch converter, so it must be safe to run in a worker process
+    """
+    if target_rate not in TARGET_SAMPLE_RATES:
+        raise ValueError(f"Target sample rate must be one of {TARGET_SAMPLE_RATES}, not {target_rate}.")
+    validate_clip_range(start_pos, end_pos)
+
+    if os.path.abspath(output_file) == os.path.abspath(input_file):
+        raise ValueError("Input and Output files cannot be the same.")
+
+    start_time = time.perf_counter()
+
+    audio = load_audio(input_file)
+    decoded_time = time.perf_counter()
+
+    samples = render_samples(audio, start_pos, end_pos, gain_value, target_rate, quality, loudness_target,
+                             crossfade_length, downmix_mode)
+    export_pagefile(samples, output_file)
+    end_time = time.perf_counter()
+
+    logging.debug(f"Converted {input_file} -> {output_file} in {end_time - start_time:.3f} s")
+
+    return {
+        "input_file": input_file,
+        "output_file": output_file,
+        "clip_length": int(len(samples) * 1000 / target_rate),
+        "decode_time": decoded_time - start_time,
+        "render_time": end_time - decoded_time,
+        "wall_time": end_time - start_time,
+    }
@@ -0,0 +1,121 @@
+# Kerokero cache - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# On-disk cache location, file hashing and eviction, so work done for a track can be reused when it is opened again.
+# This module must not import PyQt5.
+
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import sys
+import threading
+
+# Size of the chunks read when hashing a file
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# File in the cache directory remembering the hash of each file by its path, size and modification time
+HASH_INDEX_FILE = "file_hashes.json"
+
+
+def get_cache_dir(*subdirs):
+    """Returns (and creates) Kerokero's folder in the user cache directory, or a sub-folder of it
+    Set the KEROKERO_CACHE_DIR environment variable to use a different location
+    """
+    base_dir = os.environ.get("KEROKERO_CACHE_DIR")
+    if not base_dir:
+        if sys.platform == "win32":
+            base_dir = os.path.join(os.environ.get("LOCALAPPDATA", os.path.expanduser("~")), "Kerokero", "Cache")
+        elif sys.platform == "darwin":
+            base_dir = os.path.join(os.path.expanduser("~"), "Library", "Caches", "Kerokero")
+        else:
+            base_dir = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "kerokero")
+
+    cache_dir = os.path.join(base_dir, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+
+def file_hash(path):
+    """Returns the SHA-256 hex digest of a file's contents"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cached_file_hash(path):
+    """Returns file_hash(path), re-using the hash from the last call if the file's size and modification time have not
+    changed since, so unchanged files are not read again
+    """
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    index_file = os.path.join(get_cache_dir(), HASH_INDEX_FILE)
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        index = {}
+
+    entry = index.get(path)
+    if entry is not None and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+        return entry[2]
+
+    digest = file_hash(path)
+    index[path] = [stat.st_size, stat.st_mtime_ns, digest]
+    try:
+        write_atomic(index_file, json.dumps(index).encode())
+    except OSError as e:
+        logging.warning(f"Could not update {index_file}: {e}")
+    return digest
+
+
+@contextlib.contextmanager
+def atomic_path(path):
+    """Yields a temporary path to write a file to. The file replaces path when the with block ends, or is deleted if
+    the block raises, so path only ever holds a complete file
+    """
+    temp_file = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        yield temp_file
+        os.replace(temp_file, path)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+
+def write_atomic(path, data):
+    """Writes bytes to a file through a temporary file, so readers never see a partly written file"""
+    with atomic_path(path) as temp_file:
+        with open(temp_file, 'wb') as f:
+            f.write(data)
+
+
+def evict_lru(cache_dir, max_bytes, suffix):
+    """Deletes the least recently used files ending in suffix until they take up at most max_bytes in total, along with
+    any other files sharing their name (such as metadata). Files are ordered by modification time, so touch a file
+    with os.utime when it is used. The most recently used file is always kept
+    """
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(suffix):
+            stat = os.stat(os.path.join(cache_dir, name))
+            entries.append((stat.st_mtime, stat.st_size, name))
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, name in sorted(entries)[:-1]:
+        if total <= max_bytes:
+            break
+        stem = name[:-len(suffix)]
+        try:
+            for related in os.listdir(cache_dir):
+                if related.startswith(stem):
+                    os.remove(os.path.join(cache_dir, related))
+            total -= size
+            logging.debug(f"Evicted {name} from {cache_dir}")
+        except OSError as e:
+            # Files that are still open (for example memory-mapped on Windows) cannot be deleted yet
+            logging.debug(f"Could not evict {name}: {e}")
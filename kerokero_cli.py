@@ -0,0 +1,284 @@
+# Kerokero command line tool - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Headless batch conversion of audio tracks to 'pagefile.sys' format. Does not import PyQt5.
+#
+# Usage:
+#   python kerokero.py convert manifest.json [--output-dir DIR] [--workers N] [--quality fast|medium|high]
+#                                            [--loudness LUFS] [--crossfade MS] [--downmix mix|mid|left|right]
+#   python kerokero.py migrate INPUT_DIR OUTPUT_DIR [--from RATE] [--to RATE] [--workers N]
+#                                                   [--quality fast|medium|high]
+#
+# The manifest is a JSON list of tracks, for example:
+#   [
+#     {"file": "title.mp3", "in": 1500, "out": 91000, "gain": -2, "rate": 21560, "output": "stock/pagefile.sys"},
+#     {"file": "title.mp3", "in": 1500, "out": 91000, "gain": -2, "rate": 22050, "output": "patched/pagefile.sys"}
+#   ]
+# 'gain' (dB) defaults to 0, 'rate' defaults to 21560 and 'output' defaults to '<output-dir>/<file name>.sys'.
+# 'loudness' (LUFS, ex. -16) normalizes the track to that loudness instead of applying 'gain', and defaults to the
+# --loudness option, so a whole pack can be normalized to the same perceived volume.
+# 'crossfade' (ms) fades that much of the end of the track into its start so it loops without a click, and defaults
+# to the --crossfade option (0).
+# 'downmix' sets how stereo is made mono: 'mix' (average the channels), 'mid' (average, then make up for phase
+# cancellation), 'left' or 'right' (one channel). It defaults to the --downmix option ('mix').
+# Relative paths are resolved from the folder containing the manifest.
+#
+# 'migrate' resamples every .sys file under INPUT_DIR (21560 Hz to 22050 Hz by default, for firmware with the BGM
+# sample rate fix) into the same folder structure under OUTPUT_DIR. Input files are never overwritten.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import kerokero_audio
+import kerokero_cache
+import kerokero_resample
+
+
+def load_manifest(manifest_file, output_dir=None, quality=kerokero_resample.DEFAULT_QUALITY, loudness_target=None,
+                  crossfade_length=0, downmix_mode=kerokero_audio.DEFAULT_DOWNMIX_MODE):
+    """Reads a conversion manifest and returns a list of normalized track entries"""
+    with open(manifest_file, 'r', encoding='utf-8') as f:
+        tracks = json.load(f)
+
+    if not isinstance(tracks, list):
+        raise ValueError("The manifest must contain a JSON list of tracks.")
+
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    if output_dir is None:
+        output_dir = base_dir
+
+    entries = []
+    for index, track in enumerate(tracks):
+        try:
+            input_file = os.path.join(base_dir, track["file"])
+            start_pos = float(track["in"])
+            end_pos = float(track["out"])
+        except (KeyError, TypeError, ValueError) as e:
+            raise ValueError(f"Track {index} in the manifest is missing a valid 'file', 'in' or 'out' value: {e}")
+
+        output_file = track.get("output")
+        if output_file:
+            output_file = os.path.join(base_dir, output_file)
+        else:
+            output_name = os.path.splitext(os.path.basename(input_file))[0] + ".sys"
+            output_file = os.path.join(output_dir, output_name)
+
+        entries.append({
+            "input_file": input_file,
+            "output_file": output_file,
+            "start_pos": start_pos,
+            "end_pos": end_pos,
+            "gain_value": float(track.get("gain", 0)),
+            "target_rate": int(track.get("rate", kerokero_audio.STOCK_SAMPLE_RATE)),
+            "quality": quality,
+            "loudness_target": float(track["loudness"]) if "loudness" in track else loudness_target,
+            "crossfade_length": float(track.get("crossfade", crossfade_length)),
+            "downmix_mode": track.get("downmix", downmix_mode),
+        })
+
+    return entries
+
+
+def convert_entry(entry):
+    """Worker function for the process pool: converts one manifest entry"""
+    output_folder = os.path.dirname(entry["output_file"])
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+    return kerokero_audio.convert_file(**entry)
+
+
+def run_convert(args):
+    """Runs the 'convert' command: converts every track in the manifest using a process pool"""
+    entries = load_manifest(args.manifest, args.output_dir, args.quality, args.loudness, args.crossfade, args.downmix)
+
+    # Refuse to run if two tracks would be written to the same file
+    output_files = [os.path.abspath(entry["output_file"]) for entry in entries]
+    if len(set(output_files)) != len(output_files):
+        raise ValueError("Two or more tracks in the manifest have the same output file.")
+
+    print(f"Converting {len(entries)} track(s) with {args.workers or os.cpu_count()} worker(s)")
+
+    failures = 0
+    total_audio = 0.0
+    start_time = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(convert_entry, entry): entry for entry in entries}
+        for future in as_completed(futures):
+            entry = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"FAILED  {entry['input_file']}: {e}")
+                continue
+
+            total_audio += result["clip_length"] / 1000
+            print(f"OK      {result['output_file']} "
+                  f"({result['wall_time']:.3f} s wall, "
+                  f"decode {result['decode_time']:.3f} s, render {result['render_time']:.3f} s)")
+
+    total_time = time.perf_counter() - start_time
+    converted = len(entries) - failures
+    print(f"\nConverted {converted} of {len(entries)} track(s) in {total_time:.2f} s")
+    if total_time > 0:
+        print(f"Throughput: {converted / total_time:.2f} files/s, "
+              f"{total_audio / total_time:.1f} s of audio per second")
+
+    return 1 if failures else 0
+
+
+def find_pagefiles(input_dir, output_dir):
+    """Returns the paths relative to input_dir of every .sys file under it, skipping output_dir if it is inside it"""
+    output_dir = os.path.abspath(output_dir)
+    pagefiles = []
+    for folder, subfolders, files in os.walk(input_dir):
+        subfolders[:] = sorted(name for name in subfolders
+                               if os.path.abspath(os.path.join(folder, name)) != output_dir)
+        pagefiles += [os.path.relpath(os.path.join(folder, name), input_dir)
+                      for name in sorted(files) if name.lower().endswith('.sys')]
+    return pagefiles
+
+
+def migrate_entry(input_file, output_file, source_rate, target_rate, quality):
+    """Worker function for the thread pool: resamples one pagefile and checks the length of the result
+    The output is written through a temporary file, so a failed conversion never leaves a partial file behind
+    """
+    start_time = time.perf_counter()
+    input_bytes = os.path.getsize(input_file)
+    if input_bytes < kerokero_audio.PAGEFILE_SAMPLE_WIDTH:
+        raise ValueError("The file is empty.")
+    expected_frames = kerokero_resample.get_resampler(source_rate, target_rate, quality).output_length(
+        input_bytes // kerokero_audio.PAGEFILE_SAMPLE_WIDTH)
+
+    output_folder = os.path.dirname(output_file)
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+    with kerokero_cache.atomic_path(output_file) as temp_file:
+        frames = kerokero_audio.convert_pagefile(input_file, temp_file, source_rate, target_rate, quality)
+        written_frames = os.path.getsize(temp_file) // kerokero_audio.PAGEFILE_SAMPLE_WIDTH
+        if frames != expected_frames or written_frames != expected_frames:
+            raise ValueError(f"Wrote {written_frames} samples, expected {expected_frames}.")
+
+    return {
+        "output_file": output_file,
+        "input_bytes": input_bytes,
+        "wall_time": time.perf_counter() - start_time,
+    }
+
+
+def run_migrate(args):
+    """Runs the 'migrate' command: resamples every pagefile in a folder tree into a mirrored tree using a thread pool
+    NumPy and file I/O release the GIL, and threads avoid copying each file to and from a worker process
+    """
+    if not os.path.isdir(args.input_dir):
+        raise ValueError(f"Input folder not found: {args.input_dir}")
+    if args.source_rate == args.target_rate:
+        raise ValueError("The source and target sample rates are the same.")
+
+    pagefiles = find_pagefiles(args.input_dir, args.output_dir)
+    entries = [(os.path.join(args.input_dir, path), os.path.join(args.output_dir, path)) for path in pagefiles]
+
+    # Refuse to run if any output would overwrite an input, such as when the output folder is the input folder
+    input_files = {os.path.realpath(input_file) for input_file, _ in entries}
+    if any(os.path.realpath(output_file) in input_files for _, output_file in entries):
+        raise ValueError("The output folder would overwrite the input files. Please choose a different folder.")
+
+    workers = args.workers or os.cpu_count()
+    print(f"Migrating {len(entries)} pagefile(s) from {args.source_rate} Hz to {args.target_rate} Hz "
+          f"with {workers} worker(s)")
+
+    failures = 0
+    total_bytes = 0
+    start_time = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(migrate_entry, input_file, output_file, args.source_rate, args.target_rate,
+                                   args.quality): input_file
+                   for input_file, output_file in entries}
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                failures += 1
+                print(f"FAILED  {futures[future]}: {e}")
+                continue
+
+            total_bytes += result["input_bytes"]
+            print(f"OK      {result['output_file']} ({result['wall_time']:.3f} s wall)")
+
+    total_time = time.perf_counter() - start_time
+    migrated = len(entries) - failures
+    print(f"\nMigrated {migrated} of {len(entries)} pagefile(s) in {total_time:.2f} s")
+    if total_time > 0:
+        print(f"Throughput: {migrated / total_time:.2f} files/s, {total_bytes / total_time / 1e6:.1f} MB/s")
+
+    return 1 if failures else 0
+
+
+def build_parser():
+    """Builds the command line argument parser"""
+    parser = argparse.ArgumentParser(prog="kerokero", description="Kerokero SF2000+GB300 BGM Tool (command line)")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.required = True
+
+    convert_parser = subparsers.add_parser("convert", help="Convert the tracks in a manifest to pagefile.sys format")
+    convert_parser.add_argument("manifest", help="JSON manifest listing the tracks to convert")
+    convert_parser.add_argument("--output-dir", help="Folder for tracks without an 'output' entry "
+                                                     "(default: the manifest folder)")
+    convert_parser.add_argument("--workers", type=int, default=None,
+                                help="Number of worker processes (default: number of CPUs)")
+    convert_parser.add_argument("--quality", choices=sorted(kerokero_resample.QUALITY_SETTINGS),
+                                default=kerokero_resample.DEFAULT_QUALITY,
+                                help=f"Resampling quality (default: {kerokero_resample.DEFAULT_QUALITY})")
+    convert_parser.add_argument("--loudness", type=float, default=None, metavar="LUFS",
+                                help="Normalize tracks without a 'loudness' entry to this loudness, ex. -16 "
+                                     "(default: apply each track's 'gain' instead)")
+    convert_parser.add_argument("--crossfade", type=float, default=0, metavar="MS",
+                                help="Loop crossfade for tracks without a 'crossfade' entry, in ms (default: 0)")
+    convert_parser.add_argument("--downmix", choices=kerokero_audio.DOWNMIX_MODES,
+                                default=kerokero_audio.DEFAULT_DOWNMIX_MODE,
+                                help="How to down-mix stereo tracks without a 'downmix' entry to mono: average the "
+                                     "channels (mix), average them and make up for phase cancellation (mid), or use "
+                                     f"one channel (default: {kerokero_audio.DEFAULT_DOWNMIX_MODE})")
+    convert_parser.set_defaults(func=run_convert)
+
+    migrate_parser = subparsers.add_parser("migrate", help="Resample every pagefile.sys in a folder tree, for example "
+                                                           "to move a BGM library to patched firmware")
+    migrate_parser.add_argument("input_dir", help="Folder to search for .sys files, including subfolders")
+    migrate_parser.add_argument("output_dir", help="Folder to write the resampled files to, in the same structure")
+    migrate_parser.add_argument("--from", dest="source_rate", type=int, choices=kerokero_audio.TARGET_SAMPLE_RATES,
+                                default=kerokero_audio.STOCK_SAMPLE_RATE,
+                                help=f"Sample rate of the input files (default: {kerokero_audio.STOCK_SAMPLE_RATE})")
+    migrate_parser.add_argument("--to", dest="target_rate", type=int, choices=kerokero_audio.TARGET_SAMPLE_RATES,
+                                default=kerokero_audio.PATCHED_SAMPLE_RATE,
+                                help=f"Sample rate to convert to (default: {kerokero_audio.PATCHED_SAMPLE_RATE})")
+    migrate_parser.add_argument("--workers", type=int, default=None,
+                                help="Number of worker threads (default: number of CPUs)")
+    migrate_parser.add_argument("--quality", choices=sorted(kerokero_resample.QUALITY_SETTINGS),
+                                default=kerokero_resample.DEFAULT_QUALITY,
+                                help=f"Resampling quality (default: {kerokero_resample.DEFAULT_QUALITY})")
+    migrate_parser.set_defaults(func=run_migrate)
+
+    return parser
+
+
+def main(argv=None):
+    """Entry point for the command line tool"""
+    args = build_parser().parse_args(argv)
+    logging.basicConfig(level=logging.WARNING, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    try:
+        return args.func(args)
+    except (OSError, ValueError) as e:
+        print(f"ERROR: {e}")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
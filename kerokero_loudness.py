@@ -0,0 +1,237 @@
+# Kerokero loudness meter - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# EBU R128 / ITU-R BS.1770-4 integrated loudness (LUFS) and true peak (dBTP) measurement written in NumPy, used to
+# normalize clips so every track in a pack plays at the same perceived volume. This module must not import PyQt5.
+#
+# Run this file directly to benchmark it: python kerokero_loudness.py
+
+import functools
+import math
+import time
+
+import numpy as np
+
+import kerokero_resample
+import kerokero_trace
+
+# Default loudness target, and the highest true peak a normalized clip may reach, leaving headroom so the
+# resampled and down-mixed 16-bit output does not clip
+DEFAULT_TARGET_LOUDNESS = -16.0
+TRUE_PEAK_CEILING = -1.0
+
+# BS.1770 gating: 400 ms blocks overlapping by 75%, built from 100 ms segments
+SEGMENTS_PER_SECOND = 10
+SEGMENTS_PER_BLOCK = 4
+ABSOLUTE_GATE = -70.0  # LUFS
+RELATIVE_GATE = -10.0  # LU below the loudness of the blocks above the absolute gate
+
+# K-weighting filters as analog prototypes, so they can be designed for any sample rate (the BS.1770 tables only
+# give coefficients for 48 kHz): high shelf (frequency, gain in dB, Q) and high-pass (frequency, Q)
+SHELF_FILTER = (1681.974450955533, 3.999843853973347, 0.7071752369554196)
+HIGH_PASS_FILTER = (38.13547087602444, 0.5003270373238773)
+
+# True peak is measured by 4x oversampling with the resampler's polyphase filter bank
+TRUE_PEAK_OVERSAMPLING = 4
+TRUE_PEAK_QUALITY = "fast"
+TRUE_PEAK_CHUNK_SIZE = 1 << 16  # Sample positions interpolated at a time
+
+
+class Loudness:
+    """Integrated loudness (LUFS) and true peak (dBTP) of a clip. Both are -inf for silence"""
+
+    def __init__(self, integrated, true_peak):
+        self.integrated = integrated
+        self.true_peak = true_peak
+
+    def normalization_gain(self, target=DEFAULT_TARGET_LOUDNESS, ceiling=TRUE_PEAK_CEILING):
+        """Returns the gain in dB that brings the clip to the target loudness, reduced if needed so that the true
+        peak stays at or below the ceiling. Silence is left unchanged
+        """
+        if math.isinf(self.integrated):
+            return 0.0
+        return min(target - self.integrated, ceiling - self.true_peak)
+
+    def __repr__(self):
+        return f"Loudness({self.integrated:.1f} LUFS, true peak {self.true_peak:.1f} dBTP)"
+
+
+@functools.lru_cache(maxsize=8)
+def k_weighting(sample_rate):
+    """Returns the (b0, b1, b2, a1, a2) coefficients of the K-weighting shelf and high-pass biquads at sample_rate"""
+    frequency, gain, q = SHELF_FILTER
+    k = math.tan(math.pi * frequency / sample_rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ((vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0,
+             2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+
+    frequency, q = HIGH_PASS_FILTER
+    k = math.tan(math.pi * frequency / sample_rate)
+    a0 = 1 + k / q + k * k
+    high_pass = (1.0, -2.0, 1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0)
+    return shelf, high_pass
+
+
+@functools.lru_cache(maxsize=8)
+def state_response(sample_rate, length):
+    """For the two K-weighting biquads in series, returns the (length, 4) response of the output to each of the four
+    filter states over one segment, and the (4, 4) matrix that carries the states across a whole segment
+    """
+    (_, _, _, a1, a2), (c0, c1, c2, d1, d2) = k_weighting(sample_rate)
+    transition = np.array([[-a1, 1, 0, 0],
+                           [-a2, 0, 0, 0],
+                           [c1 - d1 * c0, 0, -d1, 1],
+                           [c2 - d2 * c0, 0, -d2, 0]])
+    output = np.array([c0, 0, 1, 0])
+
+    response = np.empty((length, 4))
+    carry = np.eye(4)
+    for index in range(length):
+        response[index] = output @ carry
+        carry = transition @ carry
+    return response, carry
+
+
+def segment_energy(samples, sample_rate):
+    """Returns the (channels, segments) sum of squares of the K-weighted signal over each complete 100 ms segment
+    The biquads are recursive, so instead of one long loop over the samples every segment is filtered at once from a
+    zero state, stepping through the segments sample by sample. The state each segment really starts from is then
+    chained from segment to segment, and its (linear) effect is added back with one matrix product
+    """
+    length = sample_rate // SEGMENTS_PER_SECOND
+    count = len(samples) // length
+    channels = samples.shape[1]
+    (b0, b1, b2, a1, a2), (c0, c1, c2, d1, d2) = k_weighting(sample_rate)
+
+    # Zero-copy (length, channels, count) view: row i holds sample i of every segment of every channel
+    segments = samples[:count * length].reshape(count, length, channels).transpose(1, 2, 0)
+    filtered = np.empty((length, channels, count))
+    states = [np.zeros((channels, count)) for _ in range(4)]
+    s1, s2, s3, s4 = states
+    x = np.empty((channels, count))
+    y = np.empty((channels, count))
+    scratch = np.empty((channels, count))
+    product = np.empty((channels, count))
+    b0, b1, b2 = b0 / 32768, (b1 - a1 * b0) / 32768, (b2 - a2 * b0) / 32768  # Input scaled from int16 to +-1.0
+    c1, c2 = c1 - d1 * c0, c2 - d2 * c0
+
+    # Transposed direct form II, both biquads in series, with in-place arithmetic to avoid temporary arrays
+    for index in range(length):
+        x[...] = segments[index]
+        np.multiply(x, b0, out=y)
+        y += s1
+        np.multiply(s1, -a2, out=scratch)
+        s1 *= -a1
+        s1 += s2
+        s1 += np.multiply(x, b1, out=product)
+        s2, scratch = scratch, s2
+        s2 += np.multiply(x, b2, out=product)
+
+        output = filtered[index]
+        np.multiply(y, c0, out=output)
+        output += s3
+        np.multiply(s3, -d2, out=scratch)
+        s3 *= -d1
+        s3 += s4
+        s3 += np.multiply(y, c1, out=product)
+        s4, scratch = scratch, s4
+        s4 += np.multiply(y, c2, out=product)
+
+    # States left at the end of each segment from a zero start, chained to find the state each segment starts from
+    response, carry = state_response(sample_rate, length)
+    end_states = np.stack((s1, s2, s3, s4))
+    start_states = np.empty_like(end_states)
+    state = np.zeros((4, channels))
+    for segment in range(count):
+        start_states[:, :, segment] = state
+        state = end_states[:, :, segment] + carry @ state
+
+    filtered = filtered.reshape(length, -1)
+    filtered += response @ start_states.reshape(4, -1)
+    return np.einsum('ij,ij->j', filtered, filtered).reshape(channels, count)
+
+
+def integrated_loudness(samples, sample_rate):
+    """Gated integrated loudness in LUFS of an int16 (frames, channels) array, as defined by BS.1770-4
+    Clips shorter than one 400 ms block are measured as a single block
+    """
+    segment_length = sample_rate // SEGMENTS_PER_SECOND
+    block_length = SEGMENTS_PER_BLOCK * segment_length
+    energy = segment_energy(samples, sample_rate).sum(axis=0)
+    if len(energy) == 0:
+        return -math.inf
+    if len(energy) >= SEGMENTS_PER_BLOCK:
+        # Each block is the sum of four consecutive segments, taken from a cumulative sum
+        cumulative = np.concatenate(([0.0], np.cumsum(energy)))
+        power = (cumulative[SEGMENTS_PER_BLOCK:] - cumulative[:-SEGMENTS_PER_BLOCK]) / block_length
+    else:
+        power = energy.sum(keepdims=True) / (len(energy) * segment_length)
+
+    with np.errstate(divide='ignore'):
+        block_loudness = -0.691 + 10 * np.log10(power)
+    gated = power[block_loudness > ABSOLUTE_GATE]
+    if len(gated) == 0:
+        return -math.inf
+
+    relative_gate = -0.691 + 10 * np.log10(gated.mean()) + RELATIVE_GATE
+    gated = power[(block_loudness > ABSOLUTE_GATE) & (block_loudness > relative_gate)]
+    return -0.691 + 10 * math.log10(gated.mean())
+
+
+def true_peak(samples, sample_rate):
+    """True peak in dBTP of an int16 (frames, channels) array, from the signal oversampled 4x
+    An interpolated value can be at most the filter's gain times the largest sample in its window, so only the
+    windows around samples loud enough to beat the sample peak are interpolated
+    """
+    if len(samples) == 0:
+        return -math.inf
+    bank = kerokero_resample.get_resampler(sample_rate, sample_rate * TRUE_PEAK_OVERSAMPLING, TRUE_PEAK_QUALITY).bank
+    taps = bank.shape[1]
+    max_gain = float(np.abs(bank).sum(axis=1).max())
+    peak = float(max(int(samples.max()), -int(samples.min())))
+    threshold = peak / max_gain
+
+    for channel in range(samples.shape[1]):
+        signal = samples[:, channel]
+        padded = np.concatenate((np.zeros(taps, signal.dtype), signal, np.zeros(taps, signal.dtype)))
+
+        # Outputs between position p and p + 1 use the inputs from p + 1 - taps // 2, as in Resampler.process, so
+        # mark every position whose window holds a sample above the threshold (indexes here are into padded)
+        loud = np.flatnonzero((padded > threshold) | (padded < -threshold))
+        near_loud = np.zeros(len(padded), dtype=bool)
+        for offset in range(taps):
+            near_loud[loud - offset + taps // 2 - 1] = True
+        positions = np.flatnonzero(near_loud[taps:taps + len(signal)]) + taps
+
+        window_offsets = np.arange(taps) + 1 - taps // 2
+        for first in range(0, len(positions), TRUE_PEAK_CHUNK_SIZE):
+            windows = padded[positions[first:first + TRUE_PEAK_CHUNK_SIZE, np.newaxis] + window_offsets]
+            peak = max(peak, float(np.abs(windows.astype(np.float32) @ bank.T).max()))
+
+    return 20 * math.log10(peak / 32768) if peak > 0 else -math.inf
+
+
+@kerokero_trace.traced("measure_loudness")
+def measure_loudness(samples, sample_rate):
+    """Measures the integrated loudness and true peak of an int16 (frames, channels) array"""
+    return Loudness(integrated_loudness(samples, sample_rate), true_peak(samples, sample_rate))
+
+
+def benchmark(seconds=90, cases=((44100, 2), (48000, 2), (21560, 1), (22050, 1))):
+    """Times the meter on noise shaped like music, and checks it against a full-scale 997 Hz sine (-3.01 LUFS)"""
+    rng = np.random.default_rng(0)
+    for sample_rate, channels in cases:
+        samples = (rng.standard_normal((seconds * sample_rate, channels)) * 3000).clip(-32768, 32767).astype(np.int16)
+        start_time = time.perf_counter()
+        loudness = measure_loudness(samples, sample_rate)
+        elapsed = time.perf_counter() - start_time
+        print(f"{seconds} s, {sample_rate} Hz, {channels} channel(s): {elapsed * 1000:7.1f} ms  {loudness}")
+
+    sine = np.sin(2 * np.pi * 997 * np.arange(10 * 48000) / 48000) * 32767
+    print(f"Full-scale 997 Hz sine: {measure_loudness(sine.astype(np.int16).reshape(-1, 1), 48000)}")
+
+
+if __name__ == "__main__":
+    benchmark()
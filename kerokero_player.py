@@ -0,0 +1,231 @@
+# Kerokero audio player - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Callback-driven playback using a sounddevice OutputStream. The stream reads frames straight from the sample buffer
+# with a read pointer that wraps around when looping, so loops are sample-accurate and gapless with no pre-looped copy.
+# The playhead is derived from the stream clock, so it stays accurate however late the GUI event loop runs.
+# A kerokero_audio.ProgressiveDecoder can be played while it is still decoding: the callback reads up to the decoded
+# frontier and plays silence if it ever catches up with it, and seeking past the frontier stops at the frontier.
+# Buffers at rates the sound card may not play well (such as the 21560 Hz pagefile rate) can be resampled to the
+# device's own rate a block at a time as they play, so the buffer itself is never copied or changed.
+
+import logging
+import threading
+
+import numpy as np
+import sounddevice as sd
+
+import kerokero_audio
+import kerokero_resample
+import kerokero_trace
+
+# Number of frames rendered per callback. Start and stop latency is roughly one block.
+DEFAULT_BLOCKSIZE = 512
+
+# Resampling quality used when resampling to the device rate during playback, which runs on the audio thread
+PLAYBACK_RESAMPLE_QUALITY = "medium"
+
+
+class AudioPlayer:
+    """Plays int16 (frames, channels) sample buffers, optionally looping, with gain applied per block"""
+
+    def __init__(self, blocksize=DEFAULT_BLOCKSIZE):
+        self.blocksize = blocksize
+        self.stream = None
+        self.samples = None
+        self.decoder = None
+        self.gain_factor = 1.0
+        self.loop = False
+        self.resampler = None  # Set while a buffer is resampled to the device rate as it plays
+        self.position = 0  # Read pointer, in frames of the stream (the buffer's frames unless it is resampled)
+        # Playhead clock: (frame at the start of the last block, stream time that frame reaches the speakers).
+        # Replaced as a whole tuple so it can be read from any thread without locking
+        self.clock = (0, None)
+        self.finished = threading.Event()
+        self.finished.set()
+        self.lock = threading.Lock()
+
+    @property
+    def active(self):
+        """True while audio is being played"""
+        return not self.finished.is_set()
+
+    @kerokero_trace.traced("playback_start")
+    def play(self, samples, frame_rate, loop=False, gain_value=0.0, start_frame=0, resample=False):
+        """Starts playing a sample buffer from start_frame, replacing anything that is currently playing
+        samples can also be a ProgressiveDecoder that is still decoding. If resample is True, a sample buffer is
+        resampled to the output device's default rate as it plays, instead of leaving that to the sound card driver
+        """
+        decoder = None
+        if isinstance(samples, kerokero_audio.ProgressiveDecoder):
+            decoder = samples
+            decoder.wait_for(start_frame)
+            samples, available, _ = decoder.snapshot()
+        else:
+            available = len(samples)
+        if available == 0:
+            raise ValueError("Cannot play an empty audio clip.")
+
+        resampler = None
+        stream_rate = frame_rate
+        if resample and decoder is None:
+            stream_rate = int(sd.query_devices(kind='output')['default_samplerate'])
+            if stream_rate != frame_rate:
+                resampler = kerokero_resample.get_resampler(frame_rate, stream_rate, PLAYBACK_RESAMPLE_QUALITY)
+
+        self.stop()
+
+        with self.lock:
+            self.samples = samples
+            self.decoder = decoder
+            self.gain_factor = kerokero_audio.gain_to_factor(gain_value)
+            self.loop = loop
+            self.resampler = resampler
+            self.position = self._to_stream_frame(min(max(start_frame, 0), available - 1))
+            self.clock = (self.position, None)
+
+        # Re-use the open stream when the format matches, since opening a stream is much slower than starting one
+        channels = samples.shape[1]
+        if self.stream is None or self.stream.samplerate != stream_rate or self.stream.channels != channels:
+            self.close()
+            self.stream = sd.OutputStream(samplerate=stream_rate, channels=channels, dtype='int16',
+                                          blocksize=self.blocksize, callback=self._callback,
+                                          finished_callback=self.finished.set)
+
+        self.finished.clear()
+        self.stream.start()
+        logging.debug(f"Playback started: {len(samples)} frames @ {frame_rate} Hz "
+                      f"(stream @ {stream_rate} Hz), loop: {loop}")
+
+    def seek(self, frame):
+        """Moves the read pointer to another frame while playing. A frame that has not been decoded yet is moved back to
+        the last decoded frame, so this never waits for the decoder
+        """
+        with self.lock:
+            _, available, _ = self._source()
+            self.position = self._to_stream_frame(min(max(int(frame), 0), available - 1))
+            self.clock = (self.position, None)
+
+    def stop(self):
+        """Stops playback immediately, discarding any queued audio
+        A stream that reached the end of a buffer by itself is inactive but not stopped, and must still be stopped
+        before it can be started again
+        """
+        if self.stream is not None and not self.stream.stopped:
+            # Freeze the clock in stream frames; playhead_frame converts it to a buffer frame when it is read
+            frame, dac_time = self.clock
+            if dac_time is not None:
+                frame += int(round((self.stream.time - dac_time) * self.stream.samplerate))
+            self.clock = (frame, None)
+            self.stream.abort()
+        self.finished.set()
+
+    def playhead_frame(self):
+        """Returns the index of the frame currently being heard, interpolated from the stream clock"""
+        frame, dac_time = self.clock
+        if self.samples is None:
+            return 0
+        if dac_time is not None and self.stream is not None:
+            frame += int(round((self.stream.time - dac_time) * self.stream.samplerate))
+        frame = self._to_buffer_frame(frame)
+
+        _, available, _ = self._source()
+        if self.loop:
+            return frame % available
+        return min(max(frame, 0), available)
+
+    def playhead_ms(self):
+        """Returns the playhead position in milliseconds from the start of the buffer being played"""
+        if self.stream is None:
+            return 0
+        frame_rate = self.stream.samplerate if self.resampler is None else self.resampler.source_rate
+        return int(round(self.playhead_frame() * 1000 / frame_rate))
+
+    def close(self):
+        """Stops playback and releases the audio device"""
+        self.stop()
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def _source(self):
+        """Returns (sample buffer, number of frames that can be played, whether the buffer is complete)"""
+        if self.decoder is not None:
+            return self.decoder.snapshot()
+        return self.samples, len(self.samples), True
+
+    def _to_stream_frame(self, frame):
+        """Converts a frame of the buffer to a frame of the output stream"""
+        if self.resampler is None:
+            return frame
+        return frame * self.resampler.up // self.resampler.down
+
+    def _to_buffer_frame(self, frame):
+        """Converts a frame of the output stream to a frame of the buffer"""
+        if self.resampler is None:
+            return frame
+        return frame * self.resampler.down // self.resampler.up
+
+    def _callback(self, outdata, frames, time_info, status):
+        """Fills one block of the output stream from the sample buffer (runs on the audio thread)"""
+        with self.lock:
+            samples, available, complete = self._source()
+            position = self.position
+            written = 0
+
+            # Record when the first frame of this block will be heard. Some host APIs do not report the DAC time,
+            # in which case it is estimated from the current time and the output latency
+            dac_time = time_info.outputBufferDacTime or time_info.currentTime + self.stream.latency
+            self.clock = (position, dac_time)
+
+            if self.resampler is not None:
+                self._resample_block(outdata, samples, position)
+                return
+
+            while written < frames:
+                if position >= available and not complete:
+                    # Caught up with the decoder: play silence until more of the file has been decoded
+                    outdata[written:] = 0
+                    break
+
+                count = min(frames - written, available - position)
+                self._write(outdata[written:written + count], samples[position:position + count])
+                written += count
+                position += count
+
+                if position >= available and complete:
+                    if not self.loop:
+                        # End of the buffer: pad the block with silence and let the stream finish
+                        outdata[written:] = 0
+                        self.position = position
+                        raise sd.CallbackStop
+                    position = 0
+
+            self.position = position
+
+    def _resample_block(self, outdata, samples, position):
+        """Fills a block of the output stream by resampling the buffer to the stream rate (runs on the audio thread)
+        Stream frames are counted from the start of the buffer and keep counting up while looping, so the resampler
+        reads across the loop point and the loop stays seamless at any rate ratio
+        """
+        frames = len(outdata)
+        end = self.resampler.output_length(len(samples))
+        if not self.loop:
+            frames = max(min(frames, end - position), 0)
+
+        block = self.resampler.process_range(samples, position, frames, wrap=self.loop)
+        self._write(outdata[:frames], block)
+        self.position = position + frames
+        if frames < len(outdata):
+            # End of the buffer: pad the block with silence and let the stream finish
+            outdata[frames:] = 0
+            raise sd.CallbackStop
+
+    def _write(self, outdata, block):
+        """Copies a block of samples into the output buffer, applying the gain factor if needed"""
+        if self.gain_factor == 1.0 and block.dtype == np.int16:
+            outdata[:] = block
+        else:
+            work = block * np.float32(self.gain_factor)
+            np.clip(work, -32768, 32767, out=work)
+            outdata[:] = work
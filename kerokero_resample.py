@@ -0,0 +1,156 @@
+# Kerokero resampler - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Polyphase windowed-sinc resampler written in NumPy. Replaces pydub's set_frame_rate (audioop.ratecv, which is linear
+# interpolation and was removed from the standard library in Python 3.13) for the 21560/22050 Hz targets.
+# Filter banks are built once per (source rate, target rate, quality) and reused.
+#
+# Run this file directly to benchmark it against pydub: python kerokero_resample.py
+
+import functools
+import math
+import time
+
+import numpy as np
+
+import kerokero_trace
+
+# Quality tiers: (taps per phase, Kaiser window beta, cutoff as a fraction of the lower Nyquist frequency)
+QUALITY_SETTINGS = {
+    "fast": (16, 6.0, 0.90),
+    "medium": (32, 8.0, 0.94),
+    "high": (64, 10.0, 0.96),
+}
+DEFAULT_QUALITY = "high"
+
+
+class Resampler:
+    """Resamples by the rational ratio target_rate / source_rate using a precomputed polyphase filter bank"""
+
+    def __init__(self, source_rate, target_rate, quality=DEFAULT_QUALITY):
+        if quality not in QUALITY_SETTINGS:
+            raise ValueError(f"Resampling quality must be one of {', '.join(QUALITY_SETTINGS)}, not {quality}.")
+
+        divisor = math.gcd(int(source_rate), int(target_rate))
+        self.source_rate = source_rate
+        self.target_rate = target_rate
+        self.quality = quality
+        self.up = int(target_rate) // divisor
+        self.down = int(source_rate) // divisor
+        self.taps, beta, rolloff = QUALITY_SETTINGS[quality]
+        self.bank = self._build_bank(beta, rolloff)
+
+    def _build_bank(self, beta, rolloff):
+        """Builds the (up, taps) polyphase filter bank from a Kaiser-windowed sinc low-pass filter"""
+        # Cutoff in cycles per sample of the upsampled signal (source_rate * up)
+        cutoff = 0.5 * rolloff / max(self.up, self.down)
+        half_length = self.taps * self.up / 2
+
+        # Row p holds the filter taps applied to the input samples around an output that falls p/up of the way
+        # between two input samples. Offsets are in upsampled samples from the filter centre
+        phases = np.arange(self.up)[:, np.newaxis]
+        taps = np.arange(self.taps)[np.newaxis, :]
+        offsets = phases + (self.taps // 2 - 1 - taps) * self.up
+
+        window = np.i0(beta * np.sqrt(np.clip(1 - (offsets / half_length) ** 2, 0, 1))) / np.i0(beta)
+        bank = 2 * cutoff * np.sinc(2 * cutoff * offsets) * window
+
+        # Normalize every phase to unity gain at DC, so there is no phase-dependent ripple
+        bank /= bank.sum(axis=1, keepdims=True)
+        return bank.astype(np.float32)
+
+    def output_length(self, input_length):
+        """Number of output frames produced for input_length input frames"""
+        return -(-input_length * self.up // self.down)
+
+    def process(self, signal):
+        """Resamples a 1-D float32 signal, returning a new float32 array"""
+        signal = np.asarray(signal, dtype=np.float32)
+        output_length = self.output_length(len(signal))
+        output = np.empty(output_length, dtype=np.float32)
+        if output_length == 0:
+            return output
+
+        # Zero-pad so every filter window stays inside the array
+        pad = self.taps
+        padded = np.concatenate((np.zeros(pad, dtype=np.float32), signal,
+                                 np.zeros(pad + self.down + self.taps, dtype=np.float32)))
+        itemsize = padded.strides[0]
+
+        # Outputs n, n + up, n + 2 * up, ... share a filter phase and their inputs advance by 'down' samples,
+        # so each phase is one matrix-vector product over a zero-copy strided view of the input
+        for first in range(min(self.up, output_length)):
+            position = first * self.down
+            phase = position % self.up
+            start = position // self.up + 1 - self.taps // 2 + pad
+            count = len(range(first, output_length, self.up))
+            windows = np.lib.stride_tricks.as_strided(padded[start:], shape=(count, self.taps),
+                                                      strides=(self.down * itemsize, itemsize), writeable=False)
+            output[first::self.up] = windows @ self.bank[phase]
+
+        return output
+
+    def process_range(self, samples, first, count, wrap=False):
+        """Computes output frames first .. first + count - 1 of an int16 (frames, channels) array, returning a float32
+        (count, channels) array. Used to resample a buffer a block at a time while it plays. With wrap=True the
+        input repeats endlessly, so output frames past the end continue seamlessly from the start of the buffer
+        """
+        positions = np.arange(first, first + count, dtype=np.int64) * self.down
+        phases = positions % self.up
+        indexes = (positions // self.up + 1 - self.taps // 2)[:, np.newaxis] + np.arange(self.taps)
+
+        if wrap:
+            windows = samples[indexes % len(samples)]
+        else:
+            inside = (indexes >= 0) & (indexes < len(samples))
+            windows = np.where(inside[:, :, np.newaxis], samples[np.clip(indexes, 0, len(samples) - 1)], 0)
+        return np.einsum('itc,it->ic', windows.astype(np.float32), self.bank[phases])
+
+
+@functools.lru_cache(maxsize=16)
+def get_resampler(source_rate, target_rate, quality=DEFAULT_QUALITY):
+    """Returns a cached Resampler, so filter banks are only built once for each ratio and quality"""
+    return Resampler(source_rate, target_rate, quality)
+
+
+def resample(samples, source_rate, target_rate, quality=DEFAULT_QUALITY):
+    """Resamples an int16 (frames, channels) array, returning a new int16 array"""
+    if source_rate == target_rate:
+        return samples
+
+    with kerokero_trace.span("resample", frames=len(samples), rates=f"{source_rate}->{target_rate}", quality=quality):
+        resampler = get_resampler(source_rate, target_rate, quality)
+        output = np.empty((resampler.output_length(len(samples)), samples.shape[1]), dtype=np.int16)
+        for channel in range(samples.shape[1]):
+            resampled = resampler.process(samples[:, channel])
+            np.clip(np.round(resampled, out=resampled), -32768, 32767, out=resampled)
+            output[:, channel] = resampled
+    return output
+
+
+def benchmark(seconds=90, rate_pairs=((44100, 21560), (48000, 22050), (44100, 22050), (21560, 22050))):
+    """Prints the throughput of each quality tier and of pydub's set_frame_rate, in input samples per second"""
+    from pydub import AudioSegment
+
+    rng = np.random.default_rng(0)
+    print(f"{'Conversion':<20}{'Method':<16}{'Time (s)':>10}{'Samples/s':>16}")
+    for source_rate, target_rate in rate_pairs:
+        samples = (rng.standard_normal((seconds * source_rate, 1)) * 8000).astype(np.int16)
+        conversion = f"{source_rate} -> {target_rate}"
+
+        for quality in QUALITY_SETTINGS:
+            get_resampler(source_rate, target_rate, quality)  # Build the filter bank outside the timing
+            start_time = time.perf_counter()
+            resample(samples, source_rate, target_rate, quality)
+            elapsed = time.perf_counter() - start_time
+            print(f"{conversion:<20}{quality:<16}{elapsed:>10.3f}{len(samples) / elapsed:>16,.0f}")
+
+        segment = AudioSegment(data=samples.tobytes(), sample_width=2, frame_rate=source_rate, channels=1)
+        start_time = time.perf_counter()
+        segment.set_frame_rate(target_rate)
+        elapsed = time.perf_counter() - start_time
+        print(f"{conversion:<20}{'pydub':<16}{elapsed:>10.3f}{len(samples) / elapsed:>16,.0f}")
+
+
+if __name__ == "__main__":
+    benchmark()
@@ -0,0 +1,116 @@
+# Kerokero tracing - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Lightweight timing spans for the audio pipeline. Time a block with 'with span("decode", file=name):' or a whole
+# function with the @traced() decorator. Finished spans are logged at DEBUG level to the "kerokero.trace" logger and,
+# when recording, kept so the session can be saved as a Chrome trace (open it in chrome://tracing or ui.perfetto.dev).
+# While tracing is disabled a span costs a single flag check. This module must not import PyQt5.
+
+import functools
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("kerokero.trace")
+
+# Set by enable(): whether spans are timed at all, and whether finished spans are kept for save_chrome_trace
+enabled = False
+recording = False
+
+# Recorded spans as (name, start time, duration, thread id, args). list.append is atomic, so no lock is needed
+events = []
+thread_names = {}
+
+
+def enable(record=False):
+    """Turns on timing of spans, and keeps them for save_chrome_trace if record is True"""
+    global enabled, recording
+    enabled = True
+    recording = recording or record
+
+
+def disable():
+    """Turns off timing and recording of spans"""
+    global enabled, recording
+    enabled = False
+    recording = False
+
+
+class Span:
+    """Times the code inside a with statement"""
+    __slots__ = ("name", "args", "start")
+
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.perf_counter() - self.start
+        if recording:
+            thread = threading.current_thread()
+            thread_names[thread.ident] = thread.name
+            events.append((self.name, self.start, duration, thread.ident, self.args))
+        if self.args:
+            logger.debug("%s took %.1f ms %s", self.name, duration * 1000, self.args)
+        else:
+            logger.debug("%s took %.1f ms", self.name, duration * 1000)
+        return False
+
+
+class NullSpan:
+    """Stands in for a Span while tracing is disabled"""
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+def span(name, **args):
+    """Returns a context manager that times a block of code. Keyword arguments are shown with the span in traces"""
+    if not enabled:
+        return NULL_SPAN
+    return Span(name, args)
+
+
+def traced(name=None):
+    """Decorator that times each call of a function as a span, named after the function unless a name is given
+    Qt slots must also be decorated with @pyqtSlot() so that Qt does not pass them the signal's arguments
+    """
+    def decorator(function):
+        span_name = name or function.__qualname__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            with Span(span_name, {}):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def save_chrome_trace(path):
+    """Writes the recorded spans to a Chrome trace event file"""
+    process_id = os.getpid()
+    trace_events = [{"name": "thread_name", "ph": "M", "pid": process_id, "tid": thread_id, "args": {"name": name}}
+                    for thread_id, name in thread_names.items()]
+    for name, start, duration, thread_id, args in list(events):
+        trace_events.append({"name": name, "ph": "X", "ts": start * 1e6, "dur": duration * 1e6, "pid": process_id,
+                             "tid": thread_id, "args": {key: str(value) for key, value in args.items()}})
+
+    with open(path, 'w') as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+    logger.info(f"Saved {len(events)} trace spans to {path}")
@@ -0,0 +1,262 @@
+# Kerokero widgets - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Custom PyQt5 widgets used by the Kerokero GUI.
+
+from PyQt5.QtCore import QPointF, QRectF, Qt, pyqtSignal
+from PyQt5.QtGui import QColor, QImage, QPainter, QPen, QPolygonF, qRgb
+from PyQt5.QtWidgets import QWidget
+
+# Colours used by the waveform view
+BACKGROUND_COLOR = QColor(32, 32, 32)
+WAVEFORM_COLOR = QColor(80, 200, 120)
+CENTER_LINE_COLOR = QColor(70, 70, 70)
+START_MARKER_COLOR = QColor(90, 160, 255)
+END_MARKER_COLOR = QColor(255, 90, 90)
+PLAYHEAD_COLOR = QColor(255, 255, 255)
+
+# Zoom factor per mouse wheel step, and the narrowest view in frames
+ZOOM_STEP = 1.25
+MIN_VIEW_FRAMES = 64
+
+# Mouse movement in pixels below which a press and release count as a click rather than a drag
+CLICK_DISTANCE = 3
+
+# Spectrogram view: how much audio is shown on each side of the loop seam, and the FFT sizes the mouse wheel steps
+# through (larger sizes show pitch more sharply, smaller sizes show timing more sharply)
+SEAM_LENGTH = 1000  # ms
+SPECTROGRAM_FFT_SIZES = (256, 512, 1024, 2048, 4096)
+DEFAULT_SPECTROGRAM_FFT_SIZE = 1024
+
+# Spectrogram colours from quiet to loud, interpolated into a 256 entry colour table for 8-bit indexed images.
+# The table is built without numpy so that importing this module doesn't slow down startup
+SPECTROGRAM_GRADIENT = ((0, (0, 0, 0)), (64, (40, 10, 90)), (128, (180, 40, 110)), (192, (250, 140, 40)),
+                        (255, (255, 250, 180)))
+SPECTROGRAM_COLORS = [
+    qRgb(*(int(round(low_color[channel] + (high_color[channel] - low_color[channel]) * (level - low) / (high - low)))
+           for channel in range(3)))
+    for (low, low_color), (high, high_color) in zip(SPECTROGRAM_GRADIENT, SPECTROGRAM_GRADIENT[1:])
+    for level in range(low, high)
+] + [qRgb(*SPECTROGRAM_GRADIENT[-1][1])]
+
+
+class WaveformView(QWidget):
+    """Waveform overview drawn from a kerokero_analysis.PeakPyramid, with the in/out points and playhead
+    Mouse wheel zooms around the cursor, dragging scrolls, double-clicking shows the whole track, and clicking emits
+    seek_requested with the position clicked in milliseconds. Clicking also works before the peaks are ready, once the
+    length of the track has been set
+    """
+    seek_requested = pyqtSignal(float)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.pyramid = None
+        self.frame_rate = None
+        self.view_start = 0
+        self.view_end = 0
+        self.start_frame = None
+        self.end_frame = None
+        self.playhead_frame = None
+        self.drag_x = None
+        self.press_x = None
+        self.setMinimumHeight(60)
+        self.setToolTip("Mouse wheel to zoom, drag to scroll, double-click to show the whole track, "
+                        "click to move the playhead while playing")
+
+    def clear(self):
+        """Removes the waveform, for example while a new file is loading"""
+        self.pyramid = None
+        self.frame_rate = None
+        self.view_start = self.view_end = 0
+        self.playhead_frame = None
+        self.update()
+
+    def set_length(self, frame_count, frame_rate):
+        """Shows the full length of a track whose peaks are not ready yet, so the playhead can be shown and clicked"""
+        self.pyramid = None
+        self.frame_rate = frame_rate
+        self.view_start = 0
+        self.view_end = frame_count
+        self.update()
+
+    def set_pyramid(self, pyramid, frame_rate):
+        """Shows a new track, zoomed out to its full length"""
+        self.pyramid = pyramid
+        self.frame_rate = frame_rate
+        self.view_start = 0
+        self.view_end = pyramid.frame_count
+        self.update()
+
+    def set_markers(self, start_pos, end_pos):
+        """Sets the in and out markers, in milliseconds (None hides a marker)"""
+        self.start_frame = self._ms_to_frame(start_pos)
+        self.end_frame = self._ms_to_frame(end_pos)
+        self.update()
+
+    def set_playhead(self, position):
+        """Sets the playhead position in milliseconds (None hides it)"""
+        self.playhead_frame = self._ms_to_frame(position)
+        self.update()
+
+    def _ms_to_frame(self, position):
+        if position is None or self.frame_rate is None:
+            return None
+        return position * self.frame_rate / 1000
+
+    def _frame_to_x(self, frame):
+        return (frame - self.view_start) * self.width() / max(self.view_end - self.view_start, 1)
+
+    def _set_view(self, start, end):
+        """Sets the visible range of frames, keeping it inside the track"""
+        length = min(max(end - start, MIN_VIEW_FRAMES), self.pyramid.frame_count)
+        start = min(max(start, 0), self.pyramid.frame_count - length)
+        self.view_start, self.view_end = int(start), int(start + length)
+        self.update()
+
+    def paintEvent(self, event):
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), BACKGROUND_COLOR)
+        middle = self.height() / 2
+        painter.setPen(CENTER_LINE_COLOR)
+        painter.drawLine(0, int(middle), self.width(), int(middle))
+
+        if self.view_end <= self.view_start:
+            painter.end()
+            return
+
+        # One min/max pair per pixel, drawn as a single filled polygon: maximums left to right, minimums back
+        if self.pyramid is not None:
+            width = self.width()
+            minimums, maximums = self.pyramid.peaks(self.view_start, self.view_end, width)
+            scale = middle / 32768
+            top = [QPointF(x, middle - value * scale) for x, value in enumerate(maximums.tolist())]
+            bottom = [QPointF(x, middle - value * scale) for x, value in enumerate(minimums.tolist())]
+            painter.setPen(WAVEFORM_COLOR)
+            painter.setBrush(WAVEFORM_COLOR)
+            painter.drawPolygon(QPolygonF(top + bottom[::-1]))
+
+        # In/out markers and playhead
+        for frame, color in ((self.start_frame, START_MARKER_COLOR), (self.end_frame, END_MARKER_COLOR),
+                             (self.playhead_frame, PLAYHEAD_COLOR)):
+            if frame is not None and self.view_start <= frame <= self.view_end:
+                x = int(self._frame_to_x(frame))
+                painter.setPen(QPen(color, 1))
+                painter.drawLine(x, 0, x, self.height())
+
+        painter.end()
+
+    def wheelEvent(self, event):
+        if self.pyramid is None:
+            return
+        # Zoom around the frame under the mouse cursor
+        steps = event.angleDelta().y() / 120
+        factor = ZOOM_STEP ** -steps
+        anchor = self.view_start + event.pos().x() / max(self.width(), 1) * (self.view_end - self.view_start)
+        self._set_view(anchor - (anchor - self.view_start) * factor, anchor + (self.view_end - anchor) * factor)
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.drag_x = event.pos().x()
+            self.press_x = event.pos().x()
+
+    def mouseMoveEvent(self, event):
+        if self.pyramid is None or self.drag_x is None:
+            return
+        # Scroll by the distance dragged, converted from pixels to frames
+        offset = (self.drag_x - event.pos().x()) * (self.view_end - self.view_start) / max(self.width(), 1)
+        self.drag_x = event.pos().x()
+        self._set_view(self.view_start + offset, self.view_end + offset)
+
+    def mouseReleaseEvent(self, event):
+        self.drag_x = None
+        clicked = self.press_x is not None and abs(event.pos().x() - self.press_x) < CLICK_DISTANCE
+        if self.view_end > self.view_start and clicked:
+            frame = self.view_start + event.pos().x() / max(self.width(), 1) * (self.view_end - self.view_start)
+            self.seek_requested.emit(frame * 1000 / self.frame_rate)
+        self.press_x = None
+
+    def mouseDoubleClickEvent(self, event):
+        if self.pyramid is not None:
+            self._set_view(0, self.pyramid.frame_count)
+
+
+class SpectrogramView(QWidget):
+    """Spectrogram of the loop seam, drawn from a kerokero_analysis.SpectrogramTiles: the audio up to the out point on
+    the left, joined to the audio from the in point on the right, as they are heard when the clip loops
+    Tiles are computed in the background and drawn as they arrive. The mouse wheel changes the FFT size
+    """
+    tile_ready = pyqtSignal()
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.tiles = None
+        self.start_pos = None
+        self.end_pos = None
+        self.fft_size = DEFAULT_SPECTROGRAM_FFT_SIZE
+        self.setMinimumHeight(60)
+        self._update_tooltip()
+        # Tiles finish on worker threads, so this signal is queued to repaint on the GUI thread
+        # noinspection PyUnresolvedReferences
+        self.tile_ready.connect(self.update)
+
+    def clear(self):
+        """Removes the spectrogram, for example while a new file is loading"""
+        if self.tiles is not None:
+            self.tiles.close()
+        self.tiles = None
+        self.update()
+
+    def set_tiles(self, tiles):
+        """Shows the spectrogram of a new track"""
+        self.clear()
+        self.tiles = tiles
+        self.update()
+
+    def set_markers(self, start_pos, end_pos):
+        """Sets the in and out points in milliseconds. Nothing is shown unless both are set"""
+        self.start_pos = start_pos
+        self.end_pos = end_pos
+        self.update()
+
+    def _update_tooltip(self):
+        self.setToolTip(f"Spectrogram of the loop: the {SEAM_LENGTH} ms before the End Position, then the "
+                        f"{SEAM_LENGTH} ms after the Start Position.\n"
+                        f"Mouse wheel to change the FFT size (currently {self.fft_size})")
+
+    def paintEvent(self, event):
+        # Imported here rather than at the top so that numpy loads after the window is shown
+        import numpy as np
+
+        painter = QPainter(self)
+        painter.fillRect(self.rect(), BACKGROUND_COLOR)
+        if self.tiles is None or self.start_pos is None or self.end_pos is None:
+            painter.end()
+            return
+
+        # End of the clip on the left half, start of the clip on the right half
+        middle = self.width() // 2
+        start_frame, end_frame, seam_frames = (position * self.tiles.frame_rate / 1000
+                                               for position in (self.start_pos, self.end_pos, SEAM_LENGTH))
+        for left, right, first, last in ((0, middle, end_frame - seam_frames, end_frame),
+                                         (middle, self.width(), start_frame, start_frame + seam_frames)):
+            # Low frequencies at the bottom. The image reads the uint8 levels in place through the colour table
+            levels = np.ascontiguousarray(self.tiles.columns(first, last, self.fft_size, self.tile_ready.emit)[::-1])
+            if levels.shape[1] == 0:
+                continue
+            image = QImage(levels.data, levels.shape[1], levels.shape[0], levels.strides[0], QImage.Format_Indexed8)
+            image.setColorTable(SPECTROGRAM_COLORS)
+            painter.drawImage(QRectF(left, 0, right - left, self.height()), image)
+
+        # The loop seam, coloured half and half like the out and in markers
+        painter.setPen(QPen(END_MARKER_COLOR, 1))
+        painter.drawLine(middle - 1, 0, middle - 1, self.height())
+        painter.setPen(QPen(START_MARKER_COLOR, 1))
+        painter.drawLine(middle, 0, middle, self.height())
+        painter.end()
+
+    def wheelEvent(self, event):
+        # Step through the FFT sizes, one size per wheel step
+        index = SPECTROGRAM_FFT_SIZES.index(self.fft_size) + (1 if event.angleDelta().y() > 0 else -1)
+        self.fft_size = SPECTROGRAM_FFT_SIZES[min(max(index, 0), len(SPECTROGRAM_FFT_SIZES) - 1)]
+        self._update_tooltip()
+        self.update()
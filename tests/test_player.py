@@ -0,0 +1,102 @@
+# Kerokero player tests - SF2000+GB300 BGM Tool by Dteyn
+# https://github.com/Dteyn/SF2000_BGM_Tool
+#
+# Tests kerokero_player.AudioPlayer against a stand-in for sounddevice's OutputStream that follows PortAudio's stream
+# states, so they run without a sound card. The callback is run by the test instead of an audio thread.
+#
+# Usage (from the repository folder):
+#   python -m pytest tests
+
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+try:
+    import kerokero_player  # noqa: E402
+except OSError:
+    # sounddevice raises OSError when the PortAudio library is not installed
+    pytest.skip("PortAudio is not installed", allow_module_level=True)
+
+
+class FakeOutputStream:
+    """Output stream with PortAudio's states: a stream that ends by raising CallbackStop is inactive but not
+    stopped, and starting a stream that is not stopped does nothing (sounddevice ignores paStreamIsNotStopped)
+    """
+
+    def __init__(self, samplerate, channels, dtype, blocksize, callback, finished_callback):
+        self.samplerate = samplerate
+        self.channels = channels
+        self.dtype = dtype
+        self.blocksize = blocksize
+        self.callback = callback
+        self.finished_callback = finished_callback
+        self.latency = 0.0
+        self.time = 0.0
+        self.active = False
+        self.stopped = True
+        self.blocks = []
+
+    def start(self):
+        if not self.stopped:
+            return
+        self.active = True
+        self.stopped = False
+        self.blocks = []
+
+    def abort(self):
+        was_active = self.active
+        self.active = False
+        self.stopped = True
+        if was_active:
+            self.finished_callback()
+
+    stop = abort
+
+    def close(self):
+        self.abort()
+
+    def run(self, max_blocks):
+        """Runs the callback until the stream finishes or max_blocks blocks have been played"""
+        for _ in range(max_blocks):
+            if not self.active:
+                return
+            outdata = np.zeros((self.blocksize, self.channels), dtype=np.int16)
+            time_info = SimpleNamespace(outputBufferDacTime=self.time, currentTime=self.time)
+            try:
+                self.callback(outdata, self.blocksize, time_info, None)
+            except kerokero_player.sd.CallbackStop:
+                self.active = False
+                self.finished_callback()
+            self.blocks.append(outdata)
+            self.time += self.blocksize / self.samplerate
+
+
+@pytest.fixture
+def player(monkeypatch):
+    monkeypatch.setattr(kerokero_player.sd, "OutputStream", FakeOutputStream)
+    player = kerokero_player.AudioPlayer(blocksize=256)
+    yield player
+    player.close()
+
+
+def test_replay_after_playing_to_the_end(player):
+    samples = (np.arange(1000) - 500).astype(np.int16).reshape(-1, 1)
+
+    player.play(samples, 22050)
+    stream = player.stream
+    stream.run(10)
+    assert not player.active
+    assert not stream.active and not stream.stopped
+
+    # The same rate and channel count re-uses the stream, which has to be stopped before it will start again
+    player.play(samples, 22050)
+    assert player.stream is stream
+    assert player.active and stream.active
+    stream.run(10)
+    assert not player.active
+    assert np.array_equal(np.concatenate(stream.blocks)[:len(samples)], samples)